@@ -1,6 +1,12 @@
+import csv
 import datetime
+import fnmatch
+import hashlib
+import json
+import mmap
 import multiprocessing
 import os
+import threading
 import time
 import uuid
 import exceptions
@@ -8,9 +14,180 @@ import exceptions
 import boto.sdb
 import boto.exception
 
+from compressed_input import LinesReader, compression, file_index, iter_range
+from sdb_schema import normalize_separator
+from sdb_shards import shard_domain_names, shard_index
+from sdb_telemetry import (REPORT_INTERVAL, Telemetry, TelemetryReporter,
+                           WorkerMetrics)
+from sdb_throttle import (AdaptiveThrottle, is_throttling_error,
+                          throttled_select)
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        # Python 2 backport, https://pypi.python.org/pypi/scandir
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
 
 AWS_WEST_OR_REGION = 'us-west-2'
 
+# Line counts are cached by (path, size, mtime) in this file between runs
+LINE_COUNT_CACHE_FILE = '.line_count_cache.json'
+# Count new lines over the memory-mapped file this many bytes at a time
+LINE_COUNT_BLOCK_SIZE = 16 * 1024 * 1024
+
+# Number of threads sending batch_put_attributes requests concurrently
+SENDER_COUNT = 32
+# Parsed batches waiting for a sender, per sender
+BATCH_QUEUE_DEPTH = 4
+# AWS SimpleDB BatchPutAttributes limits
+SIMPLE_DB_BATCH_LIMIT = 25
+SIMPLE_DB_ATTRIBUTE_PAIR_LIMIT = 256
+SIMPLE_DB_REQUEST_BYTES_LIMIT = 1024 * 1024
+SIMPLE_DB_VALUE_BYTES_LIMIT = 1024
+# Estimated request bytes of the query parameter names around each item and
+# each attribute pair, e.g. "&Item.25.Attribute.256.Name=" and ".Value="
+SIMPLE_DB_ITEM_OVERHEAD_BYTES = 32
+SIMPLE_DB_PAIR_OVERHEAD_BYTES = 96
+# BatchPacker handling of a repeated item name within one batch
+DUPLICATE_KEYS_MERGE = 'merge'
+DUPLICATE_KEYS_SPILL = 'spill'
+# Committed byte offsets of each work unit range are journaled to this file,
+# formatted with the domain name
+UPLOAD_JOURNAL_FILE = '.upload_journal.%s.jsonl'
+# Size, mtime, fingerprint and uploaded offset of each file of a delta upload
+# are kept in this file, formatted with the domain name
+UPLOAD_MANIFEST_FILE = '.upload_manifest.%s.json'
+# Bytes read at a time while hashing the uploaded part of a file into its
+# fingerprint
+FINGERPRINT_BLOCK_SIZE = 1024 * 1024
+# Timestamp columns given a "T" between the date and the time even without a
+# schema, the form the starttime ranges of select_planner compare with
+TIMESTAMP_COLUMNS = ("starttime",)
+# Target bytes of input per parser task.  Large files are split into units of
+# this size and small files are packed together up to this size.
+WORK_UNIT_SIZE = 8 * 1024 * 1024
+
+# {absolute file path: (size, mtime, line_count, byte_count)}
+_line_count_cache = None
+# Queue of parsed batches, set in each parser process by _init_parser
+_batch_queue = None
+
+
+class _ListDirEntry(object):
+    """Minimal stand-in for os.DirEntry when scandir is not available"""
+    __slots__ = ("name", "path", "_stat")
+
+    def __init__(self, dir_path, name):
+        self.name = name
+        self.path = os.path.join(dir_path, name)
+        self._stat = None
+
+    def stat(self):
+        if self._stat is None:
+            self._stat = os.stat(self.path)
+        return self._stat
+
+    def is_dir(self, follow_symlinks=True):
+        if not follow_symlinks and os.path.islink(self.path):
+            return False
+        return os.path.isdir(self.path)
+
+    def is_file(self, follow_symlinks=True):
+        if not follow_symlinks and os.path.islink(self.path):
+            return False
+        return os.path.isfile(self.path)
+
+
+def _scan_dir(dir_path):
+    """List the entries of dir_path with os.scandir when available"""
+    if scandir is not None:
+        return scandir(dir_path)
+    return [_ListDirEntry(dir_path, name) for name in os.listdir(dir_path)]
+
+
+def ext_predicate(ext_filter):
+    """Match files by extension, case insensitive and without the dot.  A
+    compressed file also matches by the extension of its content, e.g.
+    "loop.csv.gz" matches both "gz" and "csv".
+    @param: ext_filter - file extension, e.g. "csv"
+    """
+    ext = ext_filter.replace('.', '').lower()
+
+    def predicate(entry):
+        name = entry.name
+        while True:
+            name, f_ext = os.path.splitext(name)
+            if f_ext.replace('.', '').lower() == ext:
+                return True
+            if not compression(f_ext):
+                return False
+    return predicate
+
+
+def size_predicate(min_size=None, max_size=None):
+    """Match files by size in bytes, both bounds are inclusive
+    @param: min_size - smallest file size to match, None for no lower bound
+    @param: max_size - largest file size to match, None for no upper bound
+    """
+    def predicate(entry):
+        size = entry.stat().st_size
+        if min_size is not None and size < min_size:
+            return False
+        if max_size is not None and size > max_size:
+            return False
+        return True
+    return predicate
+
+
+def glob_predicate(pattern):
+    """Match file names with a shell-style wildcard pattern
+    @param: pattern - e.g. "loop_2011-09-*.csv"
+    """
+    def predicate(entry):
+        return fnmatch.fnmatch(entry.name, pattern)
+    return predicate
+
+
+def modified_since_predicate(since):
+    """Match files modified at or after since
+    @param: since - a datetime.datetime or a POSIX timestamp
+    """
+    if isinstance(since, datetime.datetime):
+        since = time.mktime(since.timetuple())
+
+    def predicate(entry):
+        return entry.stat().st_mtime >= since
+    return predicate
+
+
+def iter_files(root_dir, recursive=True, predicates=None):
+    """Walk from the root_dir and yield each file as soon as it is found.
+    Each directory is scanned exactly once.
+    @param: root_dir - Path to the root directory
+    @param: recursive - set to True to recursively get all files
+    @param: predicates - a list of functions taking a directory entry and
+            returning True to keep the file, see ext_predicate,
+            size_predicate, glob_predicate and modified_since_predicate
+    @yield: file paths
+    """
+    predicates = predicates or []
+    pending_dirs = [root_dir]
+    while pending_dirs:
+        dir_path = pending_dirs.pop()
+        sub_dirs = []
+        for entry in sorted(_scan_dir(dir_path), key=lambda e: e.name):
+            if entry.is_dir(follow_symlinks=False):
+                if recursive:
+                    sub_dirs.append(entry.path)
+            elif entry.is_file() and all(p(entry) for p in predicates):
+                yield entry.path
+        # Depth first, in name order
+        pending_dirs.extend(reversed(sub_dirs))
+
 
 def get_all_files(root_dir, recursive=True, ext_filter=None):
     """Walk from the root_dir to retrieve a list of files
@@ -19,76 +196,606 @@ def get_all_files(root_dir, recursive=True, ext_filter=None):
     @param: ext_filter - file extension filter
     @return: a list of file paths
     """
-    files = []
-    for (dirpath, dirnames, filenames) in os.walk(root_dir):
-        for filename in filenames:
-            if ext_filter:
-                _, f_ext = os.path.splitext(filename)
-                if f_ext.replace('.', '').lower() != ext_filter.lower():
-                    continue
-            files.append(os.path.join(dirpath, filename))
-        if recursive:
-            for dirname in dirnames:
-                files.extend(get_all_files(os.path.join(dirpath, dirname),
-                                           recursive, ext_filter))
-    return files
+    predicates = [ext_predicate(ext_filter)] if ext_filter else []
+    return list(iter_files(root_dir, recursive, predicates))
+
+
+def _init_parser(batch_queue):
+    """Pool initializer to hand the shared batch queue to a parser process"""
+    global _batch_queue
+    _batch_queue = batch_queue
+
+
+class BatchPacker(object):
+    """Pack items into batch put attributes requests filled up to the
+    SimpleDB limits on items per request, attribute pairs per item and
+    request size.
+
+    Items with more than SIMPLE_DB_ATTRIBUTE_PAIR_LIMIT attributes are split
+    across consecutive batches by sorted attribute name, which is safe with
+    replace=True as each put only replaces the attributes it names.
+
+    A repeated item name within a batch is either merged into the earlier
+    item with the later values winning, as if both were put in order
+    (DUPLICATE_KEYS_MERGE), or spilled into the next batch
+    (DUPLICATE_KEYS_SPILL).
+    """
+
+    def __init__(self, duplicate_keys=DUPLICATE_KEYS_MERGE):
+        if duplicate_keys not in (DUPLICATE_KEYS_MERGE, DUPLICATE_KEYS_SPILL):
+            raise exceptions.ValueError("Unknown duplicate_keys '%s'"
+                                        % duplicate_keys)
+        self.duplicate_keys = duplicate_keys
+        # Items skipped because a name or value exceeds the SimpleDB limit
+        self.rejected = 0
+        self._new_batch()
+
+    def _new_batch(self):
+        self.items_batch = {}
+        self.checkpoints = {}
+        self._item_bytes = {}
+        self._batch_bytes = 0
+
+    def _pop_batch(self):
+        batch = (self.items_batch, self.checkpoints)
+        self._new_batch()
+        return batch
+
+    @staticmethod
+    def _request_bytes(item_name, attributes):
+        """Estimate the request bytes of an item"""
+        size = len(item_name) + SIMPLE_DB_ITEM_OVERHEAD_BYTES
+        for name, value in attributes.items():
+            size += len(name) + len(value) + SIMPLE_DB_PAIR_OVERHEAD_BYTES
+        return size
+
+    def add(self, item_name, attributes, checkpoint=None):
+        """Add an item to the current batch
+        @param: item_name - the SimpleDB item name
+        @param: attributes - {attribute name: value}
+        @param: checkpoint - a (range_key, offset) the batch commits once the
+                whole item is sent, see UploadJournal
+        @return: a list of the (items_batch, checkpoints) filled up, usually
+                 empty
+        """
+        full_batches = []
+        oversized = len(item_name) > SIMPLE_DB_VALUE_BYTES_LIMIT or any(
+            len(name) > SIMPLE_DB_VALUE_BYTES_LIMIT or
+            len(value) > SIMPLE_DB_VALUE_BYTES_LIMIT
+            for name, value in attributes.items())
+        if oversized:
+            print("pid: %s\tSkipped item '%s', name or value over %s bytes" %
+                  (os.getpid(), item_name[:64], SIMPLE_DB_VALUE_BYTES_LIMIT))
+            self.rejected += 1
+        else:
+            if item_name in self.items_batch:
+                if self.duplicate_keys == DUPLICATE_KEYS_MERGE:
+                    merged = self.items_batch.pop(item_name)
+                    merged.update(attributes)
+                    attributes = merged
+                    self._batch_bytes -= self._item_bytes.pop(item_name)
+                else:
+                    full_batches.append(self._pop_batch())
+            pairs = sorted(attributes.items())
+            for i in range(0, max(1, len(pairs)), SIMPLE_DB_ATTRIBUTE_PAIR_LIMIT):
+                part = dict(pairs[i:i + SIMPLE_DB_ATTRIBUTE_PAIR_LIMIT])
+                part_bytes = self._request_bytes(item_name, part)
+                if (len(self.items_batch) == SIMPLE_DB_BATCH_LIMIT or
+                        item_name in self.items_batch or
+                        self._batch_bytes + part_bytes >
+                        SIMPLE_DB_REQUEST_BYTES_LIMIT):
+                    full_batches.append(self._pop_batch())
+                self.items_batch[item_name] = part
+                self._item_bytes[item_name] = part_bytes
+                self._batch_bytes += part_bytes
+        if checkpoint:
+            self.add_checkpoint(*checkpoint)
+        return full_batches
+
+    def add_checkpoint(self, range_key, offset):
+        """Let the current batch commit the range up to offset"""
+        self.checkpoints[range_key] = offset
+
+    def flush(self):
+        """@return: a list of the last (items_batch, checkpoints), if any.
+                 The items_batch is empty if only checkpoints are left.
+        """
+        if not (self.items_batch or self.checkpoints):
+            return []
+        return [self._pop_batch()]
 
 
-def sdb_batch_put((file_path, chunk_count, chunk_index, sdb_conn, domain_name,
-                  column_header, key_column, column_delimiter, show_progress)):
-    """Upload all lines in the line iterator object to the SimpleDB domain.
+def sdb_batch_put((file_ranges, domain_names, column_header, key_column,
+                  column_delimiter, show_progress, duplicate_keys,
+                  csv_quoting, shard_key, rollup, schema, indexes)):
+    """Parse all lines in a work unit into batches of items and queue them
+    for the sender threads of upload_to_simpleDB.  Must run in a process
+    initialized by _init_parser.
     @param: a tuple of args.  Needed to unpack multiple params from a single
     param that multiprocess limiting it.
-        @subparam: file_handler - the file object
-        @param: chunk_count - the number of section to divide this file into
-        @param: chunk_index - the index of the chunk to read from
-        @param: lines - an line iterator
-        @param: sdb_conn - a boto.sdb connection
-        @param: domain_name - a SimpleDB domain object
+        @param: file_ranges - a list of (file_path, start, end, offset) byte
+                ranges, see _work_units.  Lines are read from offset, which
+                is past start when resuming from the UploadJournal.
+        @param: domain_names - names of the SimpleDB shard domains, see
+                sdb_shards.shard_domain_names
         @param: column_header - a delimited column name
-        @param: key_column - the field to be use as simpleDB ItemName()
+        @param: key_column - the field to be use as simpleDB ItemName(), None
+                to name each item by its file and line, see line_item_names
         @param: column_delimiter - a delimiter to for the column's header and
                                    each line in the lines iterator
         @param: show_progress - Show the progess of item processed so far
+        @param: duplicate_keys - how BatchPacker handles a repeated key_column
+                value within a batch
+        @param: csv_quoting - set to True to parse quoted fields, see
+                decode_range
+        @param: shard_key - the field to hash to pick the shard of each
+                item, None to hash the item name
+        @param: rollup - an empty loop_rollup.LoopRollup to add the items
+                to, None for no rollup
+        @param: schema - the sdb_schema.Schema to encode the items with,
+                None to upload the values as they are but for the
+                separator of the TIMESTAMP_COLUMNS
+        @param: indexes - {file_path: compressed_input.CompressedIndex} of
+                the compressed files of the work unit, their ranges are
+                uncompressed byte ranges read in order by one LinesReader
+    @return: (worker_id, item_count, WorkerMetrics.to_dict(), rollup cells)
+             for the Telemetry of the upload and the merged rollup
     """
-
-    # AWS SimpleDB API limit
-    SIMPLE_DB_BATCH_LIMIT = 25
+    started = time.time()
+    metrics = WorkerMetrics()
+    queue_wait = 0.0
     # Counter to show progress
     item_counter = 0
-    # A set of items to upload in a batch
-    items_batch = {}
-    attributes = column_header.split(column_delimiter)
-    item_domain = sdb_conn.get_domain(domain_name)
+    # Values emptied because they do not fit the type of the schema
+    invalid_values = 0
+    # One packer per shard, each shard commits its own journal checkpoints
+    shard_count = len(domain_names)
+    packers = [BatchPacker(duplicate_keys) for _ in domain_names]
+    # {(file_path, start, shard): sequence number of the next batch}
+    range_seq = {}
+    # Interned once, shared as keys by all the items of the work unit
+    attributes = tuple(intern(a) for a in column_header.split(column_delimiter))
+    readers = dict((file_path, LinesReader(file_path, index))
+                   for file_path, index in indexes.items())
     print("pid: %s\t%s\t%s" % (os.getpid(), str(datetime.datetime.now()),
                                "Started"))
-    with open(file_path, "r") as file_handler:
-        for line in file_chunker(file_handler, chunk_count, chunk_index):
-            line = line.strip()
-            item = dict(zip(attributes, line.split(column_delimiter)))
+    for file_path, start, end, offset in file_ranges:
+        for shard in range(shard_count):
+            range_seq[(file_path, start, shard)] = 0
+        metrics.count("bytes_parsed", end - offset)
+        line_end = None
+        item_name_of = line_item_names(file_path)
+        items = decode_file_range(file_path, offset, end, attributes,
+                                  column_delimiter, csv_quoting,
+                                  readers.get(file_path))
+        for item, line_end in items:
+            if rollup is not None:
+                rollup.add(item)
+            if schema is not None:
+                invalid_values += schema.encode_item(item)
+            else:
+                for name in TIMESTAMP_COLUMNS:
+                    if name in item:
+                        item[name] = normalize_separator(item[name])
             if key_column:
                 item_name = item[key_column]
             else:
-                item_name = uuid.uuid4()
-            items_batch[item_name] = dict(zip(attributes,
-                                              line.split(column_delimiter)))
-            if len(items_batch) == SIMPLE_DB_BATCH_LIMIT:
-                item_counter += len(items_batch)
-                if show_progress and item_counter % 100000 < SIMPLE_DB_BATCH_LIMIT:
-                    print("pid: %s\t%s\t%s" %
-                          (os.getpid(), str(datetime.datetime.now()),
-                           item_counter))
-                item_domain.batch_put_attributes(items_batch, replace=True)
-                items_batch = {}
-        # Put the last batch
-        if items_batch:
-            item_domain.batch_put_attributes(items_batch, replace=True)
-            if show_progress:
-                item_counter += len(items_batch)
-                print("pid: %s\t%s\t%s == Done!" %
-                      (os.getpid(), str(datetime.datetime.now()), item_counter))
-
-    return item_counter
+                item_name = item_name_of(line_end)
+            shard = shard_index(item[shard_key] if shard_key else item_name,
+                                shard_count)
+            for items_batch, checkpoints in packers[shard].add(
+                    item_name, item, ((file_path, start, shard), line_end)):
+                queue_wait += _queue_batch(domain_names[shard], items_batch,
+                                           checkpoints, range_seq, metrics)
+            item_counter += 1
+        if line_end is not None:
+            # The whole range is done once every shard commits its last line
+            for shard, packer in enumerate(packers):
+                packer.add_checkpoint((file_path, start, shard), line_end)
+    # Put the last batch
+    for shard, packer in enumerate(packers):
+        for items_batch, checkpoints in packer.flush():
+            queue_wait += _queue_batch(domain_names[shard], items_batch,
+                                       checkpoints, range_seq, metrics)
+    if show_progress:
+        print("pid: %s\t%s\t%s == Done!" %
+              (os.getpid(), str(datetime.datetime.now()), item_counter))
+
+    metrics.count("work_units")
+    metrics.count("items_parsed", item_counter)
+    metrics.count("items_rejected", sum(p.rejected for p in packers))
+    metrics.count("values_invalid", invalid_values)
+    # Time waiting on the senders is not parsing
+    metrics.observe("parse_seconds", time.time() - started - queue_wait)
+    return ("parser-%s" % os.getpid(), item_counter, metrics.to_dict(),
+            rollup.cells if rollup is not None else None)
+
+
+def line_item_names(file_path):
+    """Item names of the lines of a file uploaded without a key_column, the
+    same every time a line is read so a resumed or repeated upload replaces
+    the item instead of adding a copy of it.  The name of a line is
+    uuid.uuid5 of its line_end in the namespace of the absolute file path,
+    formatted from a copy of the hash of the namespace.
+    @param: file_path - the file of the lines
+    @return: a function of the line_end of a line, see decode_range,
+             returning its item name
+    """
+    namespace = uuid.uuid5(uuid.NAMESPACE_URL, os.path.abspath(file_path))
+    namespace_sha = hashlib.sha1(namespace.bytes)
+
+    def item_name(line_end):
+        sha = namespace_sha.copy()
+        sha.update(str(line_end))
+        digest = sha.hexdigest()
+        # Version 5 and the RFC 4122 variant, as uuid.UUID sets them
+        return "%s-%s-5%s-%s%s-%s" % (digest[:8], digest[8:12], digest[13:16],
+                                      "89ab"[int(digest[16], 16) & 3],
+                                      digest[17:20], digest[20:32])
+    return item_name
+
+
+def _queue_batch(domain_name, items_batch, checkpoints, range_seq, metrics):
+    """Queue a batch for the senders along with the journal checkpoints it
+    commits, numbered per range so the journal can commit them in order.
+    @param: domain_name - name of the SimpleDB domain
+    @param: items_batch - {item_name: attributes}
+    @param: checkpoints - {(file_path, start, shard): byte offset} of the
+            batch
+    @param: range_seq - {(file_path, start, shard): next sequence number},
+            updated
+    @param: metrics - the WorkerMetrics of the parser
+    @return: seconds waited for room in the queue
+    """
+    sequenced_checkpoints = {}
+    for range_key, offset in checkpoints.items():
+        sequenced_checkpoints[range_key] = (range_seq[range_key], offset)
+        range_seq[range_key] += 1
+    started = time.time()
+    _batch_queue.put((domain_name, items_batch, sequenced_checkpoints))
+    waited = time.time() - started
+    metrics.count("batches_queued")
+    metrics.observe("queue_wait_seconds", waited)
+    return waited
+
+
+class UploadJournal(object):
+    """Local journal of the byte offset of the last committed batch of each
+    work unit range, so an interrupted upload can resume from its
+    checkpoints instead of restarting every file.
+
+    The journal is a JSON lines file of two kinds of records:
+        {"file": path, "size": byte_count, "mtime": mtime}
+        {"file": path, "start": range_start, "shard": shard,
+         "offset": committed_offset}
+    A file record whose size or mtime differ from the file on disk
+    invalidates the checkpoints of that file.  Ranges are identified by
+    their start, so resume with the same work_unit_size and shard_count.
+    Each shard commits independently, a range resumes from the checkpoint
+    of its least advanced shard.
+    """
+
+    def __init__(self, journal_file, resume=False, shard_count=1):
+        """
+        @param: journal_file - path to the journal file
+        @param: resume - set to True to load the existing journal, otherwise
+                the journal is truncated
+        @param: shard_count - the number of shards of the domain
+        """
+        self.journal_file = journal_file
+        self.shard_count = shard_count
+        self.lock = threading.Lock()
+        # {file path: {"size": ..., "mtime": ...,
+        #              "ranges": {(start, shard): offset}}}
+        self.files = {}
+        # {(file_path, start, shard): next sequence number to commit}
+        self._next_seq = {}
+        # {(file_path, start, shard): {sequence number: offset}} completed
+        # ahead of an earlier batch
+        self._completed = {}
+        if resume and os.path.isfile(journal_file):
+            self._load()
+        self._journal_handler = open(journal_file, "a" if resume else "w")
+
+    def _load(self):
+        with open(self.journal_file, "r") as journal_handler:
+            for line in journal_handler:
+                try:
+                    record = json.loads(line)
+                except exceptions.ValueError:
+                    # A torn last line from an interrupted run
+                    continue
+                if "size" in record:
+                    self.files[record["file"]] = {"size": record["size"],
+                                                  "mtime": record["mtime"],
+                                                  "ranges": {}}
+                elif record["file"] in self.files:
+                    ranges = self.files[record["file"]]["ranges"]
+                    key = (record["start"], record.get("shard", 0))
+                    ranges[key] = max(record["offset"], ranges.get(key, 0))
+
+    def _write(self, record):
+        self._journal_handler.write(json.dumps(record) + "\n")
+        self._journal_handler.flush()
+
+    def pending_ranges(self, file_ranges):
+        """Drop the committed part of each range
+        @param: file_ranges - a list of (file_path, start, end) byte ranges
+        @return: a list of (file_path, start, end, offset) where offset is
+                 where to restart reading the range
+        """
+        pending = []
+        with self.lock:
+            for file_path, start, end in file_ranges:
+                f_stat = os.stat(file_path)
+                journaled = self.files.get(file_path)
+                if (not journaled or journaled["size"] != f_stat.st_size or
+                        journaled["mtime"] != f_stat.st_mtime):
+                    journaled = {"size": f_stat.st_size,
+                                 "mtime": f_stat.st_mtime, "ranges": {}}
+                    self.files[file_path] = journaled
+                    self._write({"file": file_path, "size": f_stat.st_size,
+                                 "mtime": f_stat.st_mtime})
+                offset = min(journaled["ranges"].get((start, shard), start)
+                             for shard in range(self.shard_count))
+                for shard in range(self.shard_count):
+                    self._next_seq[(file_path, start, shard)] = 0
+                    self._completed[(file_path, start, shard)] = {}
+                if offset < end:
+                    pending.append((file_path, start, end, offset))
+        return pending
+
+    def commit(self, checkpoints):
+        """Record the checkpoints of a successfully sent batch.  A range only
+        advances once all the earlier batches of the range are committed.
+        @param: checkpoints - {(file_path, start, shard):
+                               (sequence number, offset)}
+        """
+        with self.lock:
+            for range_key, (seq, offset) in checkpoints.items():
+                completed = self._completed[range_key]
+                completed[seq] = offset
+                next_seq = self._next_seq[range_key]
+                committed = None
+                while next_seq in completed:
+                    committed = completed.pop(next_seq)
+                    next_seq += 1
+                self._next_seq[range_key] = next_seq
+                if committed is not None:
+                    file_path, start, shard = range_key
+                    self.files[file_path]["ranges"][(start, shard)] = committed
+                    self._write({"file": file_path, "start": start,
+                                 "shard": shard,
+                                 "offset": committed})
+
+    def close(self):
+        self._journal_handler.close()
+
+
+def file_fingerprints(file_path, offsets):
+    """SHA-1 of the first offset bytes of a file, for each of the offsets.
+    Every byte up to the offset is hashed, so a rewrite anywhere before it
+    changes the fingerprint, and the file is read once up to the largest
+    offset whatever the number of offsets.
+    @param: offsets - a list of byte offsets, at most the file size
+    @return: list of the hex digests, in the order of offsets
+    """
+    sha = hashlib.sha1()
+    digests = {}
+    position = 0
+    with open(file_path, "rb") as file_handler:
+        for offset in sorted(set(offsets)):
+            while position < offset:
+                data = file_handler.read(min(FINGERPRINT_BLOCK_SIZE,
+                                             offset - position))
+                if not data:
+                    break
+                sha.update(data)
+                position += len(data)
+            digests[offset] = sha.copy().hexdigest()
+    return [digests[offset] for offset in offsets]
+
+
+def complete_lines_end(file_path, size):
+    """Byte offset past the last new line within the first size bytes of a
+    file, the end of its complete lines
+    """
+    with open(file_path, "rb") as file_handler:
+        end = size
+        while end > 0:
+            start = max(0, end - LINE_COUNT_BLOCK_SIZE)
+            file_handler.seek(start)
+            position = file_handler.read(end - start).rfind(b"\n")
+            if position >= 0:
+                return start + position + 1
+            end = start
+    return 0
+
+
+class UploadManifest(object):
+    """Size, mtime, fingerprint and uploaded offset of each file uploaded to
+    a domain, so a delta upload only sends the new files and the lines
+    appended to the others.
+
+    A file is planned as
+        new         not in the manifest, uploaded in full
+        unchanged   same size and mtime, skipped
+        appended    its fingerprint, the SHA-1 of every byte up to the
+                    uploaded offset, still matches, only the lines past the
+                    offset are uploaded
+        rewritten   anything else, uploaded in full again
+    Only complete lines are uploaded, a last line without a new line may
+    still be written to and is left for the next run.  The manifest is a
+    JSON file of {absolute file path: {"size", "mtime", "fingerprint",
+    "offset", "raw_offset"}}, saved by commit once the whole upload
+    succeeded.  The offset of a compressed file is in uncompressed bytes and
+    its fingerprint is of the raw_offset compressed bytes, so gzip members
+    or bzip2 streams appended to it upload as appended.
+    """
+
+    def __init__(self, manifest_file):
+        self.manifest_file = manifest_file
+        self.files = {}
+        # The records of the files planned by this upload
+        self._planned = {}
+        if os.path.isfile(manifest_file):
+            try:
+                with open(manifest_file, "r") as manifest_handler:
+                    self.files = json.load(manifest_handler)
+            except exceptions.ValueError:
+                # A corrupted manifest only costs a full upload
+                self.files = {}
+
+    def plan(self, file_path):
+        """The byte span of a file to upload
+        @param: file_path - the file to upload
+        @return: (start, end, change), the span [start, end) and "new",
+                 "unchanged", "appended" or "rewritten", see UploadManifest.
+                 Nothing to upload when start == end.
+        """
+        key = os.path.abspath(file_path)
+        f_stat = os.stat(file_path)
+        record = self.files.get(key)
+        if (record and record["size"] == f_stat.st_size and
+                record["mtime"] == f_stat.st_mtime):
+            return record["offset"], record["offset"], "unchanged"
+        if compression(file_path):
+            end = file_index(file_path).complete_end
+            raw_end = f_stat.st_size
+        else:
+            end = raw_end = complete_lines_end(file_path, f_stat.st_size)
+        start, change = 0, "new"
+        if record:
+            offset = record["offset"]
+            raw_offset = record["raw_offset"]
+            if offset <= end and raw_offset <= raw_end:
+                # The uploaded part and the whole part in one read
+                fingerprint, new_fingerprint = file_fingerprints(
+                    file_path, [raw_offset, raw_end])
+            else:
+                fingerprint = None
+                new_fingerprint, = file_fingerprints(file_path, [raw_end])
+            if fingerprint == record["fingerprint"]:
+                start, change = offset, "appended"
+            else:
+                change = "rewritten"
+        else:
+            new_fingerprint, = file_fingerprints(file_path, [raw_end])
+        self._planned[key] = {"size": f_stat.st_size, "mtime": f_stat.st_mtime,
+                              "fingerprint": new_fingerprint,
+                              "offset": end, "raw_offset": raw_end}
+        return start, end, change
+
+    def commit(self):
+        """Record the planned files as uploaded and save the manifest"""
+        self.files.update(self._planned)
+        self._planned = {}
+        tmp_file = "%s.%s.tmp" % (self.manifest_file, os.getpid())
+        with open(tmp_file, "w") as manifest_handler:
+            json.dump(self.files, manifest_handler)
+        os.rename(tmp_file, self.manifest_file)
+
+
+class _SenderErrors(object):
+    """Failed batches of all the sender threads"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.errors = []
+
+    def failed(self, domain_name, items_batch, error):
+        with self.lock:
+            self.errors.append((domain_name, sorted(items_batch), error))
+
+
+def _send_batches(connection_factory, batch_queue, throttle, sender_errors,
+                  journal, metrics):
+    """Sender thread loop.  Each sender owns its own connection, and with it
+    its own HTTP connection pool, and sends the queued batches until it
+    receives None.
+    @param: connection_factory - a callable returning a new boto.sdb connection
+    @param: batch_queue - queue of (domain_name, items_batch, checkpoints)
+            from the parsers
+    @param: throttle - the AdaptiveThrottle capping the concurrent requests
+            and retrying the throttled ones
+    @param: sender_errors - the _SenderErrors to record the failed batches
+    @param: journal - the UploadJournal to commit the sent batches to
+    @param: metrics - the WorkerMetrics of this sender
+    """
+    sdb_conn = connection_factory()
+    # {domain name: Domain}.  Given a name, boto validates the domain with a
+    # select before every request, so each domain is looked up once here.
+    domains = {}
+
+    def batch_put(domain_name, items_batch):
+        # One attempt, the throttle may call it again
+        started = time.time()
+        try:
+            domain = domains.get(domain_name)
+            if domain is None:
+                domain = sdb_conn.get_domain(domain_name, validate=False)
+                domains[domain_name] = domain
+            return domain.batch_put_attributes(items_batch, replace=True)
+        except Exception as e:
+            if is_throttling_error(e):
+                metrics.count("throttled")
+            raise
+        finally:
+            metrics.count("requests")
+            metrics.observe("request_seconds", time.time() - started)
+
+    while True:
+        task = batch_queue.get()
+        if task is None:
+            break
+        domain_name, items_batch, checkpoints = task
+        if not items_batch:
+            # Only the last checkpoints of a shard, nothing to send
+            journal.commit(checkpoints)
+            continue
+        started = time.time()
+        requests_before = metrics.counters.get("requests", 0)
+        try:
+            throttle.call(batch_put, domain_name, items_batch)
+        except Exception as e:
+            # Keep draining the queue, otherwise the parsers block forever
+            sender_errors.failed(domain_name, items_batch, e)
+            metrics.count("batches_failed")
+        else:
+            journal.commit(checkpoints)
+            metrics.count("batches_sent")
+            metrics.count("items_sent", len(items_batch))
+            metrics.observe("batch_seconds", time.time() - started)
+        metrics.count("retries",
+                      metrics.counters["requests"] - requests_before - 1)
+
+
+def _queue_rollup(rollup, domain_name, batch_queue, duplicate_keys):
+    """Queue the items of a merged rollup for the senders
+    @param: rollup - the LoopRollup of the upload
+    @param: domain_name - name of the rollup domain
+    @param: batch_queue - the queue of the senders
+    @param: duplicate_keys - see BatchPacker
+    """
+    packer = BatchPacker(duplicate_keys)
+    for item_name, attributes in rollup.items():
+        for items_batch, _ in packer.add(item_name, attributes):
+            batch_queue.put((domain_name, items_batch, {}))
+    for items_batch, _ in packer.flush():
+        batch_queue.put((domain_name, items_batch, {}))
+
+
+def _default_connection_factory(sdb_conn):
+    """Make new connections to the same region with the same credentials"""
+    region_name = sdb_conn.region.name
+    aws_access_key_id = sdb_conn.aws_access_key_id
+    aws_secret_access_key = sdb_conn.aws_secret_access_key
+
+    def connection_factory():
+        return boto.sdb.connect_to_region(
+            region_name, aws_access_key_id=aws_access_key_id,
+            aws_secret_access_key=aws_secret_access_key)
+    return connection_factory
 
 
 def file_chunker(file_handler, chunk_count, chunk_index):
@@ -101,7 +808,7 @@ def file_chunker(file_handler, chunk_count, chunk_index):
     """
     if 1 > chunk_count:
         raise exceptions.ValueError("Chunk count must be > 0 ")
-    if chunk_index > chunk_count:
+    if chunk_index >= chunk_count:
         raise exceptions.IndexError("Chunk index out of bound")
     # seek to the end of file
     file_handler.seek(0, 2)
@@ -110,16 +817,30 @@ def file_chunker(file_handler, chunk_count, chunk_index):
     chunk_size = max(1, file_size // chunk_count)
     chunk_start = chunk_index * chunk_size
     chunk_end = chunk_start + chunk_size
+    if chunk_index == chunk_count - 1:
+        # The last chunk takes the remainder of the division
+        chunk_end = file_size
+    return file_range_lines(file_handler, chunk_start, chunk_end)
+
 
-    # Set the file position at the start of the first line in the chunk
-    if chunk_start == 0:
+def file_range_lines(file_handler, start, end):
+    """Access the lines of a byte range of a file.  A line belongs to the
+    range it starts in, so adjacent ranges never share or drop a line.
+    @param: file_handler - the file object
+    @param: start - byte offset of the range, inclusive
+    @param: end - byte offset of the range, exclusive
+
+    @yield: stripped lines starting within [start, end)
+    """
+    # Set the file position at the start of the first line in the range
+    if start == 0:
         file_handler.seek(0)
     else:
-        file_handler.seek(chunk_start - 1)
+        file_handler.seek(start - 1)
         file_handler.readline()
 
-    # Start yielding line within the chunk identified by the chunk index
-    while file_handler.tell() < chunk_end:
+    # Start yielding line within the range
+    while file_handler.tell() < end:
         line = file_handler.readline()
         if not line:
             # End of file, readline() include new line character for blank line
@@ -128,20 +849,233 @@ def file_chunker(file_handler, chunk_count, chunk_index):
         yield line.strip()
 
 
+def decode_range(file_handler, start, end, attributes, column_delimiter,
+                 csv_quoting=False):
+    """Decode the lines of a byte range of a file into items.  The range is
+    read from a memory map in one slice and split in bulk, each line is
+    stripped and split once.  Same as file_range_lines, a line belongs to the
+    range it starts in.
+    @param: file_handler - the file object, opened in binary mode
+    @param: start - byte offset of the range, inclusive
+    @param: end - byte offset of the range, exclusive
+    @param: attributes - a tuple of the attribute names of the columns
+    @param: column_delimiter - a delimiter of the columns
+    @param: csv_quoting - set to True to parse the lines with the csv module,
+            so quoted fields may contain the delimiter.  Quoted fields
+            spanning lines are not supported.
+
+    @yield: (item, line_end) for each non blank line, where item maps the
+            attributes to the fields and line_end is the byte offset past
+            the line
+    """
+    if os.fstat(file_handler.fileno()).st_size == 0:
+        return
+    buf = mmap.mmap(file_handler.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        if start == 0:
+            first = 0
+        else:
+            # Skip the partial line, owned by the previous range
+            first = buf.find(b"\n", start - 1) + 1
+            if first == 0:
+                return
+        if first >= end:
+            return
+        # Read up to the end of the last line starting within the range
+        stop = buf.find(b"\n", end - 1) + 1 or len(buf)
+        block = buf[first:stop]
+    finally:
+        buf.close()
+    for decoded in _decode_lines(block, first, attributes, column_delimiter,
+                                 csv_quoting):
+        yield decoded
+
+
+def decode_file_range(file_path, start, end, attributes, column_delimiter,
+                      csv_quoting=False, reader=None):
+    """decode_range of a file by its path
+    @param: reader - the compressed_input.LinesReader of a compressed file,
+            start and end are then uncompressed byte offsets.  None for a
+            plain file.
+    @yield: (item, line_end), see decode_range
+    """
+    if reader is not None:
+        first, block = reader.read(start, end)
+        for decoded in _decode_lines(block, first, attributes,
+                                     column_delimiter, csv_quoting):
+            yield decoded
+        return
+    with open(file_path, "rb") as file_handler:
+        for decoded in decode_range(file_handler, start, end, attributes,
+                                    column_delimiter, csv_quoting):
+            yield decoded
+
+
+def _decode_lines(block, first, attributes, column_delimiter, csv_quoting):
+    """Decode the lines of a block read from byte offset first, see
+    decode_range
+    """
+    stop = first + len(block)
+    lines = block.split(b"\n")
+    if not lines[-1]:
+        # Nothing after the last new line
+        lines.pop()
+    if csv_quoting:
+        position = [first]
+
+        def tracked_lines():
+            for line in lines:
+                position[0] += len(line) + 1
+                yield line.rstrip(b"\r")
+        for fields in csv.reader(tracked_lines(), delimiter=column_delimiter):
+            if fields:
+                yield dict(zip(attributes, fields)), min(position[0], stop)
+    else:
+        line_end = first
+        for line in lines:
+            line_end += len(line) + 1
+            line = line.strip()
+            if line:
+                yield (dict(zip(attributes, line.split(column_delimiter))),
+                       min(line_end, stop))
+
+
 def get_item_count(sdb_domain, consistent_read=False):
     """SELECT COUNT(*) FROM sdb_domain
     @param: sdb_domain - an SDB domain object to query the SELECT COUNT(*)
     @consistent_read - set to true for consistent read, default to False
     """
     select_count_query = ("""SELECT COUNT(*) FROM `%s` """ % sdb_domain.name)
-    select_count = list(sdb_domain.select(select_count_query,
-                                          consistent_read=consistent_read))
+    select_count = list(throttled_select(sdb_domain, select_count_query,
+                                         consistent_read=consistent_read))
     return sum([int(c["Count"]) for c in select_count])
 
 
+def _work_units(files, file_stats, unit_size, telemetry, manifest=None):
+    """Break all the files into byte-balanced work units.  Files larger
+    than unit_size are split into ranges of unit_size bytes, smaller ones
+    are packed together, so every unit costs about the same to parse
+    regardless of how skewed the file sizes are.
+    Compressed files are split in uncompressed bytes into runs at their
+    seek points, see compressed_input.CompressedIndex.ranges, and the
+    ranges of a run go in the same unit to be read with one decompression.
+    @param: files - an iterable of file paths, e.g. from iter_files
+    @param: file_stats - {file path: (line_count, byte_count)} of every file,
+            see get_files_line_count.  With a manifest those of the planned
+            spans are recorded to it instead.
+    @param: unit_size - target number of bytes per work unit
+    @param: telemetry - the Telemetry to add the totals of each file to
+    @param: manifest - the UploadManifest of a delta upload, only the span
+            it plans for each file is uploaded.  None for whole files.
+    @yield: non-empty lists of (file_path, start, end) byte ranges
+    """
+    pending_ranges = []
+    pending_bytes = 0
+    for current_file in files:
+        if manifest is None:
+            first, last = 0, file_stats[current_file][1]
+            change = ""
+        else:
+            first, last, change = manifest.plan(current_file)
+            if first >= last:
+                print("Skipped '%s', %s" % (current_file, change))
+                continue
+            file_stats[current_file] = (
+                count_range_lines(current_file, first, last), last - first)
+            change = ", %s from byte %s" % (change, first)
+        line_count, byte_count = file_stats[current_file]
+        telemetry.add_totals(line_count, byte_count)
+        print("Queued '%s' (%s lines, %s bytes%s)" %
+              (current_file, line_count, byte_count, change))
+        if compression(current_file):
+            runs = file_index(current_file).ranges(first, last, unit_size)
+        else:
+            runs = [[(start, min(start + unit_size, last))]
+                    for start in range(first, last, unit_size)]
+        for run in runs:
+            for start, end in run:
+                pending_ranges.append((current_file, start, end))
+                pending_bytes += end - start
+            if pending_bytes >= unit_size:
+                yield pending_ranges
+                pending_ranges = []
+                pending_bytes = 0
+    if pending_ranges:
+        yield pending_ranges
+
+
+def _sdb_batch_put_tasks(files, file_stats, unit_size, journal, telemetry,
+                         manifest, domain_names, column_header, key_column,
+                         column_delimiter, duplicate_keys, csv_quoting,
+                         shard_key, rollup, schema):
+    """Generate the sdb_batch_put args for each work unit of all files.
+    Consumed by the pool's task handler thread, so the delta planning of the
+    next file overlaps with the upload of the current one.  Idle parsers
+    take the next unit from the pool's shared task queue, which keeps every
+    parser busy until the last unit.
+    @param: files - an iterable of file paths, e.g. from iter_files
+    @param: file_stats - see _work_units
+    @param: unit_size - target number of bytes per work unit
+    @param: journal - the UploadJournal to skip the committed ranges
+    @param: telemetry - the Telemetry of the upload
+    @param: manifest - the UploadManifest of a delta upload, None otherwise
+    @param: rollup - the LoopRollup of the upload, each task gets an empty
+            partial of it, None for no rollup
+    Other params are passed through to sdb_batch_put
+    """
+    for file_ranges in _work_units(files, file_stats, unit_size, telemetry,
+                                   manifest):
+        file_ranges = journal.pending_ranges(file_ranges)
+        if file_ranges:
+            indexes = dict((file_path, file_index(file_path))
+                           for file_path, _, _, _ in file_ranges
+                           if compression(file_path))
+            yield (file_ranges, domain_names, column_header, key_column,
+                   column_delimiter, True, duplicate_keys, csv_quoting,
+                   shard_key, rollup.partial() if rollup is not None else None,
+                   schema, indexes)
+
+
+def _get_destination_domain(sdb_conn, domain_name, reuse_domain, throttle):
+    """Get the domain to upload to, creating it if it does not exist
+    @param: sdb_conn - A Boto.sdb connection object
+    @param: domain_name - The domain name
+    @param: reuse_domain - Set to true to use an existing domain
+    @param: throttle - the AdaptiveThrottle to send the requests through
+    @return: (domain, True if the domain was created)
+    """
+    try:
+        # The domain exists, use it
+        destination_domain = throttle.call(sdb_conn.get_domain, domain_name)
+        if not reuse_domain:
+            raise exceptions.RuntimeError("Domain '%s' already exists and "
+                                          "'reuse_domain' is set to %s.  Be "
+                                          "careful when uploading data to an "
+                                          "existing domain as the new data may "
+                                          "pollute the existing data int the "
+                                          "domain."
+                                          % (domain_name, reuse_domain))
+        print("Selected existing domain '%s'" % domain_name)
+        return destination_domain, False
+    except boto.exception.SDBResponseError:
+        # The domain does not exist, create it
+        destination_domain = throttle.call(sdb_conn.create_domain,
+                                           domain_name)
+        print("Created new domain '%s'" % domain_name)
+        return destination_domain, True
+
+
 def upload_to_simpleDB(sdb_conn, domain_name, input_dir, column_header,
                        key_column=None, column_delimiter=",", recursive=False,
-                       ext_filter=None, reuse_domain=False, worker_count=None):
+                       ext_filter=None, reuse_domain=False, worker_count=None,
+                       file_predicates=None, sender_count=SENDER_COUNT,
+                       max_in_flight=None, connection_factory=None,
+                       work_unit_size=WORK_UNIT_SIZE, resume=False,
+                       journal_file=None, duplicate_keys=DUPLICATE_KEYS_MERGE,
+                       throttle=None, csv_quoting=False, telemetry_file=None,
+                       report_interval=REPORT_INTERVAL, shard_count=1,
+                       shard_key=None, rollup=None, schema=None, delta=False,
+                       manifest_file=None):
     """Upload each line in text files found in input_dir to SimpleDB domain
     @param: sdb_conn - A Boto.sdb connection object
     @param: domain_name - The domain name to upload the data to
@@ -150,111 +1084,373 @@ def upload_to_simpleDB(sdb_conn, domain_name, input_dir, column_header,
             example "col1,col2,col3" where "," is the column_delimiter
     @param: key_column - The column to be used as item key, this should be
             unique or it may result in attribute with more than one value.
-            Default to UUID.uuid.uuid4()
+            Default to a UUID of the file path and line offset, see
+            line_item_names.
     @param: column_delimiter - The delimiter to parse the column_header and each
             line in the data
     @param: recursive - Set to true to recursive search for all file under the
             input_dir
     @param: ext_filter - The file extension to filter in the input_dir.
+            Files ending in .gz or .bz2 are decompressed as they are parsed,
+            still split across the parsers, see compressed_input.
     @param: reuse_domain - Set to true to use an existing domain if one exists.
             Be careful when setting this option to true as it may pollute the
             existing data.  You have been warned!
-    @param: work_count - The number of process to divide each file to run in
-            parallel.  Depend on the number of row in each file, setting this
-            number high to about max out your network speed as SimpleDB send
-            request of 25 items per batch put attributes request.  Default to
-            number of CPU count.
+    @param: work_count - The number of parser processes.  Parsing is CPU
+            bound, the network is left to the senders.  Default to number of
+            CPU count.
+    @param: file_predicates - additional file filters for iter_files, e.g.
+            [size_predicate(min_size=1), glob_predicate("*2011-09*")]
+    @param: sender_count - The number of threads sending the parsed batches,
+            each with its own connection.  SimpleDB round-trip latency, not
+            CPU, limits the upload so this is usually much larger than
+            work_count.
+    @param: max_in_flight - Cap on concurrent batch put attributes requests.
+            The throttle adapts the actual limit below this cap to the
+            throttling responses.  Default to sender_count.
+    @param: connection_factory - A callable returning a new boto.sdb
+            connection for each sender.  Default to connecting to the region
+            of sdb_conn with its credentials.
+    @param: work_unit_size - Target bytes of input parsed per task, see
+            _work_units.
+    @param: resume - Set to true to resume an interrupted upload.  Ranges
+            committed in the journal are skipped and partially committed
+            ranges restart from their last committed batch.  Implies
+            reuse_domain.  The lines after the last committed batch of a
+            range are put again, they replace their items as long as the
+            item names are the same every run: a unique key_column, or no
+            key_column and the files at the same paths.
+    @param: journal_file - The UploadJournal path.  Default to
+            UPLOAD_JOURNAL_FILE of the domain name.
+    @param: duplicate_keys - DUPLICATE_KEYS_MERGE to merge rows repeating a
+            key_column value within a batch, the later values winning, or
+            DUPLICATE_KEYS_SPILL to put the repeated row in the next batch.
+    @param: throttle - A sdb_throttle.AdaptiveThrottle to share with other
+            clients of the same endpoint.  Default to a new throttle capped
+            at max_in_flight.
+    @param: csv_quoting - Set to true to parse the lines as CSV, so quoted
+            fields may contain the column_delimiter.
+    @param: telemetry_file - Path of a JSON lines file to append the
+            sdb_telemetry snapshots of the upload to.
+    @param: report_interval - Seconds between two progress reports.
+    @param: shard_count - The number of domains to spread the items across,
+            named by sdb_shards.shard_domain_names.  Query them with
+            sdb_shards.ShardedDomain.
+    @param: shard_key - The column to hash to pick the shard of an item,
+            e.g. "detectorid" to keep the readings of a detector together.
+            Default to the item name.
+    @param: rollup - A loop_rollup.LoopRollup to add up the speeds of each
+            detector by bucket while parsing.  Its items are put in the
+            rollup.domain_name(domain_name) domain once every line is
+            parsed.  Not with resume, the ranges committed by an earlier run
+            would be missing from the totals.
+    @param: schema - A sdb_schema.Schema to encode the values with, e.g.
+            sdb_schema.LOOP_SCHEMA, so their strings sort like the values and
+            range predicates run on the server.  Values that do not fit
+            their type are uploaded empty.  Without a schema only the
+            TIMESTAMP_COLUMNS change, a space between their date and time
+            becomes a "T".
+    @param: delta - Set to true to upload only the files new since the last
+            delta upload and the lines appended to the others, see
+            UploadManifest.  Rewritten files are uploaded again in full.
+            Without a key_column items are named by line offset, so the items
+            of old lines past the new end of a rewritten file stay, use a
+            key_column.  Implies reuse_domain.
+    @param: manifest_file - The UploadManifest path.  Default to
+            UPLOAD_MANIFEST_FILE of the domain name.
     """
-    files = get_all_files(input_dir, recursive=recursive, ext_filter=ext_filter)
-    total_lines = get_line_count(input_dir, recursive=recursive,
-                                 ext_filter=ext_filter)
-    file_count = len(files)
-    print("-" * 20)
-    print("Found %s file%s" % (file_count, "s" if file_count > 1 else ""))
-    for f in files:
-        print("\t%s" % f)
-    print("-" * 20)
-    print("Total of %s line%s" % (total_lines, "s" if total_lines > 1 else ""))
-    print("-" * 20)
-
-    if file_count == 0:
+    if rollup is not None and (resume or delta):
+        raise exceptions.ValueError("A rollup needs every line in one run, "
+                                    "it cannot resume or upload a delta")
+    reuse_domain = reuse_domain or delta
+    predicates = list(file_predicates or [])
+    if ext_filter:
+        predicates.insert(0, ext_predicate(ext_filter))
+    files = list(iter_files(input_dir, recursive=recursive,
+                            predicates=predicates))
+    if not files:
+        print("Found no file to upload in '%s'" % input_dir)
         # Nothing to do
         return
-    try:
-        # The domain exists, use it
-        destination_domain = sdb_conn.get_domain(domain_name)
-        if not reuse_domain:
-            raise exceptions.RuntimeError("Domain '%s' already exists and "
-                                          "'reuse_domain' is set to %s.  Be "
-                                          "careful when uploading data to an "
-                                          "existing domain as the new data may "
-                                          "pollute the existing data int the "
-                                          "domain."
-                                          % (domain_name, reuse_domain))
-        print("Selected existing domain '%s'" % domain_name)
-    except boto.exception.SDBResponseError:
-        # The domain does not exist, create it
-        destination_domain = sdb_conn.create_domain(domain_name)
-        print("Created new domain '%s'" % domain_name)
+    if not max_in_flight:
+        max_in_flight = sender_count
+    if not throttle:
+        throttle = AdaptiveThrottle(max_limit=max_in_flight)
+    domain_names = shard_domain_names(domain_name, shard_count)
+    destination_domains = [_get_destination_domain(sdb_conn, name,
+                                                   reuse_domain or resume,
+                                                   throttle)
+                           for name in domain_names]
+    if rollup is not None:
+        rollup_domain_name = rollup.domain_name(domain_name)
+        destination_domains.append(_get_destination_domain(
+            sdb_conn, rollup_domain_name, reuse_domain, throttle))
+    if any(created for _, created in destination_domains):
         # Delay to let the new domain to be consistent
         n = 5
         print("Delaying %s seconds after created new domain" % n)
         time.sleep(n)
+    destination_domains = [d for d, _ in destination_domains]
+    if rollup is not None:
+        # Counted apart from the loop items
+        rollup_domain = destination_domains.pop()
 
-    count_before = get_item_count(destination_domain, consistent_read=True)
+    count_before = sum(get_item_count(d, consistent_read=True)
+                       for d in destination_domains)
 
-    # Divide the file into multiple chunks for concurrent process
+    # Divide all files into work units for concurrent process
     # Normally, the worker pool should line up with the multiprocessing.cpu_count().
     # However, since most of the work will be querying AWS, so it is ok to wait.
     if not worker_count:
         worker_count = multiprocessing.cpu_count()
-    workers = multiprocessing.Pool(worker_count)
+    # All the files at once with as many counters as parsers, a delta upload
+    # counts the lines of the span it plans for each file instead
+    file_stats = (get_files_line_count(files, worker_count, persist=False)
+                  if not delta else {})
+    if not connection_factory:
+        connection_factory = _default_connection_factory(sdb_conn)
+    # Bounded, so parsers wait for the senders instead of filling up memory
+    batch_queue = multiprocessing.Queue(sender_count * BATCH_QUEUE_DEPTH)
+    sender_errors = _SenderErrors()
+    telemetry = Telemetry()
+    journal = UploadJournal(journal_file or UPLOAD_JOURNAL_FILE % domain_name,
+                            resume=resume, shard_count=shard_count)
+    manifest = (UploadManifest(manifest_file or
+                               UPLOAD_MANIFEST_FILE % domain_name)
+                if delta else None)
+    senders = [threading.Thread(target=_send_batches,
+                                args=(connection_factory, batch_queue,
+                                      throttle, sender_errors, journal,
+                                      telemetry.worker("sender-%s" % i)))
+               for i in range(sender_count)]
+    for sender in senders:
+        sender.daemon = True
+        sender.start()
+    workers = multiprocessing.Pool(worker_count, initializer=_init_parser,
+                                   initargs=(batch_queue,))
 
     print("Before upload starts item count: %s" % count_before)
     time_before = datetime.datetime.now()
-    for current_file in files:
-        print("_" * 10)
-        print("Begin upload the content of '%s' to '%s' domain" %
-              (current_file, domain_name))
-        sdb_batch_put_args = zip(
-            worker_count * [current_file],
-            worker_count * [worker_count],
-            [i for i in range(worker_count)],
-            worker_count * [sdb_conn],
-            worker_count * [domain_name],
-            worker_count * [column_header],
-            worker_count * [key_column],
-            worker_count * [column_delimiter],
-            worker_count * [True])
-        workers.map(sdb_batch_put, sdb_batch_put_args)
-        print("-" * 10)
-    count_after = get_item_count(destination_domain, consistent_read=True)
+    reporter = TelemetryReporter(telemetry, telemetry_file, report_interval)
+    reporter.start()
+    sdb_batch_put_args = _sdb_batch_put_tasks(
+        files, file_stats, work_unit_size,
+        journal, telemetry, manifest, domain_names, column_header, key_column,
+        column_delimiter, duplicate_keys, csv_quoting, shard_key, rollup,
+        schema)
+    try:
+        for worker_id, _, metrics_dict, rollup_cells in workers.imap_unordered(
+                sdb_batch_put, sdb_batch_put_args):
+            telemetry.merge_worker(worker_id, metrics_dict)
+            if rollup is not None:
+                rollup.merge(rollup_cells)
+        if rollup is not None:
+            # Every reading is added up, the totals are final
+            _queue_rollup(rollup, rollup_domain_name, batch_queue,
+                          duplicate_keys)
+    finally:
+        workers.close()
+        workers.join()
+        # All batches are queued, let the senders drain the queue and stop
+        for _ in senders:
+            batch_queue.put(None)
+        for sender in senders:
+            sender.join()
+        journal.close()
+        _save_line_count_cache(LINE_COUNT_CACHE_FILE)
+        snapshot = reporter.stop()
+    print("-" * 10)
+    counters = snapshot["total"]["counters"]
+    print("Sent %s items in %s batches with %s senders" %
+          (counters.get("items_sent", 0), counters.get("batches_sent", 0),
+           sender_count))
+    print("%s throttled responses, %s retries, final concurrency limit %s" %
+          (counters.get("throttled", 0), counters.get("retries", 0),
+           int(throttle.limit)))
+    if counters.get("values_invalid"):
+        print("%s values did not fit the schema and were uploaded empty" %
+              counters["values_invalid"])
+    if sender_errors.errors:
+        for failed_domain, item_names, error in sender_errors.errors:
+            print("Failed batch to '%s' %s..%s: %r" %
+                  (failed_domain, item_names[0], item_names[-1], error))
+        raise exceptions.RuntimeError("%s batches failed to upload, rerun "
+                                      "with resume=True to retry them"
+                                      % len(sender_errors.errors))
+    if manifest is not None:
+        manifest.commit()
+    file_count = len(file_stats)
+    total_lines = sum(line_count for line_count, _ in file_stats.values())
+    print("Uploaded %s file%s" % (file_count, "s" if file_count > 1 else ""))
+    for f in sorted(file_stats):
+        print("\t%s\t%s" % (file_stats[f][0], f))
+    print("Total of %s line%s" % (total_lines, "s" if total_lines > 1 else ""))
+    print("-" * 10)
+    count_after = sum(get_item_count(d, consistent_read=True)
+                      for d in destination_domains)
     time_after = datetime.datetime.now()
     print("Before upload starts item count:   %s" % count_before)
     print("After upload completed item count: %s" % count_after)
+    if rollup is not None:
+        print("Rolled up into %s items, %s in '%s'" %
+              (len(rollup.cells),
+               get_item_count(rollup_domain, consistent_read=True),
+               rollup_domain_name))
     print("Upload start:    %s" % str(time_before))
     print("Upload complete: %s" % str(time_after))
     print("-" * 10)
     print("Total upload time %s" % str(time_after - time_before))
 
 
-def get_line_count(root_dir, recursive=True, ext_filter=None):
+def count_file_lines(file_path):
+    """Count the lines of a file by counting new line characters over a
+    memory-mapped buffer, so the file is never loaded into memory.  A
+    compressed file is counted while indexing it, see
+    compressed_input.file_index, its byte_count is the uncompressed size.
+    @param: file_path - path to the file to count
+    @return: a tuple of (file_path, line_count, byte_count)
+    """
+    if compression(file_path):
+        index = file_index(file_path)
+        line_count = index.line_count
+        if index.complete_end < index.uncompressed_size:
+            line_count += 1
+        return file_path, line_count, index.uncompressed_size
+    with open(file_path, "rb") as file_handler:
+        byte_count = os.fstat(file_handler.fileno()).st_size
+        if byte_count == 0:
+            # mmap cannot map an empty file
+            return file_path, 0, 0
+        buf = mmap.mmap(file_handler.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            line_count = 0
+            for offset in range(0, byte_count, LINE_COUNT_BLOCK_SIZE):
+                line_count += buf[offset:offset + LINE_COUNT_BLOCK_SIZE].count(b"\n")
+            # Same as readlines(), the last line may not end with a new line
+            if buf[byte_count - 1:byte_count] != b"\n":
+                line_count += 1
+        finally:
+            buf.close()
+    return file_path, line_count, byte_count
+
+
+def count_range_lines(file_path, start, end):
+    """Count the lines starting within a byte range of a file, the range
+    starting at a line and ending past a new line
+    @param: file_path - path to the file to count
+    @param: start - byte offset of the range, inclusive
+    @param: end - byte offset of the range, exclusive
+    @return: the line count
+    """
+    if start >= end:
+        return 0
+    if compression(file_path):
+        # Only the range is decompressed, from the seek point before it
+        return sum(data.count(b"\n") for data in
+                   iter_range(file_path, file_index(file_path), start, end))
+    with open(file_path, "rb") as file_handler:
+        buf = mmap.mmap(file_handler.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            line_count = 0
+            for offset in range(start, end, LINE_COUNT_BLOCK_SIZE):
+                stop = min(offset + LINE_COUNT_BLOCK_SIZE, end)
+                line_count += buf[offset:stop].count(b"\n")
+        finally:
+            buf.close()
+    return line_count
+
+
+def _load_line_count_cache(cache_file):
+    """Load the line count cache file once per process
+    @param: cache_file - path to the JSON cache file, None to disable
+    """
+    global _line_count_cache
+    if _line_count_cache is None:
+        _line_count_cache = {}
+        if cache_file and os.path.isfile(cache_file):
+            try:
+                with open(cache_file, "r") as cache_handler:
+                    for k, v in json.load(cache_handler).items():
+                        _line_count_cache[k] = tuple(v)
+            except (exceptions.IOError, exceptions.ValueError):
+                # A corrupted cache only costs a recount
+                _line_count_cache = {}
+    return _line_count_cache
+
+
+def _save_line_count_cache(cache_file):
+    """Write the line count cache back to the cache file
+    @param: cache_file - path to the JSON cache file, None to disable
+    """
+    if not cache_file or _line_count_cache is None:
+        return
+    tmp_file = "%s.%s.tmp" % (cache_file, os.getpid())
+    with open(tmp_file, "w") as cache_handler:
+        json.dump(_line_count_cache, cache_handler)
+    os.rename(tmp_file, cache_file)
+
+
+def get_files_line_count(files, worker_count=None,
+                         cache_file=LINE_COUNT_CACHE_FILE, persist=True):
+    """Count the lines of each file in files.  Files unchanged since the last
+    count, by size and modified time, are served from the cache and the rest
+    are counted in parallel.
+    @param: files - a list of file paths
+    @param: worker_count - number of processes to count with.  Default to
+            number of CPU count.
+    @param: cache_file - path to the JSON cache file, None to not persist
+    @param: persist - set to False to defer writing the cache file, see
+            _save_line_count_cache
+    @return: a dict of {file path: (line_count, byte_count)}
+    """
+    cache = _load_line_count_cache(cache_file)
+    file_stats = {}
+    stale = {}
+    for f in files:
+        f_stat = os.stat(f)
+        key = os.path.abspath(f)
+        cached = cache.get(key)
+        if cached and cached[:2] == (f_stat.st_size, f_stat.st_mtime):
+            file_stats[f] = cached[2:]
+        else:
+            stale[f] = (key, f_stat.st_size, f_stat.st_mtime)
+
+    if stale:
+        if not worker_count:
+            worker_count = multiprocessing.cpu_count()
+        worker_count = min(worker_count, len(stale))
+        if worker_count > 1:
+            counters = multiprocessing.Pool(worker_count)
+            try:
+                counts = counters.map(count_file_lines, list(stale), chunksize=1)
+            finally:
+                counters.close()
+                counters.join()
+        else:
+            counts = [count_file_lines(f) for f in stale]
+        for f, line_count, byte_count in counts:
+            key, size, mtime = stale[f]
+            cache[key] = (size, mtime, line_count, byte_count)
+            file_stats[f] = (line_count, byte_count)
+        if persist:
+            _save_line_count_cache(cache_file)
+    return file_stats
+
+
+def get_line_count(root_dir, recursive=True, ext_filter=None, worker_count=None):
     """Count the lines in all files found in under root_dir
     @param: root_dir - directory path to start the search
     @param: recursive - set to True to recursive search
     @param: ext_filter - file to filter based on its extension
+    @param: worker_count - number of processes to count with
     """
-    global files, file_stats, f, f1, line_count, total_lines, k, v
     files = get_all_files(root_dir, recursive=recursive, ext_filter=ext_filter)
-    file_stats = {}
-    for f in files:
-        with open(f, 'r') as f1:
-            line_count = len(f1.readlines())
-            file_stats[f] = line_count
+    file_stats = get_files_line_count(files, worker_count=worker_count)
     total_lines = 0
-    for k, v in file_stats.items():
-        print("%s\t%s" % (v, k))
-        total_lines += v
+    for f in files:
+        line_count = file_stats[f][0]
+        print("%s\t%s" % (line_count, f))
+        total_lines += line_count
     print("Total lines: %s" % total_lines)
     return total_lines
 
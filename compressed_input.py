@@ -0,0 +1,430 @@
+"""Random access to the lines of gzip and bz2 compressed files.
+
+The uploader splits its input into byte ranges parsed in parallel, which a
+compressed file does not allow as is.  A CompressedIndex, built by a single
+streaming pass over the file and cached in COMPRESSED_INDEX_FILE, records
+the seek points of the file: where decompression can start, with the
+uncompressed offset it starts at.
+    gzip    the start of each member.  zlib cannot resume within a member,
+            so a single member file has one seek point and its ranges are
+            read in order by one LinesReader, decompressing the file once.
+            Files of many members, such as bgzip output or concatenated
+            gzip files, have a seek point every member.
+    bz2     the start of each block, about every 900KB of data.  Blocks
+            start at any bit, each is shifted back to a byte boundary and
+            decompressed as a stream of its own.
+Offsets are uncompressed offsets throughout, nothing is decompressed to
+disk.
+"""
+import binascii
+import bisect
+import bz2
+import json
+import os
+import zlib
+
+
+GZIP_SUFFIXES = (".gz", ".gzip")
+BZ2_SUFFIXES = (".bz2",)
+# Indexes are cached by (path, size, mtime) in this file between runs
+COMPRESSED_INDEX_FILE = '.compressed_index.json'
+# Compressed bytes read at a time
+READ_SIZE = 1024 * 1024
+# Keep a gzip seek point at most every this many uncompressed bytes
+SEEK_POINT_SPACING = 1024 * 1024
+# bzip2 block header and end of stream magic numbers, 48 bits each
+_BZ2_BLOCK_MAGIC = 0x314159265359
+_BZ2_EOS_MAGIC = 0x177245385090
+# Stream header of a bzip2 block decompressed on its own, the largest block
+# size so any block fits
+_BZ2_STREAM_HEADER = b"BZh9"
+_BZ2_ERRORS = (IOError, OSError, ValueError, EOFError)
+
+# {absolute file path: CompressedIndex}
+_indexes = None
+
+
+def compression(file_path):
+    """"gzip" or "bz2" by the file suffix, None for a plain file"""
+    lower = file_path.lower()
+    if lower.endswith(GZIP_SUFFIXES):
+        return "gzip"
+    if lower.endswith(BZ2_SUFFIXES):
+        return "bz2"
+    return None
+
+
+class CompressedIndex(object):
+    """Seek points of a compressed file and the totals of its content"""
+
+    def __init__(self, kind, size, mtime, uncompressed_size, line_count,
+                 complete_end, points):
+        """
+        @param: kind - "gzip" or "bz2"
+        @param: size - byte size of the compressed file when indexed
+        @param: mtime - modified time of the compressed file when indexed
+        @param: uncompressed_size - byte size of the content
+        @param: line_count - number of new lines in the content
+        @param: complete_end - offset past the last new line of the content
+        @param: points - the seek points in uncompressed offset order,
+                gzip: [compressed offset, uncompressed offset]
+                bz2: [first bit, end bit, uncompressed offset] of each block
+        """
+        self.kind = kind
+        self.size = size
+        self.mtime = mtime
+        self.uncompressed_size = uncompressed_size
+        self.line_count = line_count
+        self.complete_end = complete_end
+        self.points = points
+        self._offsets = [point[-1] for point in points]
+
+    def to_dict(self):
+        return {"kind": self.kind, "size": self.size, "mtime": self.mtime,
+                "uncompressed_size": self.uncompressed_size,
+                "line_count": self.line_count,
+                "complete_end": self.complete_end, "points": self.points}
+
+    @classmethod
+    def from_dict(cls, d):
+        return cls(d["kind"], d["size"], d["mtime"], d["uncompressed_size"],
+                   d["line_count"], d["complete_end"], d["points"])
+
+    def point_index(self, offset):
+        """Index of the last seek point at or before an uncompressed offset"""
+        return max(0, bisect.bisect_right(self._offsets, offset) - 1)
+
+    def ranges(self, start, end, unit_size):
+        """Split [start, end) into runs starting at seek points, so each run
+        decompresses only its own data.  A run longer than unit_size, a
+        stretch without seek points, is split into ranges of about
+        unit_size to read in order with one LinesReader.
+        @return: list of runs, each a list of (start, end) uncompressed byte
+                 ranges
+        """
+        cuts = [start]
+        for offset in self._offsets:
+            if start < offset < end and offset - cuts[-1] >= unit_size:
+                cuts.append(offset)
+        cuts.append(end)
+        return [[(s, min(s + unit_size, last))
+                 for s in range(first, last, unit_size)]
+                for first, last in zip(cuts, cuts[1:]) if first < last]
+
+
+def _bits(data, bit_offset, count):
+    """The count bits of data from bit_offset as an integer, most
+    significant bit first like bzip2 writes them
+    """
+    first = bit_offset // 8
+    last = (bit_offset + count + 7) // 8
+    value = int(binascii.hexlify(data[first:last]) or b"0", 16)
+    return (value >> (last * 8 - bit_offset - count)) & ((1 << count) - 1)
+
+
+def _magic_patterns(magic):
+    """Byte patterns finding a 48 bit magic at each of the 8 bit shifts
+    @return: list of (shift, byte index of the pattern in the magic, pattern)
+    """
+    patterns = []
+    for shift in range(8):
+        raw = binascii.unhexlify("%014x" % (magic << (8 - shift)))
+        # The bytes wholly covered by the magic
+        first = 1 if shift else 0
+        patterns.append((shift, first, raw[first:6]))
+    return patterns
+
+
+_BZ2_PATTERNS = ((_BZ2_BLOCK_MAGIC, _magic_patterns(_BZ2_BLOCK_MAGIC)),
+                 (_BZ2_EOS_MAGIC, _magic_patterns(_BZ2_EOS_MAGIC)))
+
+
+def _bz2_marks(file_handler):
+    """Bit offsets of the block and end of stream magic numbers of a bzip2
+    file.  A magic may also occur by chance within a block, see
+    _index_bz2.
+    @return: sorted list of (bit offset, is a block start)
+    """
+    marks = set()
+    base = 0
+    tail = b""
+    while True:
+        chunk = file_handler.read(READ_SIZE)
+        buf = tail + chunk
+        for magic, patterns in _BZ2_PATTERNS:
+            for shift, first, pattern in patterns:
+                position = buf.find(pattern)
+                while position >= 0:
+                    bit_offset = (position - first) * 8 + shift
+                    if (bit_offset >= 0 and bit_offset + 48 <= len(buf) * 8 and
+                            _bits(buf, bit_offset, 48) == magic):
+                        marks.add((base * 8 + bit_offset,
+                                   magic == _BZ2_BLOCK_MAGIC))
+                    position = buf.find(pattern, position + 1)
+        if not chunk:
+            break
+        # A magic may straddle two chunks
+        tail = buf[-8:]
+        base += len(buf) - len(tail)
+    return sorted(marks)
+
+
+def _bz2_block(file_handler, first_bit, end_bit):
+    """Decompress the bzip2 block of bits [first_bit, end_bit) as a stream of
+    its own: the block shifted to a byte boundary, between a stream header
+    and an end of stream marker with the block CRC as the stream CRC
+    """
+    file_handler.seek(first_bit // 8)
+    data = file_handler.read((end_bit + 7) // 8 - first_bit // 8)
+    length = end_bit - first_bit
+    block = _bits(data, first_bit % 8, length)
+    # 48 bits of magic then the 32 bits of the block CRC
+    crc = (block >> (length - 80)) & 0xffffffff
+    stream = (((block << 48) | _BZ2_EOS_MAGIC) << 32) | crc
+    padding = -(length + 80) % 8
+    stream_bytes = binascii.unhexlify("%0*x" % ((length + 80 + padding) // 4,
+                                                stream << padding))
+    return bz2.decompress(_BZ2_STREAM_HEADER + stream_bytes)
+
+
+class _Totals(object):
+    """Size, new lines and end of the last complete line of the content"""
+
+    def __init__(self):
+        self.size = 0
+        self.line_count = 0
+        self.complete_end = 0
+
+    def add(self, data):
+        last_line = data.rfind(b"\n")
+        if last_line >= 0:
+            self.line_count += data.count(b"\n")
+            self.complete_end = self.size + last_line + 1
+        self.size += len(data)
+
+
+def _index_bz2(file_path):
+    """@return: (_Totals, points) of a bzip2 file, see CompressedIndex"""
+    totals = _Totals()
+    points = []
+    with open(file_path, "rb") as file_handler:
+        marks = _bz2_marks(file_handler)
+        i = 0
+        while i < len(marks):
+            first_bit, is_block = marks[i]
+            if not is_block:
+                i += 1
+                continue
+            # The block ends at the next mark that decodes, a mark within
+            # the block is a chance match
+            for j in range(i + 1, len(marks)):
+                try:
+                    data = _bz2_block(file_handler, first_bit, marks[j][0])
+                except _BZ2_ERRORS:
+                    continue
+                points.append([first_bit, marks[j][0], totals.size])
+                totals.add(data)
+                i = j
+                break
+            else:
+                # A truncated last block
+                break
+    return totals, points
+
+
+def _index_gzip(file_path):
+    """@return: (_Totals, points) of a gzip file, see CompressedIndex"""
+    totals = _Totals()
+    points = []
+    with open(file_path, "rb") as file_handler:
+        position = 0
+        decompressor = None
+        pending = b""
+        while True:
+            if not pending:
+                pending = file_handler.read(READ_SIZE)
+                if not pending:
+                    break
+            if decompressor is None:
+                # A member starts here
+                if not points or totals.size - points[-1][1] >= SEEK_POINT_SPACING:
+                    points.append([position, totals.size])
+                decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            try:
+                totals.add(decompressor.decompress(pending))
+            except zlib.error:
+                if totals.size:
+                    # Trailing garbage after the last member
+                    break
+                raise
+            unused = decompressor.unused_data
+            position += len(pending) - len(unused)
+            if unused:
+                totals.add(decompressor.flush())
+                decompressor = None
+            pending = unused
+    return totals, points
+
+
+def build_index(file_path):
+    """Index a compressed file in one streaming pass
+    @return: a CompressedIndex
+    """
+    kind = compression(file_path)
+    f_stat = os.stat(file_path)
+    if kind == "bz2":
+        totals, points = _index_bz2(file_path)
+    else:
+        totals, points = _index_gzip(file_path)
+    return CompressedIndex(kind, f_stat.st_size, f_stat.st_mtime, totals.size,
+                           totals.line_count, totals.complete_end, points)
+
+
+def _load_indexes(index_file):
+    indexes = {}
+    if index_file and os.path.isfile(index_file):
+        try:
+            with open(index_file, "r") as index_handler:
+                for key, d in json.load(index_handler).items():
+                    indexes[key] = CompressedIndex.from_dict(d)
+        except (IOError, ValueError, KeyError):
+            # A corrupted cache only costs indexing again
+            indexes = {}
+    return indexes
+
+
+def file_index(file_path, index_file=COMPRESSED_INDEX_FILE):
+    """The index of a compressed file, from the cache unless the file
+    changed since, otherwise built and saved to the cache
+    @param: index_file - path to the JSON cache file, None to not persist
+    """
+    global _indexes
+    if _indexes is None:
+        _indexes = _load_indexes(index_file)
+    key = os.path.abspath(file_path)
+    f_stat = os.stat(file_path)
+    index = _indexes.get(key)
+    if index and (index.size, index.mtime) == (f_stat.st_size, f_stat.st_mtime):
+        return index
+    # Indexed by another process since
+    _indexes.update(_load_indexes(index_file))
+    index = _indexes.get(key)
+    if index and (index.size, index.mtime) == (f_stat.st_size, f_stat.st_mtime):
+        return index
+    index = build_index(file_path)
+    _indexes[key] = index
+    if index_file:
+        tmp_file = "%s.%s.tmp" % (index_file, os.getpid())
+        with open(tmp_file, "w") as index_handler:
+            json.dump(dict((k, i.to_dict()) for k, i in _indexes.items()),
+                      index_handler)
+        os.rename(tmp_file, index_file)
+    return index
+
+
+def iter_uncompressed(file_path, index, start):
+    """Decompress from the last seek point at or before start
+    @yield: (uncompressed offset, data)
+    """
+    point = index.point_index(start)
+    with open(file_path, "rb") as file_handler:
+        if index.kind == "bz2":
+            for first_bit, end_bit, offset in index.points[point:]:
+                yield offset, _bz2_block(file_handler, first_bit, end_bit)
+            return
+        if not index.points:
+            return
+        position, offset = index.points[point]
+        file_handler.seek(position)
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        while True:
+            pending = file_handler.read(READ_SIZE)
+            if not pending:
+                break
+            while pending:
+                try:
+                    data = decompressor.decompress(pending)
+                except zlib.error:
+                    # Trailing garbage after the last member
+                    return
+                if data:
+                    yield offset, data
+                    offset += len(data)
+                pending = decompressor.unused_data
+                if pending:
+                    # The next member
+                    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+
+def iter_range(file_path, index, start, end):
+    """@yield: the uncompressed data of [start, end) in pieces"""
+    for offset, data in iter_uncompressed(file_path, index, start):
+        if offset >= end:
+            break
+        if offset + len(data) > start:
+            yield data[max(0, start - offset):end - offset]
+
+
+class LinesReader(object):
+    """Reads the lines of ranges of a compressed file with one decompression
+    as long as the ranges come in offset order, a range before the data
+    read so far restarts from its seek point
+    """
+
+    def __init__(self, file_path, index):
+        self.file_path = file_path
+        self.index = index
+        self._stream = None
+        # Uncompressed data from self._offset on, read but not yet consumed
+        self._data = b""
+        self._offset = 0
+
+    def read(self, start, end):
+        """The lines starting within the uncompressed range [start, end), same
+        as aws_simpleDB_uploader.decode_range reads them from a plain file
+        @return: (offset of the first line, bytes of the lines)
+        """
+        origin = max(0, start - 1)
+        if self._stream is None or origin < self._offset:
+            self._stream = iter_uncompressed(self.file_path, self.index,
+                                             origin)
+            self._data, self._offset = b"", origin
+        pieces = [self._data[origin - self._offset:]]
+        position = origin + len(pieces[0])
+        # Done once the line running over end - 1 is complete
+        search_from = max(end - 1, origin) - origin
+        while not (position > end - 1 and
+                   pieces[-1].find(b"\n", search_from) >= 0):
+            for offset, data in self._stream:
+                if offset + len(data) > origin:
+                    data = data[max(0, origin - offset):]
+                    break
+            else:
+                break
+            pieces.append(data)
+            search_from = max(end - 1, position) - position
+            position += len(data)
+        buf = b"".join(pieces)
+        # Kept for the next range, which starts at end at the earliest
+        kept = min(max(0, end - 1 - origin), len(buf))
+        self._data, self._offset = buf[kept:], origin + kept
+        if start == 0:
+            first = 0
+        else:
+            # Skip the partial line, owned by the previous range
+            first = buf.find(b"\n") + 1
+            if first == 0:
+                return end, b""
+            first += origin
+        if first >= end:
+            return first, b""
+        stop = buf.find(b"\n", end - 1 - origin) + 1 or len(buf)
+        return first, buf[first - origin:stop]
+
+
+def read_lines_block(file_path, index, start, end):
+    """The lines starting within the uncompressed range [start, end), see
+    LinesReader.read
+    @return: (offset of the first line, bytes of the lines)
+    """
+    return LinesReader(file_path, index).read(start, end)
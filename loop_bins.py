@@ -0,0 +1,208 @@
+"""Grouped time bin reductions of loop readings with NumPy.
+
+The readings of any number of detectors over any time span are reduced in
+one pass: each reading gets a flat (group, bin) index and numpy.bincount sums
+the speeds and counts the readings of every cell.  A group is whatever the
+caller maps the detectors to, a station for the travel times.
+
+A row may also be a rollup of several readings, see loop_rollup: its speed
+is then the sum of their speeds, its "count" column their number and its
+"squares" column the sum of their squared speeds.
+"""
+import numpy
+
+from sdb_schema import to_epoch
+
+
+# Seconds in a bin, 288 bins a day
+BIN_SECONDS = 300
+
+
+def bin_count(start, end, bin_seconds=BIN_SECONDS):
+    """Number of bins covering [start, end)"""
+    span = to_epoch(end) - to_epoch(start)
+    return int(-(-span // bin_seconds))
+
+
+def group_indexes(detector_ids, detector_group):
+    """The group index of each detector, -1 when it is in no group
+    @param: detector_ids - numpy array of detector IDs
+    @param: detector_group - {detector ID: group index}
+    """
+    if not detector_group:
+        return numpy.full(len(detector_ids), -1, numpy.int64)
+    keys = numpy.array(sorted(int(d) for d in detector_group), numpy.int64)
+    values = numpy.array([detector_group[k] for k in
+                          sorted(detector_group, key=int)], numpy.int64)
+    positions = numpy.searchsorted(keys, detector_ids)
+    positions = numpy.minimum(positions, len(keys) - 1)
+    return numpy.where(keys[positions] == detector_ids, values[positions], -1)
+
+
+def reading_counts(readings):
+    """Number of readings behind each row, 1 unless the rows are rollups"""
+    if "count" in readings:
+        return readings["count"]
+    return numpy.ones(len(readings["speed"]), numpy.int64)
+
+
+def binned_speeds(readings, detector_group, group_count, start, end,
+                  bin_seconds=BIN_SECONDS, skip_zero=True):
+    """Sum and count of the speeds of every (group, bin) cell
+    @param: readings - {column name: numpy array}, see loop_cache.COLUMNS,
+            or rollups, see loop_rollup.rollups_from_items
+    @param: detector_group - {detector ID: group index in [0, group_count)}
+    @param: group_count - number of groups
+    @param: start - inclusive start of the first bin, a datetime, starttime
+            string or epoch
+    @param: end - exclusive end of the last bin, same types as start
+    @param: bin_seconds - width of the bins
+    @param: skip_zero - leave the zero speeds out, a stopped detector reads 0
+    @return: (sums, counts), float64 and int64 arrays of shape
+             (group_count, bin_count)
+    """
+    start, end = to_epoch(start), to_epoch(end)
+    bins = bin_count(start, end, bin_seconds)
+    speeds = readings["speed"].astype(numpy.float64)
+    starttimes = readings["starttime"]
+    groups = group_indexes(readings["detectorid"], detector_group)
+    keep = ((groups >= 0) & ~numpy.isnan(speeds) &
+            (starttimes >= start) & (starttimes < end))
+    if skip_zero:
+        keep &= speeds != 0
+    cells = groups[keep] * bins + (starttimes[keep] - start) // bin_seconds
+    size = group_count * bins
+    sums = numpy.bincount(cells, weights=speeds[keep], minlength=size)
+    counts = numpy.bincount(cells, weights=reading_counts(readings)[keep],
+                            minlength=size).astype(numpy.int64)
+    return sums.reshape(group_count, bins), counts.reshape(group_count, bins)
+
+
+def mean_speeds(sums, counts):
+    """Mean speed of every cell, NaN where there is no reading"""
+    with numpy.errstate(invalid="ignore", divide="ignore"):
+        return numpy.where(counts > 0, sums / numpy.maximum(counts, 1),
+                           numpy.nan)
+
+
+def travel_times(means, lengths):
+    """Travel time of every cell, the length of its group over its mean
+    speed, NaN where the mean is missing or zero
+    @param: means - array of shape (group_count, bin_count)
+    @param: lengths - the length of each group, in miles for speeds in mph
+            and travel times in hours
+    """
+    lengths = numpy.asarray(lengths, numpy.float64)[:, numpy.newaxis]
+    with numpy.errstate(invalid="ignore", divide="ignore"):
+        return numpy.where(means > 0, lengths / means, numpy.nan)
+
+
+class SpeedAccumulator(object):
+    """Count, sum and sum of squares of the speeds of every bin of a fixed
+    span, in arrays allocated once.  Readings are folded in chunk by chunk
+    as they are fetched, so the memory is the same for a day or for months
+    of readings, and accumulators of the same span merge by adding up their
+    partials.
+    """
+    __slots__ = ("start", "bin_seconds", "counts", "sums", "squares",
+                 "unsquared")
+
+    def __init__(self, start, end, bin_seconds=BIN_SECONDS):
+        """
+        @param: start - inclusive start of the first bin, a datetime,
+                starttime string or epoch
+        @param: end - exclusive end of the last bin, same types as start
+        @param: bin_seconds - width of the bins
+        """
+        self.start = to_epoch(start)
+        self.bin_seconds = bin_seconds
+        size = bin_count(start, end, bin_seconds)
+        self.counts = numpy.zeros(size, numpy.int64)
+        self.sums = numpy.zeros(size, numpy.float64)
+        self.squares = numpy.zeros(size, numpy.float64)
+        # The bins with rows whose sum of squares is unknown
+        self.unsquared = numpy.zeros(size, bool)
+
+    def add(self, starttimes, speeds, counts=None, squares=None):
+        """Fold a chunk of readings into their bins, the readings outside
+        the span are left out
+        @param: starttimes - numpy array of the starttime in seconds since
+                the epoch
+        @param: speeds - numpy array of the speeds to add up
+        @param: counts - numpy array of the readings behind each speed when
+                the speeds are sums, see reading_counts, None for one each
+        @param: squares - numpy array of the sum of the squared speeds
+                behind each speed.  None for the speeds squared without
+                counts, and for unknown sums of squares with counts: the
+                variances of their bins are then NaN.
+        """
+        speeds = numpy.asarray(speeds, numpy.float64)
+        bins = (numpy.asarray(starttimes) - self.start) // self.bin_seconds
+        keep = (bins >= 0) & (bins < len(self.counts))
+        bins, speeds = bins[keep], speeds[keep]
+        if squares is not None:
+            squares = squares[keep]
+        elif counts is None:
+            squares = speeds * speeds
+        else:
+            self.unsquared[bins] = True
+            squares = numpy.zeros(len(speeds))
+        if counts is not None:
+            counts = counts[keep]
+        size = len(self.counts)
+        self.counts += numpy.bincount(bins, weights=counts,
+                                      minlength=size).astype(numpy.int64)
+        self.sums += numpy.bincount(bins, weights=speeds, minlength=size)
+        self.squares += numpy.bincount(bins, weights=squares, minlength=size)
+
+    def partial(self):
+        """The bins with readings, to send back from a worker instead of the
+        whole span
+        @return: (bins, counts, sums, squares, unsquared), numpy arrays
+        """
+        bins = numpy.flatnonzero(self.counts)
+        return (bins, self.counts[bins], self.sums[bins], self.squares[bins],
+                self.unsquared[bins])
+
+    def merge(self, bins, counts, sums, squares, unsquared):
+        """Add the partial of an accumulator of the same span"""
+        self.counts[bins] += counts
+        self.sums[bins] += sums
+        self.squares[bins] += squares
+        self.unsquared[bins] |= unsquared
+
+    def means(self):
+        return mean_speeds(self.sums, self.counts)
+
+    def variances(self):
+        """Variance of the speeds of every bin, NaN where there is no
+        reading or the rows are rollups without their squares
+        """
+        means = self.means()
+        with numpy.errstate(invalid="ignore", divide="ignore"):
+            variances = numpy.maximum(self.squares / self.counts -
+                                      means * means, 0.0)
+        return numpy.where(self.unsquared, numpy.nan, variances)
+
+
+def pair_travel_times(segment_times):
+    """Travel time between every pair of stations of a chain from the travel
+    time of each station, with prefix sums instead of adding up every pair
+    @param: segment_times - array of shape (..., stations), the travel time
+            of each station of the chain in downstream order
+    @return: array of shape (..., stations, stations), [i, j] the travel
+             time from station i through station j, NaN when j < i or a
+             station in between has no travel time
+    """
+    segment_times = numpy.asarray(segment_times, numpy.float64)
+    missing = numpy.isnan(segment_times)
+    zeros = numpy.zeros(segment_times.shape[:-1] + (1,))
+    times = numpy.concatenate(
+        [zeros, numpy.cumsum(numpy.where(missing, 0, segment_times), -1)], -1)
+    gaps = numpy.concatenate([zeros, numpy.cumsum(missing, -1)], -1)
+    # [i, j] = prefix[j + 1] - prefix[i]
+    pairs = times[..., numpy.newaxis, 1:] - times[..., :-1, numpy.newaxis]
+    pair_gaps = gaps[..., numpy.newaxis, 1:] - gaps[..., :-1, numpy.newaxis]
+    count = segment_times.shape[-1]
+    upstream = numpy.tril(numpy.ones((count, count), bool), -1)
+    return numpy.where((pair_gaps > 0) | upstream, numpy.nan, pairs)
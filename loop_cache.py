@@ -0,0 +1,213 @@
+"""Local memory-mapped columnar cache of the TeamA_Loop readings.
+
+export_loop_cache pulls the loop domain once and stores each attribute as a
+typed NumPy column file:
+    detectorid  int32
+    starttime   int64, seconds since the epoch of the naive starttime
+    speed       float32, NaN when missing
+    status      uint8, MISSING_STATUS when missing
+The rows are sorted by (detectorid, starttime) and detector_index.npy holds
+the row range of each detector, so LoopCache.readings only touches the rows
+of the requested detectors and time window.
+"""
+import datetime
+import json
+import os
+
+import numpy
+
+from sdb_schema import LOOP_SCHEMA, TIMESTAMP_FORMAT, to_epoch
+
+
+COLUMNS = (("detectorid", numpy.int32),
+           ("starttime", numpy.int64),
+           ("speed", numpy.float32),
+           ("status", numpy.uint8))
+MISSING_STATUS = 255
+# Format of the starttime attribute, the first 19 characters are parsed and
+# any time zone suffix is ignored
+STARTTIME_FORMAT = TIMESTAMP_FORMAT
+# Rows fetched from SimpleDB before being appended to the column files
+EXPORT_CHUNK_ROWS = 100000
+CACHE_META_FILE = "cache_meta.json"
+DETECTOR_INDEX_FILE = "detector_index.npy"
+
+
+def empty_readings():
+    return dict((name, numpy.empty(0, dtype)) for name, dtype in COLUMNS)
+
+
+def readings_from_items(items):
+    """Convert SimpleDB loop items into readings columns, decoding the
+    sdb_schema.LOOP_SCHEMA attributes.  Items without a detectorid or a
+    valid starttime are dropped.
+    @param: items - an iterable of dicts with the COLUMNS attributes
+    @return: {column name: numpy array}
+    """
+    columns = dict((name, []) for name, _ in COLUMNS)
+    for item in items:
+        try:
+            detector_id = int(item["detectorid"])
+            starttime = LOOP_SCHEMA.decode_value("starttime",
+                                                 item["starttime"])
+        except (KeyError, ValueError):
+            continue
+        if starttime is None:
+            continue
+        try:
+            speed = LOOP_SCHEMA.decode_value("speed", item.get("speed"))
+        except ValueError:
+            speed = None
+        if speed is None:
+            speed = float("nan")
+        try:
+            status = int(item.get("status"))
+        except (TypeError, ValueError):
+            status = MISSING_STATUS
+        columns["detectorid"].append(detector_id)
+        columns["starttime"].append(starttime)
+        columns["speed"].append(speed)
+        columns["status"].append(status)
+    return dict((name, numpy.array(columns[name], dtype))
+                for name, dtype in COLUMNS)
+
+
+def concat_readings(readings_list):
+    """Concatenate readings columns"""
+    readings_list = list(readings_list)
+    if not readings_list:
+        return empty_readings()
+    return dict((name, numpy.concatenate([r[name] for r in readings_list]))
+                for name, _ in COLUMNS)
+
+
+def export_loop_cache(loop_dom, cache_dir, domain_meta=None, query=None):
+    """Export the loop domain into the columnar cache in cache_dir
+    @param: loop_dom - the loop domain, a boto Domain or a ShardedDomain
+    @param: cache_dir - directory of the cache, created if needed
+    @param: domain_meta - the domain metadata at export time, its item_count
+            and timestamp are kept to tell when the cache is stale
+    @param: query - the SELECT to export, default to every reading, or a
+            list of disjoint SELECTs fetched concurrently with
+            loop_dom.select_many
+    @return: the number of rows exported
+    """
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    if query is None:
+        query = ("SELECT detectorid, starttime, speed, status FROM `%s`"
+                 % loop_dom.name)
+    raw_files = dict((name, os.path.join(cache_dir, "%s.raw" % name))
+                     for name, _ in COLUMNS)
+    raw_handlers = dict((name, open(path, "wb"))
+                        for name, path in raw_files.items())
+    if isinstance(query, (list, tuple)):
+        items = loop_dom.select_many(query)
+    else:
+        items = loop_dom.select(query)
+    row_count = 0
+    try:
+        chunk = []
+        for item in items:
+            chunk.append(item)
+            if len(chunk) == EXPORT_CHUNK_ROWS:
+                row_count += _append_raw(raw_handlers, chunk)
+                chunk = []
+        row_count += _append_raw(raw_handlers, chunk)
+    finally:
+        for handler in raw_handlers.values():
+            handler.close()
+
+    # Sort by (detectorid, starttime), one column in memory at a time
+    raw = dict((name, numpy.fromfile(raw_files[name], dtype))
+               for name, dtype in COLUMNS[:2])
+    order = numpy.lexsort((raw["starttime"], raw["detectorid"]))
+    for name, dtype in COLUMNS:
+        column = raw.pop(name, None)
+        if column is None:
+            column = numpy.fromfile(raw_files[name], dtype)
+        if name == "detectorid":
+            sorted_ids = column[order]
+        numpy.save(os.path.join(cache_dir, "%s.npy" % name), column[order])
+        del column
+        os.remove(raw_files[name])
+
+    # Row range of each detector
+    detector_ids, first_rows = numpy.unique(sorted_ids, return_index=True)
+    detector_index = numpy.empty((len(detector_ids), 3), numpy.int64)
+    detector_index[:, 0] = detector_ids
+    detector_index[:, 1] = first_rows
+    detector_index[:, 2] = numpy.append(first_rows[1:], len(sorted_ids))
+    numpy.save(os.path.join(cache_dir, DETECTOR_INDEX_FILE), detector_index)
+
+    meta = {"domain": loop_dom.name, "rows": row_count,
+            "exported": datetime.datetime.now().isoformat(),
+            "item_count": getattr(domain_meta, "item_count", None),
+            "timestamp": str(getattr(domain_meta, "timestamp", None))}
+    with open(os.path.join(cache_dir, CACHE_META_FILE), "w") as meta_handler:
+        json.dump(meta, meta_handler)
+    return row_count
+
+
+def _append_raw(raw_handlers, items):
+    readings = readings_from_items(items)
+    for name, _ in COLUMNS:
+        readings[name].tofile(raw_handlers[name])
+    return len(readings["detectorid"])
+
+
+class LoopCache(object):
+    """Read only view of an exported loop cache, columns are memory mapped"""
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        with open(os.path.join(cache_dir, CACHE_META_FILE)) as meta_handler:
+            self.meta = json.load(meta_handler)
+        self.columns = dict(
+            (name, numpy.load(os.path.join(cache_dir, "%s.npy" % name),
+                              mmap_mode="r"))
+            for name, _ in COLUMNS)
+        # {detectorid: (first row, end row)}
+        self.detector_rows = dict(
+            (int(d), (int(first), int(end))) for d, first, end in
+            numpy.load(os.path.join(cache_dir, DETECTOR_INDEX_FILE)))
+
+    def is_stale(self, domain_meta):
+        """True if the domain changed since the export, by its metadata"""
+        return (self.meta.get("item_count") != getattr(domain_meta,
+                                                       "item_count", None) or
+                self.meta.get("timestamp") != str(getattr(domain_meta,
+                                                          "timestamp", None)))
+
+    def detector_ids(self):
+        return sorted(self.detector_rows)
+
+    def readings(self, detector_ids=None, start=None, end=None):
+        """The readings of the detectors within [start, end)
+        @param: detector_ids - an iterable of detector IDs, None for all
+        @param: start - inclusive, a datetime, starttime string or epoch
+        @param: end - exclusive, same types as start
+        @return: {column name: numpy array}, by detector then starttime
+        """
+        start, end = to_epoch(start), to_epoch(end)
+        if detector_ids is None:
+            detector_ids = self.detector_ids()
+        starttime = self.columns["starttime"]
+        row_ranges = []
+        for detector_id in detector_ids:
+            rows = self.detector_rows.get(int(detector_id))
+            if not rows:
+                continue
+            first, last = rows
+            if start is not None:
+                first += int(numpy.searchsorted(starttime[first:last], start))
+            if end is not None:
+                last = rows[0] + int(numpy.searchsorted(
+                    starttime[rows[0]:last], end))
+            if first < last:
+                row_ranges.append((first, last))
+        if not row_ranges:
+            return empty_readings()
+        return dict((name, numpy.concatenate([self.columns[name][a:b]
+                                              for a, b in row_ranges]))
+                    for name, _ in COLUMNS)
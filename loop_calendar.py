@@ -0,0 +1,94 @@
+"""Calendar filters of loop readings: a date range, weekdays and hour windows.
+
+CalendarFilter lists the time windows to fetch and tells, with NumPy over
+whole arrays of starttimes, which weekday and hour window each reading falls
+in, so a single pass over the readings can partition them for the peak
+period queries.
+"""
+import datetime
+
+import numpy
+
+
+# datetime.date.weekday() numbers
+MONDAY, TUESDAY, WEDNESDAY, THURSDAY, FRIDAY, SATURDAY, SUNDAY = range(7)
+WEEKDAY_NAMES = ("Monday", "Tuesday", "Wednesday", "Thursday", "Friday",
+                 "Saturday", "Sunday")
+# The epoch, 1970-01-01, was a Thursday
+_EPOCH_WEEKDAY = THURSDAY
+_DAY_SECONDS = 86400
+
+
+class CalendarFilter(object):
+    """Readings on some weekdays of a date range within some hour windows"""
+
+    def __init__(self, start_date, end_date, weekdays=None, hour_windows=None):
+        """
+        @param: start_date - first day, a datetime.date
+        @param: end_date - day after the last day, a datetime.date
+        @param: weekdays - the datetime.date.weekday() numbers to keep, None
+                for every day
+        @param: hour_windows - list of (first hour, end hour), e.g. (7, 9)
+                for 7-9AM, None for the whole day
+        """
+        self.start_date = start_date
+        self.end_date = end_date
+        self.weekdays = tuple(sorted(set(range(7) if weekdays is None
+                                         else weekdays)))
+        self.hour_windows = tuple(hour_windows or [(0, 24)])
+
+    def days(self):
+        """The days of the range on the weekdays"""
+        days = []
+        day = self.start_date
+        while day < self.end_date:
+            if day.weekday() in self.weekdays:
+                days.append(day)
+            day += datetime.timedelta(days=1)
+        return days
+
+    def time_windows(self):
+        """The [start, end) datetimes of every hour window of every day, in
+        time order
+        """
+        windows = []
+        for day in self.days():
+            midnight = datetime.datetime.combine(day, datetime.time())
+            for first_hour, end_hour in sorted(self.hour_windows):
+                windows.append((midnight + datetime.timedelta(hours=first_hour),
+                                midnight + datetime.timedelta(hours=end_hour)))
+        return windows
+
+    def partition(self, starttimes):
+        """The weekday and hour window of each reading
+        @param: starttimes - numpy array of the starttime in seconds since
+                the epoch
+        @return: (weekday indexes, window indexes), numpy arrays of the
+                 position in self.weekdays and self.hour_windows, both -1
+                 for the readings the filter leaves out
+        """
+        days = starttimes // _DAY_SECONDS
+        seconds = starttimes - days * _DAY_SECONDS
+        first_day = (datetime.datetime.combine(self.start_date, datetime.time())
+                     - datetime.datetime(1970, 1, 1)).days
+        end_day = (datetime.datetime.combine(self.end_date, datetime.time())
+                   - datetime.datetime(1970, 1, 1)).days
+        in_range = (days >= first_day) & (days < end_day)
+
+        weekday_lookup = numpy.full(7, -1, numpy.int64)
+        weekday_lookup[list(self.weekdays)] = numpy.arange(len(self.weekdays))
+        weekday_indexes = weekday_lookup[(days + _EPOCH_WEEKDAY) % 7]
+
+        window_indexes = numpy.full(len(starttimes), -1, numpy.int64)
+        for i, (first_hour, end_hour) in enumerate(self.hour_windows):
+            in_window = ((seconds >= first_hour * 3600) &
+                         (seconds < end_hour * 3600))
+            window_indexes[in_window] = i
+
+        keep = in_range & (weekday_indexes >= 0) & (window_indexes >= 0)
+        return (numpy.where(keep, weekday_indexes, -1),
+                numpy.where(keep, window_indexes, -1))
+
+    def mask(self, starttimes):
+        """True for the readings the filter keeps"""
+        return self.partition(starttimes)[0] >= 0
@@ -0,0 +1,189 @@
+"""Per-detector rollups of the loop readings, computed at upload time.
+
+SimpleDB select has no aggregate beside COUNT(*), so the travel time queries
+otherwise fetch every 20 second reading and average the speeds themselves.
+LoopRollup adds up the speeds of each detector by 5 minute and hourly
+buckets while upload_to_simpleDB parses the lines, and the totals are put in
+a companion domain, see rollup_domain_name, one item per detector and
+bucket:
+    detectorid          the detector ID
+    bucket              width of the bucket in seconds, "300" or "3600"
+    starttime           start of the bucket, loop_cache.STARTTIME_FORMAT
+    count, sum          of the positive speeds
+    min, max            of the positive speeds
+    ok_count, ok_sum    of the positive speeds with an OK status
+    sum_squares,        of the squared positive speeds, and of those with
+    ok_sum_squares      an OK status
+A detector-day is 312 rollup items instead of 4320 readings.
+
+Rollup items are replaced, not added to, so the totals of a bucket are only
+right when all its readings are uploaded in the same run.
+"""
+import numpy
+
+from sdb_schema import format_starttime, parse_starttime
+
+
+# Width of the buckets in seconds, 5 minutes and an hour
+ROLLUP_BUCKETS = (300, 3600)
+ROLLUP_DOMAIN_SUFFIX = "_Rollup"
+LOOP_STATUS_OK = "2"
+# Attributes the queries read, see rollups_from_items
+ROLLUP_ATTRIBUTES = ("detectorid", "starttime", "count", "sum", "ok_count",
+                     "ok_sum", "sum_squares", "ok_sum_squares")
+# Fields of a rollup cell
+(_COUNT, _SUM, _MIN, _MAX, _OK_COUNT, _OK_SUM, _SUM_SQUARES,
+ _OK_SUM_SQUARES) = range(8)
+
+
+def rollup_domain_name(domain_name):
+    """Name of the rollup domain of a loop domain"""
+    return domain_name + ROLLUP_DOMAIN_SUFFIX
+
+
+class LoopRollup(object):
+    """Count, sum, min, max and sum of squares of the positive speeds of
+    each detector by bucket.  The parsers each fill a partial rollup and the
+    uploader merges their cells.
+    """
+
+    def __init__(self, bucket_seconds=ROLLUP_BUCKETS,
+                 ok_status=LOOP_STATUS_OK):
+        """
+        @param: bucket_seconds - widths of the buckets, each divides a day
+        @param: ok_status - the status value of a good reading
+        """
+        self.bucket_seconds = tuple(bucket_seconds)
+        self.ok_status = ok_status
+        # {(detector ID, bucket seconds, bucket start epoch):
+        #  [count, sum, min, max, ok_count, ok_sum, sum_squares,
+        #   ok_sum_squares]}
+        self.cells = {}
+        # {starttime date: epoch of its midnight}
+        self._midnights = {}
+
+    def partial(self):
+        """A new empty rollup of the same buckets, for a parser"""
+        return LoopRollup(self.bucket_seconds, self.ok_status)
+
+    def domain_name(self, domain_name):
+        return rollup_domain_name(domain_name)
+
+    def _epoch(self, starttime):
+        """Same as sdb_schema.parse_starttime, with the date of each day
+        parsed only once
+        """
+        day = starttime[:10]
+        midnight = self._midnights.get(day)
+        if midnight is None:
+            midnight = parse_starttime(day + "T00:00:00")
+            self._midnights[day] = midnight
+        return (midnight + int(starttime[11:13]) * 3600 +
+                int(starttime[14:16]) * 60 + int(starttime[17:19]))
+
+    def add(self, item):
+        """Add the speed of a reading to its buckets.  Readings without a
+        positive speed, a detectorid or a valid starttime are left out.
+        @param: item - {attribute name: value} of a loop reading
+        @return: True when the reading was added
+        """
+        try:
+            speed = float(item["speed"])
+            epoch = self._epoch(item["starttime"])
+            detector_id = item["detectorid"]
+        except (KeyError, ValueError):
+            return False
+        if not speed > 0:
+            return False
+        ok = item.get("status") == self.ok_status
+        square = speed * speed
+        for bucket in self.bucket_seconds:
+            key = (detector_id, bucket, epoch - epoch % bucket)
+            cell = self.cells.get(key)
+            if cell is None:
+                self.cells[key] = [1, speed, speed, speed, int(ok),
+                                   speed if ok else 0.0, square,
+                                   square if ok else 0.0]
+                continue
+            cell[_COUNT] += 1
+            cell[_SUM] += speed
+            cell[_SUM_SQUARES] += square
+            if speed < cell[_MIN]:
+                cell[_MIN] = speed
+            if speed > cell[_MAX]:
+                cell[_MAX] = speed
+            if ok:
+                cell[_OK_COUNT] += 1
+                cell[_OK_SUM] += speed
+                cell[_OK_SUM_SQUARES] += square
+        return True
+
+    def merge(self, cells):
+        """Add the cells of another rollup, e.g. of another parser"""
+        for key, other in cells.items():
+            cell = self.cells.get(key)
+            if cell is None:
+                self.cells[key] = list(other)
+                continue
+            cell[_COUNT] += other[_COUNT]
+            cell[_SUM] += other[_SUM]
+            cell[_MIN] = min(cell[_MIN], other[_MIN])
+            cell[_MAX] = max(cell[_MAX], other[_MAX])
+            cell[_OK_COUNT] += other[_OK_COUNT]
+            cell[_OK_SUM] += other[_OK_SUM]
+            cell[_SUM_SQUARES] += other[_SUM_SQUARES]
+            cell[_OK_SUM_SQUARES] += other[_OK_SUM_SQUARES]
+
+    def items(self):
+        """@yield: (item name, attributes) of every cell, sorted by detector,
+                bucket and time
+        """
+        for key in sorted(self.cells):
+            detector_id, bucket, start = key
+            (count, total, low, high, ok_count, ok_total, squares,
+             ok_squares) = self.cells[key]
+            starttime = format_starttime(start)
+            yield ("%s_%s_%s" % (detector_id, bucket, starttime),
+                   {"detectorid": detector_id, "bucket": str(bucket),
+                    "starttime": starttime, "count": str(count),
+                    "sum": repr(total), "min": repr(low), "max": repr(high),
+                    "ok_count": str(ok_count), "ok_sum": repr(ok_total),
+                    "sum_squares": repr(squares),
+                    "ok_sum_squares": repr(ok_squares)})
+
+
+def rollups_from_items(items, ok_only=False):
+    """Convert rollup items into readings columns where each row stands for
+    the readings of a bucket: speed is the sum of their speeds, count their
+    number and squares the sum of their squared speeds, see
+    loop_bins.reading_counts
+    @param: items - an iterable of dicts with the ROLLUP_ATTRIBUTES
+    @param: ok_only - set to True for the totals of the readings with an OK
+            status only
+    @return: {"detectorid", "starttime", "speed", "count", "squares":
+             numpy array}
+    """
+    prefix = "ok_" if ok_only else ""
+    count_name, sum_name, squares_name = (prefix + "count", prefix + "sum",
+                                          prefix + "sum_squares")
+    detector_ids, starttimes, sums, counts, squares = [], [], [], [], []
+    for item in items:
+        try:
+            count = int(item[count_name])
+            detector_id = int(item["detectorid"])
+            starttime = parse_starttime(item["starttime"])
+            total = float(item[sum_name])
+            square_total = float(item[squares_name])
+        except (KeyError, ValueError):
+            continue
+        if count:
+            detector_ids.append(detector_id)
+            starttimes.append(starttime)
+            sums.append(total)
+            counts.append(count)
+            squares.append(square_total)
+    return {"detectorid": numpy.array(detector_ids, numpy.int32),
+            "starttime": numpy.array(starttimes, numpy.int64),
+            "speed": numpy.array(sums, numpy.float64),
+            "count": numpy.array(counts, numpy.int64),
+            "squares": numpy.array(squares, numpy.float64)}
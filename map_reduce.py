@@ -0,0 +1,40 @@
+"""Map partitions on a pool of worker processes and reduce as they finish.
+
+Each worker fetches and aggregates its own partition and sends back a small
+partial, so no connection or lazy select result crosses the process boundary
+and the parent only holds the reduced state.
+"""
+import multiprocessing
+
+
+def map_reduce(mapper, partitions, reducer, worker_count=None,
+               initializer=None, initargs=()):
+    """Run mapper on every partition in worker processes and pass each
+    partial result to reducer in this process, in completion order
+    @param: mapper - a picklable function of a partition returning a partial
+    @param: partitions - a list of picklable partitions
+    @param: reducer - a function of a partial, merges it into the result
+    @param: worker_count - number of worker processes, default to the number
+            of CPUs, never more than the partitions
+    @param: initializer - called with initargs when each worker starts, to
+            open its own connections
+    @return: the number of partitions reduced
+    """
+    if not partitions:
+        return 0
+    worker_count = min(worker_count or multiprocessing.cpu_count(),
+                       len(partitions))
+    workers = multiprocessing.Pool(worker_count, initializer=initializer,
+                                   initargs=initargs)
+    reduced = 0
+    try:
+        for partial in workers.imap_unordered(mapper, partitions):
+            reducer(partial)
+            reduced += 1
+        workers.close()
+    except:
+        workers.terminate()
+        raise
+    finally:
+        workers.join()
+    return reduced
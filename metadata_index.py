@@ -0,0 +1,166 @@
+"""In memory index of the TeamA_Station and TeamA_Detector metadata.
+
+Both domains are small, so MetadataIndex loads them whole with one paginated
+SELECT each instead of one SELECT per station, and keeps the mappings the
+queries need:
+    station_detectors  {stationid: [detectorid, ...]}
+    detector_station   {detectorid: stationid}
+    station_length     {stationid: length_mid as a float}
+The index is saved to a JSON file along with the item count and timestamp of
+both domains, and loaded again from it as long as the domain metadata match.
+"""
+import datetime
+import json
+import os
+
+from sdb_throttle import throttled_select
+
+
+class MetadataIndex(object):
+    """Stations and detectors by ID, item attributes are kept as strings"""
+
+    def __init__(self, stations, detectors, domain_stamps=None):
+        """
+        @param: stations - {stationid: station item dict}
+        @param: detectors - {detectorid: detector item dict}
+        @param: domain_stamps - {"station": stamp, "detector": stamp}, see
+                domain_stamp
+        """
+        self.stations = stations
+        self.detectors = detectors
+        self.domain_stamps = domain_stamps or {}
+        self.station_detectors = {}
+        self.detector_station = {}
+        for detector_id, detector in sorted(detectors.items(),
+                                            key=lambda d: _id_key(d[0])):
+            station_id = detector.get("stationid")
+            if not station_id:
+                continue
+            self.detector_station[detector_id] = station_id
+            self.station_detectors.setdefault(station_id, []).append(detector_id)
+        self.station_length = {}
+        for station_id, station in stations.items():
+            try:
+                self.station_length[station_id] = float(station["length_mid"])
+            except (KeyError, TypeError, ValueError):
+                pass
+
+    @classmethod
+    def from_domains(cls, station_dom, detector_dom, station_meta=None,
+                     detector_meta=None):
+        """Load both domains with a paginated SELECT * each
+        @param: station_meta - the station domain metadata, to tell later
+                when the index is stale
+        @param: detector_meta - same for the detector domain
+        """
+        stations = _items_by(station_dom, "stationid")
+        detectors = _items_by(detector_dom, "detectorid")
+        return cls(stations, detectors,
+                   {"station": domain_stamp(station_meta),
+                    "detector": domain_stamp(detector_meta)})
+
+    @classmethod
+    def from_file(cls, index_file):
+        with open(index_file) as index_handler:
+            data = json.load(index_handler)
+        return cls(data["stations"], data["detectors"], data["domain_stamps"])
+
+    def save(self, index_file):
+        data = {"saved": datetime.datetime.now().isoformat(),
+                "domain_stamps": self.domain_stamps,
+                "stations": self.stations,
+                "detectors": self.detectors}
+        temp_file = "%s.tmp" % index_file
+        with open(temp_file, "w") as index_handler:
+            json.dump(data, index_handler)
+        os.rename(temp_file, index_file)
+
+    def is_stale(self, station_meta, detector_meta):
+        """True if either domain changed since the index was loaded"""
+        return (self.domain_stamps.get("station") != domain_stamp(station_meta) or
+                self.domain_stamps.get("detector") != domain_stamp(detector_meta))
+
+    def find_stations(self, **attributes):
+        """IDs of the stations whose attributes equal the given values,
+        sorted by ID, e.g. find_stations(highwayname="I-205")
+        """
+        return _find(self.stations, attributes)
+
+    def find_detectors(self, **attributes):
+        """IDs of the detectors whose attributes equal the given values,
+        sorted by ID
+        """
+        return _find(self.detectors, attributes)
+
+    def station_chain(self, from_station_id, to_station_name=None):
+        """IDs of the stations from a station following the downstream
+        attribute, until no downstream station, the station whose
+        locationtext is to_station_name, or a loop
+        """
+        chain = []
+        station_id = from_station_id
+        while station_id in self.stations and station_id not in chain:
+            chain.append(station_id)
+            station = self.stations[station_id]
+            if station.get("locationtext") == to_station_name:
+                break
+            station_id = station.get("downstream")
+        return chain
+
+
+def domain_stamp(domain_meta):
+    """What identifies a version of a domain, from its metadata"""
+    if domain_meta is None:
+        return None
+    return [getattr(domain_meta, "item_count", None),
+            str(getattr(domain_meta, "timestamp", None))]
+
+
+def load_metadata_index(station_dom, detector_dom, station_meta=None,
+                        detector_meta=None, index_file=None):
+    """The index saved in index_file, or loaded from the domains and saved
+    when the file is missing or stale
+    @param: index_file - path of the saved index, None to not persist it
+    @return: a MetadataIndex
+    """
+    if index_file and os.path.isfile(index_file):
+        try:
+            index = MetadataIndex.from_file(index_file)
+        except (KeyError, ValueError):
+            index = None
+        if index is not None and not index.is_stale(station_meta,
+                                                    detector_meta):
+            return index
+    index = MetadataIndex.from_domains(station_dom, detector_dom,
+                                       station_meta, detector_meta)
+    if index_file:
+        index.save(index_file)
+    return index
+
+
+def _items_by(domain, id_attribute):
+    """{id: item} of every item of the domain, by the id attribute or by the
+    item name when the attribute is missing
+    """
+    query = "SELECT * FROM `%s`" % domain.name
+    items = {}
+    for item in throttled_select(domain, query):
+        item_id = item.get(id_attribute) or getattr(item, "name", None)
+        if item_id:
+            items[item_id] = dict(item)
+    return items
+
+
+def _id_key(item_id):
+    """Sort numeric IDs by value, the others after them by string"""
+    try:
+        return (0, int(item_id), item_id)
+    except ValueError:
+        return (1, 0, item_id)
+
+
+def _find(items, attributes):
+    return sorted((item_id for item_id, item in items.items()
+                   if all(item.get(name) == value
+                          for name, value in attributes.items())),
+                  key=_id_key)
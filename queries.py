@@ -11,12 +11,36 @@ Nelson, Jason
 Quach, Hong
 """
 
-import exceptions
-import multiprocessing
+import datetime
+import itertools
+import os
 from multiprocessing.pool import ThreadPool
 
+import boto.exception
 import boto.sdb
 # AWS Boto API http://aws.amazon.com/sdkforpython/
+import numpy
+
+from loop_bins import (BIN_SECONDS, SpeedAccumulator, bin_count,
+                       binned_speeds, group_indexes, mean_speeds,
+                       pair_travel_times, reading_counts, travel_times)
+from loop_calendar import (THURSDAY, TUESDAY, WEDNESDAY, WEEKDAY_NAMES,
+                           CalendarFilter)
+from loop_cache import (CACHE_META_FILE, STARTTIME_FORMAT, LoopCache,
+                        export_loop_cache, readings_from_items)
+from loop_rollup import (ROLLUP_ATTRIBUTES, ROLLUP_BUCKETS, rollup_domain_name,
+                         rollups_from_items)
+from map_reduce import map_reduce
+from metadata_index import load_metadata_index
+from select_planner import (LoopSelectPlan, hex_boundaries,
+                            item_name_partitions, partition_query,
+                            typed_predicate)
+from sdb_schema import (LOOP_SCHEMA, format_starttime, space_separated,
+                        to_epoch)
+from sdb_select_cache import SELECT_CACHE_DIR, CachedDomain, SelectCache
+from sdb_shards import ShardedDomain
+from sdb_throttle import (is_throttling_error, shared_throttle,
+                          throttled_select)
 
 # http://docs.aws.amazon.com/general/latest/gr/rande.html#sdb_region
 
@@ -25,19 +49,234 @@ AWS_WEST_OR_REGION = 'us-west-2'
 DETECTOR_DOMAIN = 'TeamA_Detector'
 LOOP_DOMAIN = 'TeamA_Loop'
 STATION_DOMAIN  = 'TeamA_Station'
+# Per-detector speed totals by 5 minutes and hour, see loop_rollup
+ROLLUP_DOMAIN = rollup_domain_name(LOOP_DOMAIN)
 
 STATION_CLASS_MAINLINE = '1'
 DETECTOR_CLASS_MAINLINE = '1'
 LOOP_STATUS_OK = '2'
 
+# The 2-month test period, the end day excluded
+TEST_PERIOD_START = datetime.date(2011, 9, 15)
+TEST_PERIOD_END = datetime.date(2011, 11, 15)
+
+# Number of hash shards TeamA_Loop is uploaded to, see upload_to_simpleDB
+LOOP_SHARD_COUNT = 1
+# Local columnar cache of TeamA_Loop, see open_loop_cache
+LOOP_CACHE_DIR = 'loop_cache'
+# Item name ranges of TeamA_Loop scanned at once by the export
+EXPORT_PARTITIONS = 16
+# Saved index of the station and detector domains, see init_conn
+METADATA_INDEX_FILE = '.metadata_index.json'
+# Items fetched from SimpleDB before being folded in, see
+# speed_reading_chunks
+READING_CHUNK_ROWS = 100000
+
 # Global variables for data access
 conn = None
+# Returns a new connection, see init_conn
+connection_factory = None
 detector_dom = None
 loop_dom = None
 station_dom = None
+# None when the loop data was uploaded without a rollup
+rollup_dom = None
 detector_meta = None
 loop_meta = None
 station_meta = None
+# The LoopCache when open, loop_readings then reads from it
+loop_cache = None
+# The MetadataIndex of the station and detector domains
+metadata = None
+# The SelectCache the domains above select through
+select_cache = None
+
+
+def open_loop_cache(cache_dir=LOOP_CACHE_DIR, export=False):
+    """Read the loop readings from the local columnar cache from now on.
+    The cache is exported from the loop domain first when it does not exist.
+    @param: cache_dir - directory of the cache
+    @param: export - set to True to export again, e.g. when the cache is stale
+    """
+    global loop_cache
+    if export or not os.path.isfile(os.path.join(cache_dir, CACHE_META_FILE)):
+        print("Exporting %s to %s" % (LOOP_DOMAIN, cache_dir))
+        # The item names are UUIDs, scan ranges of them concurrently
+        export_query = ('SELECT detectorid, starttime, speed, status FROM `%s`'
+                        % LOOP_DOMAIN)
+        export_queries = partition_query(
+            export_query, item_name_partitions(hex_boundaries(EXPORT_PARTITIONS)))
+        # Straight to the domain, the export would only flush the select cache
+        row_count = export_loop_cache(loop_dom.domain, cache_dir, loop_meta,
+                                      export_queries)
+        print("Exported %s readings" % row_count)
+    loop_cache = LoopCache(cache_dir)
+    if loop_meta is not None and loop_cache.is_stale(loop_meta):
+        print("Loop cache %s is older than %s, export it again to refresh it"
+              % (cache_dir, LOOP_DOMAIN))
+
+
+def loop_readings(detector_ids, start=None, end=None, positive_speed=False,
+                  ok_only=False):
+    """Readings of the detectors within [start, end), from the loop cache
+    when open, otherwise from the loop domain with the fewest selects, see
+    LoopSelectPlan.
+    @param: detector_ids - an iterable of detector IDs
+    @param: start - inclusive, a datetime, starttime string or epoch
+    @param: end - exclusive, same types as start
+    @param: positive_speed - set to True to keep the readings with a speed
+            above 0 only, filtered by SimpleDB on the LOOP_SCHEMA speeds
+    @param: ok_only - set to True to keep the readings with an OK status
+            only, filtered by SimpleDB too
+    @return: {column name: numpy array}, see loop_cache.COLUMNS
+    """
+    if loop_cache is not None:
+        readings = loop_cache.readings(detector_ids, start, end)
+        keep = numpy.ones(len(readings["speed"]), bool)
+        if positive_speed:
+            keep &= readings["speed"] > 0
+        if ok_only:
+            keep &= readings["status"] == int(LOOP_STATUS_OK)
+        return dict((name, column[keep]) for name, column in readings.items())
+    plan = _loop_plan(detector_ids, start, end, positive_speed, ok_only)
+    return readings_from_items(plan.select(loop_dom))
+
+
+def _loop_plan(detector_ids, start, end, positive_speed, ok_only,
+               ranges=None):
+    """The LoopSelectPlan of loop_readings"""
+    predicates = []
+    if positive_speed:
+        predicates.append(typed_predicate("speed", ">", 0, LOOP_SCHEMA))
+    return LoopSelectPlan(LOOP_DOMAIN, detector_ids, start, end,
+                          filters={"status": LOOP_STATUS_OK} if ok_only else None,
+                          predicates=predicates, ranges=ranges)
+
+
+def rollup_readings(detector_ids, bucket_seconds, start=None, end=None,
+                    ok_only=False):
+    """Rollups of the detectors by bucket within [start, end) from the
+    rollup domain, a few hundred items per detector-day instead of
+    thousands of readings
+    @param: bucket_seconds - width of the buckets, one of ROLLUP_BUCKETS
+    @param: ok_only - set to True for the readings with an OK status only
+    @return: readings columns, each row the speed sum and "count" of the
+             positive speeds of a bucket, see loop_rollup.rollups_from_items.
+             None when the loop cache is open, there is no rollup domain or
+             start and end are not on bucket boundaries.
+    """
+    plan = _rollup_plan(detector_ids, bucket_seconds, start, end)
+    if plan is None:
+        return None
+    return rollups_from_items(plan.select(rollup_dom), ok_only)
+
+
+def _rollup_plan(detector_ids, bucket_seconds, start, end, ranges=None):
+    """The LoopSelectPlan of rollup_readings, None when the rollups do not
+    fit, see rollup_readings
+    """
+    if (loop_cache is not None or rollup_dom is None or
+            bucket_seconds not in ROLLUP_BUCKETS):
+        return None
+    if any(moment is not None and to_epoch(moment) % bucket_seconds
+           for moment in itertools.chain(*(ranges or [(start, end)]))):
+        return None
+    return LoopSelectPlan(ROLLUP_DOMAIN, detector_ids, start, end,
+                          filters={"bucket": str(bucket_seconds)},
+                          attributes=ROLLUP_ATTRIBUTES, ranges=ranges)
+
+
+def speed_readings(detector_ids, bucket_seconds, start=None, end=None,
+                   ok_only=False):
+    """The positive speeds to average by buckets of bucket_seconds, the
+    rollups when they fit, otherwise the readings of loop_readings
+    @param: ok_only - set to True to keep the readings with an OK status
+    @return: readings columns, see loop_bins.reading_counts for the rows
+             standing for several readings
+    """
+    readings = rollup_readings(detector_ids, bucket_seconds, start, end,
+                               ok_only)
+    if readings is None:
+        readings = loop_readings(detector_ids, start, end,
+                                 positive_speed=True, ok_only=ok_only)
+    return readings
+
+
+def speed_reading_chunks(detector_ids, bucket_seconds, start=None, end=None,
+                         ok_only=False, ranges=None):
+    """speed_readings a chunk at a time, of READING_CHUNK_ROWS items from
+    SimpleDB or of one detector from the loop cache, each fetched once the
+    previous one is folded in, so the memory does not grow with the span
+    @param: ranges - a list of [start, end) to read instead of [start, end),
+            selected together, see LoopSelectPlan
+    @yield: readings columns, see speed_readings
+    """
+    if loop_cache is not None:
+        for detector_id in detector_ids:
+            for first, last in ranges or [(start, end)]:
+                yield loop_readings([detector_id], first, last,
+                                    positive_speed=True, ok_only=ok_only)
+        return
+    plan = _rollup_plan(detector_ids, bucket_seconds, start, end, ranges)
+    if plan is not None:
+        items = plan.select(rollup_dom)
+        from_items = lambda chunk: rollups_from_items(chunk, ok_only)
+    else:
+        items = _loop_plan(detector_ids, start, end, True, ok_only,
+                           ranges).select(loop_dom)
+        from_items = readings_from_items
+    items = iter(items)
+    while True:
+        chunk = list(itertools.islice(items, READING_CHUNK_ROWS))
+        if not chunk:
+            return
+        yield from_items(chunk)
+
+
+def corridor_detectors(highway_name, short_direction,
+                       detector_class=DETECTOR_CLASS_MAINLINE):
+    """The stations of a highway direction and their detectors of a class,
+    from the metadata index
+    @return: (list of station IDs, list of detector IDs), sorted by ID
+    """
+    station_ids = metadata.find_stations(highwayname=highway_name,
+                                         shortdirection=short_direction)
+    corridor = set(station_ids)
+    detector_ids = [detector_id for detector_id in
+                    metadata.find_detectors(detectorclass=detector_class)
+                    if metadata.detector_station.get(detector_id) in corridor]
+    with_detectors = set(metadata.detector_station[d] for d in detector_ids)
+    return [s for s in station_ids if s in with_detectors], detector_ids
+
+
+def corridor_chain(from_station_name, to_station_name, highway_name,
+                   short_direction):
+    """The mainline stations from one station to another following the
+    downstream links, and their mainline detectors, from the metadata index
+    @return: (tuple of station IDs in downstream order,
+              {station ID: list of detector IDs})
+    """
+    first_station_ids = metadata.find_stations(locationtext=from_station_name,
+                                               highwayname=highway_name,
+                                               shortdirection=short_direction,
+                                               stationclass=STATION_CLASS_MAINLINE)
+
+    # Traverse the station through the downstream station attribute until
+    # no downstream station or terminated by to_station_name
+    station_id_chain = []
+    if first_station_ids:
+        station_id_chain = [station_id for station_id in
+                            metadata.station_chain(first_station_ids[0],
+                                                   to_station_name)
+                            if metadata.stations[station_id].get("stationclass") == STATION_CLASS_MAINLINE]
+
+    detector_ids_by_station_chain = {}
+    for station_id in station_id_chain:
+        detector_ids_by_station_chain[station_id] = [
+            d for d in metadata.station_detectors.get(station_id, [])
+            if metadata.detectors[d].get("detectorclass") == DETECTOR_CLASS_MAINLINE]
+    # Frozen list to maintain sequence
+    return tuple(station_id_chain), detector_ids_by_station_chain
 
 
 def show_domains_stat():
@@ -47,9 +286,9 @@ def show_domains_stat():
         if attr.startswith('_'):
             continue
         print("%s:\t%s\t%s\t%s" % (attr,
-                                   getattr(detector_meta, attr),
-                                   getattr(loop_meta, attr),
-                                   getattr(station_meta, attr)))
+                                   getattr(detector_meta, attr, ""),
+                                   getattr(loop_meta, attr, ""),
+                                   getattr(station_meta, attr, "")))
 
 
 def query_top_5_samples():
@@ -82,468 +321,336 @@ def single_day_station_travel_times():
     #the average travel time to traverse through a station's area over a 5 minute period
     print('Query a: Single-Day Station Travel Times')
     
-    s_query1 = 'SELECT stationid FROM `%s` WHERE Shortdirection = "N" AND highwayname ="I-205" and detectorclass="1"' %DETECTOR_DOMAIN
-    
-    stations = detector_dom.select(s_query1)
-        
-    sDict = {}
-    sList = []
-    for ea in stations:
-        sDict[ea['stationid']] = 0
-        sList.append(ea['stationid'])
-
-    sList2 = []
-    for ea in sList:
-        if ea not in sList2:
-            sList2.append(ea)
-
-    sList = sList2
-    stationCount = len(sList)
-
-    for ea in sList:
-        length_query = 'SELECT length_mid FROM `%s` WHERE itemName() = "%s"' %(STATION_DOMAIN, ea)
-        s_Length = station_dom.select(length_query)
-        for i in s_Length:
-            sDict[ea] = i['length_mid']
+    # Stations and their mainline detectors from the metadata index
+    sList, dList = corridor_detectors("I-205", "N")
+    station_index = dict((sta, i) for i, sta in enumerate(sList))
+    detector_group = dict((int(det), station_index[metadata.detector_station[det]]) for det in dList)
+    lengths = [metadata.station_length.get(sta, numpy.nan) for sta in sList]
+
+    # The whole day in one planned fetch, of the 5 minute rollups when
+    # uploaded, binned by station and 5 minutes
+    day_start = datetime.datetime(2011, 9, 22)
+    day_end = day_start + datetime.timedelta(days=1)
+    readings = speed_readings(dList, BIN_SECONDS, day_start, day_end)
+    sums, counts = binned_speeds(readings, detector_group, len(sList), day_start, day_end)
+    station_times = travel_times(mean_speeds(sums, counts), lengths)
 
-
-    #NEED TO STILL GET dLIST SOMEHOW
-    #dList = []
-    #d_query1 = 'SELECT detectorid FROM '%s' WHERE stationid = %s GROUP BY stationid" %(DETECTOR_DOMAIN, station)
-    #detectors = detector_dom.select(d_query1)
-    #for dec in detectors:
-        #dList.append(dec['detectorid'])
-    dList = [1345,1346,1347,1348,1353,1354,1355,1361,1362,1363,1369,1370,1371,1809,1810,1811,1941,1942,1943,1949,1950,1951]
-
-    detectorCount = len(dList)
-
-    #NEED TO CREAT FUNCTION FOR detector mid length dDict
-    #for item in dList, map dList[item] to sDict[item] and save it to dDict
-    #dDict is a dictionary or detector ID's to station lengths
-    dDict = {1345 : 0.94,1346 : 0.94,1347 : 0.94,1348 : 0.94,1353 : 1.89,1354 : 1.89,1355 : 1.89,1361 : 1.6,1362 : 1.6,1363 : 1.6,1369 : 0.86,1370 : 0.86,1371 : 0.86,1809 : 0.84,1810 : 0.84,1811 : 0.84,1941 : 2.14,1942 : 2.14,1943 : 2.14,1949 : 1.82,1950 : 1.82,1951 : 1.82}
-
-    #this dictionary will match the detectorid to stationid used above for each detector to corresponding stations
-    dettosta = {1345:1111, 1346:1111, 1347:1111, 1348:1111, 1353:2222, 1354:2222, 1355:2222, 1361:3333, 1362:3333, 1363:3333, 1369:4444, 1370:4444, 1371:4444, 1809:5555, 1810:5555, 1811:5555, 1941:6666, 1942:6666, 1943:6666, 1949:7777, 1950:7777, 1951:7777}
-    #count of results
-    resCount = 0
-    totalTime = 0.0
-    speed5Min = 0.0
-    numReadings = 0
-    per = "%"
-    
     file = open('results.txt', 'w')
-
-    day = 22
-    year = 2011
-    month = "09"
-    for hr in range(0, 23):
-        for i in range(0,11): #for every 5 minute increment this hour
-            for sta in sList:
-                for det in dList:
-                    if dettosta[det] == sta:
-                        for minute in range(0,4):
-                            min = minute + (i*5)
-                            l_query = 'SELECT speed FROM `%s` WHERE detectorid = "%s" AND starttime like "%s-%s-%sT%s:%s:%s" AND speed != "" ' %(LOOPDATA_DOMAIN, det, year, month, day, hr, min, per)
-                            data = loopdata_dom.select(l_query)
-                            for d in data:
-                                resCount += 1
-                                #need to determine what impact 0 speeds will have on the results
-                                if not (float(d['speed']) == 0):
-                                    numReadings += 1
-                                    speed5Min += float(d['speed'])
-                #look up station from det?
-                file.write('station: %s, time: %s:%s - %s:%s, travel time: %s\n' %(sta, hr, (min - 4), hr, min, (dDict[det]/(speed5Min/numReadings))))
-                speed5Min = 0.0
-                numReadings = 0
-
+    bin_starts = [day_start + datetime.timedelta(seconds=BIN_SECONDS * b) for b in range(station_times.shape[1])]
+    for b, bin_start in enumerate(bin_starts):
+        bin_end = bin_start + datetime.timedelta(seconds=BIN_SECONDS - 60)
+        for i, sta in enumerate(sList):
+            file.write('station: %s, time: %s - %s, travel time: %s\n' %(sta, bin_start.strftime("%H:%M"), bin_end.strftime("%H:%M"), station_times[i, b]))
     file.close()
 
+    #count of results, the zero speeds are left out of the means
+    resCount = int(numpy.sum(counts))
+    totalTime = float(numpy.nansum(station_times))
     print totalTime
     print resCount
-    
 
 
-def _hourly_speed_group_by((station_id, detector_id, loop_result_iter)):
-    """Helper function to group by the result and process each
-    result in the loop_result_iter.  SimpleDB does not support any
-    function in select beside COUNT(*), so combining the station_id
-    constant and derive hourly starttime need to be done outside
-    the query.
-    Required attributes in loop_result_iter
-        "starttime" with format "YYYY-MM-ddTHH:mm:ss"
-        "speed" with format of integer string
-
-    Return a list of tuple (station_id, starttime_hour, speed)
+def _init_loop_worker(cache_dir, rollups):
+    """Initializer of the worker processes reading the loop data, each one
+    opens its own connection and loop cache instead of sharing the parent's
+    @param: cache_dir - directory of the loop cache, None to read SimpleDB
+    @param: rollups - set to True to read the rollup domain
     """
-    result = []
-    #TODO: test one item for the expected attribute
-    for loop in loop_result_iter:
-        try:
-            starttime_hour = "%s:00:00" % loop["starttime"][:-6]
-            speed = int(loop["speed"])
-        except exceptions.ValueError:
-            continue
-        result.append((station_id, starttime_hour, speed))
-    return {station_id: (detector_id, result)}
+    global conn, loop_dom, rollup_dom, loop_cache
+    conn = connection_factory()
+    loop_dom = ShardedDomain(conn, LOOP_DOMAIN, LOOP_SHARD_COUNT)
+    rollup_dom = ShardedDomain(conn, ROLLUP_DOMAIN) if rollups else None
+    loop_cache = LoopCache(cache_dir) if cache_dir else None
+
+
+def _hourly_station_partial((station_index, detector_ids, start, end)):
+    """Mapper of hourly_corridor_travel_times, runs in a worker process.
+    SimpleDB does not support any function in select beside COUNT(*), so the
+    worker fetches the hourly rollups of the detectors of one station, or
+    their readings without rollups, and adds up the speeds with an OK status
+    by hour itself.  Zero speeds are left out as in the single day query.
+    The readings are folded into an hourly SpeedAccumulator of [start, end)
+    chunk by chunk as they are fetched.
+
+    Return (station_index, partial), see SpeedAccumulator.partial
+    """
+    station_hours = SpeedAccumulator(start, end, 3600)
+    for readings in speed_reading_chunks(detector_ids, 3600, start, end,
+                                         ok_only=True):
+        station_hours.add(readings["starttime"], readings["speed"],
+                          readings.get("count"), readings.get("squares"))
+    return station_index, station_hours.partial()
 
 
 def hourly_corridor_travel_times(from_station_name=None, to_station_name=None,
-                                 highway_name=None, short_direction=None):
+                                 highway_name=None, short_direction=None,
+                                 start_date=TEST_PERIOD_START,
+                                 end_date=TEST_PERIOD_END):
     """Find travel time for the entire I-205 NB freeway
     section in the data set (Sunnyside Rd to the river - all NB stations
     in the data set) for each hour in the 2-month test period.
     """
     print('Query b: Hourly Corridor Travel Times')
-    # 1.  Using a 'for-loop' to query the sequence of stations from the starting
-    # station to the ending station (Sunnyside to River).
-    # Traverse by 'downstream' station ID.
-    # Query the first station
-    first_station_query = ("""SELECT * FROM `%s`
-        WHERE locationtext = "%s"
-            AND highwayname = "%s"
-            AND shortdirection = "%s"
-            AND stationclass = "%s" """
-        % (STATION_DOMAIN, from_station_name, highway_name, short_direction, STATION_CLASS_MAINLINE))
-    station_result = list(station_dom.select(first_station_query, max_items=1))
-
-    all_stations = []
-    station_id_chain = []
-    # Traverse the station through the downstream station attribute until
-    # no downstream station or terminated by to_station_name
-    while station_result:
-        current_station = station_result[0]
-        all_stations.append(current_station)
-        station_id_chain.append(current_station["stationid"])
-        if current_station["locationtext"] == to_station_name:
-            break
-        station_query = ("""SELECT * FROM `%s`
-            WHERE stationid = "%s"
-                AND stationclass = "%s" """
-            % (STATION_DOMAIN, current_station["downstream"], STATION_CLASS_MAINLINE))
-        station_result = list(station_dom.select(station_query, max_items=1))
-    # Frozen list to maintain sequence
-    station_id_chain = tuple(station_id_chain)
+    # 1.  Follow the sequence of stations from the starting station to the
+    # ending station (Sunnyside to River) by 'downstream' station ID.
+    # 2.  Find the list of detectors in the list of stations found in step 1
+    station_id_chain, detector_ids_by_station_chain = corridor_chain(
+        from_station_name, to_station_name, highway_name, short_direction)
     print("Station IDs chain:  %s" % (" --> ".join(station_id_chain)))
 
-    # 2.  Query the list of detectors in the list of stations found in step 1
-    all_detectors = []
-    detector_ids_by_station_chain = {}
-    for station_id in station_id_chain:
-        detector_query = ("""SELECT * FROM `%s`
-            WHERE stationid="%s"
-                AND detectorclass = "%s" """
-            % (DETECTOR_DOMAIN, station_id, DETECTOR_CLASS_MAINLINE))
-        detector_result = list(detector_dom.select(detector_query))
-        all_detectors.extend(detector_result)
-        detector_ids_by_station_chain[station_id] = [d["detectorid"] for d in detector_result]
-
     print("Detector IDs group by Station ID chain:")
     for station_id in station_id_chain:
         print("%s: %s" % (station_id, detector_ids_by_station_chain[station_id]))
 
-    # 3.  Query all loop data having detector ID in the list of detectors found in step 2
-    loop_query_by_station = {}
-    # Build a query to select all loop data for each station
-    for station_id in station_id_chain:
-        query_or_clauses = []
-        loop_query_by_station[station_id] = []
-        for detector_id in detector_ids_by_station_chain[station_id]:
-            query_or_clauses.append('detectorid="%s"' % (detector_id))
-            all_loops_query = ("""SELECT starttime, speed FROM `%s`
-                WHERE status = "%s"
-                    AND speed IS NOT NULL
-                    AND speed != ""
-                    AND detectorid="%s" """
-                % (LOOP_DOMAIN, LOOP_STATUS_OK, detector_id))
-            loop_query_by_station[station_id].append((detector_id, all_loops_query))
-
-    # 4.  Using a mapper to map speed by starttime and station ID.
-    # Because SimpleDB can store multiple values in one attributes,
-    # we will map all the speed data of a given station within a given
-    # hour into a value of that station with the starttime as key.
-    hourly_average_speed_by_station = {}
-    group_by_args1 = []
-    group_by_args2 = []
-    group_by_args3 = []
-    for station_id, detectory_queries in loop_query_by_station.items():
-        for (detector_id, loop_query) in detectory_queries:
-            print("Query for station ID# %s" % station_id)
-            print(loop_query)
-            loop_result_iter = loop_dom.select(loop_query)
-            group_by_args1.append(station_id)
-            group_by_args2.append(detector_id)
-            group_by_args3.append(loop_result_iter)
-
-    groupers = multiprocessing.Pool(len(group_by_args1))
-    for result in groupers.map(_hourly_speed_group_by,
-                               zip(group_by_args1, group_by_args2, group_by_args3)):
-        # TODO pick one and remove the other, depend on the reduce step.
-        # save to memory
-        hourly_average_speed_by_station[result.keys()[0]] = result[result.keys()[0]]
-        # save to disc
-        if result[result.keys()[0]][1]:
-            with open('query_2_station_%s_%s_loop_hourly.txt' %
-                              (result.keys()[0], result[result.keys()[0]][0]),
-                      'w') as result_file:
-                result_file.write("\n".join("%s,%s,%s" % r for r in result[result.keys()[0]][1]))
-
-    # 5.  Reduce to starhour, travelduration
-    # TODO:  implement reducer
-    print("Still need to reduce the data.  Do it here or use AWS EMR")
-
-
-def mid_weekday_peak_period_travel_times():
+    # 3.  Map: each worker fetches the loop data of the detectors of a
+    # station found in step 2, from the loop cache if open or the hourly
+    # rollups, and adds up the speeds by hour.
+    # 4.  Reduce: merge the (count, sum, sum of squares) partials by station
+    # and hour, the memory is bounded by hours x stations and not by
+    # readings.
+    start = datetime.datetime.combine(start_date, datetime.time())
+    end = datetime.datetime.combine(end_date, datetime.time())
+    station_hours = [SpeedAccumulator(start, end, 3600)
+                     for _ in station_id_chain]
+    partitions = [(i, detector_ids_by_station_chain[station_id], start, end)
+                  for i, station_id in enumerate(station_id_chain)
+                  if detector_ids_by_station_chain[station_id]]
+    map_reduce(_hourly_station_partial, partitions,
+               lambda (i, partial): station_hours[i].merge(*partial),
+               initializer=_init_loop_worker,
+               initargs=(loop_cache.cache_dir if loop_cache else None,
+                         rollup_dom is not None))
+
+    # 5.  Reduce to starthour, travelduration.  The corridor travel time of
+    # an hour is the sum of the station travel times, complete only when
+    # every station of the chain reported that hour.
+    lengths = [metadata.station_length.get(station_id, numpy.nan)
+               for station_id in station_id_chain]
+    shape = (len(station_hours), bin_count(start, end, 3600))
+    counts = numpy.array([a.counts for a in station_hours]).reshape(shape)
+    # The hours some station reported
+    hours = numpy.flatnonzero(numpy.any(counts > 0, axis=0))
+    means = numpy.array([a.means() for a in station_hours]).reshape(shape)
+    station_times = travel_times(means[:, hours], lengths)
+    reporting = numpy.sum(~numpy.isnan(station_times), axis=0)
+    corridor_times = numpy.sum(station_times, axis=0)
+    hour_starts = to_epoch(start) + 3600 * hours
+    with open('query_2_corridor_hourly.txt', 'w') as result_file:
+        result_file.write("starthour,travel_time,stations_reporting\n")
+        for hour_start, corridor_time, station_count in zip(hour_starts,
+                                                            corridor_times,
+                                                            reporting):
+            result_file.write("%s,%s,%s\n" % (format_starttime(hour_start),
+                                              corridor_time, station_count))
+    complete = reporting == len(station_id_chain)
+    print("%s hours, %s with every station reporting" %
+          (len(hours), numpy.count_nonzero(complete)))
+    if numpy.any(complete):
+        print("Mean corridor travel time: %s" %
+              numpy.mean(corridor_times[complete]))
+
+
+def mid_weekday_peak_period_travel_times(start_date=TEST_PERIOD_START,
+                                         end_date=TEST_PERIOD_END):
     """Find the average travel time for 7-9AM and 4-6PM on Tuesdays,
     Wednesdays and Thursdays for the I-205 NB freeway during the 2-month test
     period.
     """
     print('Query c: Mid-Weekday Peak Period Travel Times')
 
-    
-    s_query1 = 'SELECT stationid, length_mid  FROM `%s` WHERE shortdirection = "N" AND highwayname ="I-205" and length_mid != ""' %STATION_DOMAIN
-    
-    
-    stations = station_dom.select(s_query1)
-        
-    sDict = {}
-    sList = []
-    for ea in stations:
-        print ea
-        sDict[ea['stationid']] = ea['length_mid']
-        sList.append(ea['stationid'])
-
-
+    peak_periods = CalendarFilter(start_date, end_date,
+                                  weekdays=(TUESDAY, WEDNESDAY, THURSDAY),
+                                  hour_windows=[(7, 9), (16, 18)])
+    weekday_count = len(peak_periods.weekdays)
+    window_count = len(peak_periods.hour_windows)
+
+    # Stations with a length and their mainline detectors from the metadata index
+    sList, dList = corridor_detectors("I-205", "N")
+    sList = [sta for sta in sList if sta in metadata.station_length]
+    station_index = dict((sta, i) for i, sta in enumerate(sList))
+    dList = [det for det in dList if metadata.detector_station[det] in station_index]
+    detector_group = dict((int(det), station_index[metadata.detector_station[det]]) for det in dList)
     stationCount = len(sList)
 
-    dList = []
-    dDict = {}
-    for ea in range(0, len(sList)):
-        detector_query = 'SELECT detectorid From `%s` WHERE stationid = "%s"' %(STATION_DOMAIN, sList[ea])
-        
-        print detector_query
-        d_query = detector_dom.select(detector_query)
-        for i in d_query:
-            dDict[i['detectorid']] = sDict[sList[ea]]
-            dList.append(i['detectorid'])
-
-
-
-
-    """#NEED TO STILL GET dLIST SOMEHOW
-    dList = [1345,1346,1347,1348,1353,1354,1355,1361,1362,1363,1369,1370,1371,1809,1810,1811,1941,1942,1943,1949,1950,1951]
-
-    detectorCount = len(dList)
-
-    #NEED TO CREAT FUNCTION FOR detector mid length dDict
-    dDict = {1345 : 0.94,1346 : 0.94,1347 : 0.94,1348 : 0.94,1353 : 1.89,1354 : 1.89,1355 : 1.89,1361 : 1.6,1362 : 1.6,1363 : 1.6,1369 : 0.86,1370 : 0.86,1371 : 0.86,1809 : 0.84,1810 : 0.84,1811 : 0.84,1941 : 2.14,1942 : 2.14,1943 : 2.14,1949 : 1.82,1950 : 1.82,1951 : 1.82}"""
-
+    # One pass over the readings of every peak window of every day, selected
+    # together and partitioned by (weekday, peak window, station)
+    cell_count = weekday_count * window_count * stationCount
+    sums = numpy.zeros(cell_count)
+    counts = numpy.zeros(cell_count, numpy.int64)
     resCount = 0
-    totalTime = 0.0
+    # The windows are whole hours, the hourly rollups fit them
+    for readings in speed_reading_chunks(
+            dList, 3600, ranges=peak_periods.time_windows()):
+        weekday_indexes, window_indexes = peak_periods.partition(readings["starttime"])
+        stations = group_indexes(readings["detectorid"], detector_group)
+        #need to determine what impact 0 speeds will have on the results
+        keep = (weekday_indexes >= 0) & (stations >= 0) & (readings["speed"] > 0)
+        reading_count = reading_counts(readings)[keep]
+        resCount += int(numpy.sum(reading_count))
+        cells = ((weekday_indexes[keep] * window_count + window_indexes[keep])
+                 * stationCount + stations[keep])
+        sums += numpy.bincount(cells, weights=readings["speed"][keep], minlength=cell_count)
+        counts += numpy.bincount(cells, weights=reading_count, minlength=cell_count).astype(numpy.int64)
+
+    # Travel time of each station, then of the corridor, by weekday and window
+    lengths = [metadata.station_length[sta] for sta in sList]
+    station_times = travel_times(mean_speeds(sums, counts).reshape(-1, stationCount).T, lengths)
+    station_times = station_times.T.reshape(weekday_count, window_count, stationCount)
+    corridor_times = numpy.sum(station_times, axis=2)
 
     file = open('results.txt', 'w')
-
-    per = "%"
-    year = 2011
-    #------------------------------------ September ------------------------------------
-    start = 258
-    month = "09"
-    begin = 15
-    end = 30
-    for day in range (begin, end):
-        if (start % 7) in [4,5,6]:
-            for det in dList:
-                for hr in  ["07","08","16","17"]:
-                    l_query = 'SELECT speed FROM `%s` WHERE detectorid = "%s" AND starttime like "%s-%s-%s %s:%s" AND speed is not null ' %(LOOP_DOMAIN, det, year, month, day, hr, per)
-                    data = loop_dom.select(l_query)
-                    for d in data:
-                        resCount += 1
-                            #need to determine what impact 0 speeds will have on the results
-                        if not (float(d['speed']) == 0):
-                            file.write('%s\n' %(float(dDict[det])/float(d['speed'])))
-                            totalTime += float(dDict[det])/float(d['speed'])
-        start += 1
-
-    #------------------------------------ October ------------------------------------
-    start = 274
-    month = 10
-    begin = 1
-    end = 31
-    for day in range (begin, end):
-        if (start % 7) in [4,5,6]:
-            for det in dList:
-                for hr in  ["07","08","16","17"]:
-                    l_query = 'SELECT speed FROM `%s` WHERE detectorid = "%s" AND starttime like "%s-%s-%s %s:%s" AND speed is not null ' %(LOOP_DOMAIN, det, year, month, day, hr, per)
-                    data = loop_dom.select(l_query)
-                    for d in data:
-                        resCount += 1
-                        #need to determine what impact 0 speeds will have on the results
-                        if not (float(d['speed']) == 0):
-                            file.write('%s\n' %(float(dDict[det])/float(d['speed'])))
-                            totalTime += float(dDict[det])/float(d['speed'])
-        start += 1
-
-    #------------------------------------ December ------------------------------------
-    start = 305
-    month = 11
-    begin = 1
-    end = 15
-    for day in range (begin, end):
-        if (start % 7) in [4,5,6]:
-            for det in dList:
-                for hr in  ["07","08","16","17"]:
-                    l_query = 'SELECT speed FROM `%s` WHERE detectorid = "%s" AND starttime like "%s-%s-%s %s:%s" AND speed is not null ' %(LOOP_DOMAIN, det, year, month, day, hr, per)
-                    data = loop_dom.select(l_query)
-                    for d in data:
-                        resCount += 1
-                        #need to determine what impact 0 speeds will have on the results
-                        if not (float(d['speed']) == 0):
-                            file.write('%s\n' %(float(dDict[det])/float(d['speed'])))
-                            totalTime += float(dDict[det])/float(d['speed'])
-        start += 1
-
+    file.write('weekday,window,station,readings,travel_time\n')
+    cell_counts = counts.reshape(weekday_count, window_count, stationCount)
+    for w, weekday in enumerate(peak_periods.weekdays):
+        for h, (first_hour, end_hour) in enumerate(peak_periods.hour_windows):
+            for i, sta in enumerate(sList):
+                file.write('%s,%s-%s,%s,%s,%s\n' %(WEEKDAY_NAMES[weekday], first_hour, end_hour, sta, cell_counts[w, h, i], station_times[w, h, i]))
     file.close()
-    #decide if running map reduce job makes sense or not
 
-    print totalTime
     print resCount
-                                          
-    print "Average Commute Time: ", totalTime/(resCount/stationCount)
-
-    
-    s_query1 = 'SELECT stationid  FROM `%s` WHERE Shortdirection = "N" AND highwayname ="I-205" and detectorclass="1"' %DETECTOR_DOMAIN
-    
-    stations = detector_dom.select(s_query1)
-        
-    sDict = {}
-    sList = []
-    for ea in stations:
-        sDict[ea['stationid']] = 0
-        sList.append(ea['stationid'])
-
-    sList2 = []
-    for ea in sList:
-        if ea not in sList2:
-            sList2.append(ea)
-
-    sList = sList2
-    stationCount = len(sList)
-
-    for ea in sList:
-        length_query = 'SELECT length_mid From `%s` WHERE itemName() = "%s"' %(STATION_DOMAIN, ea)
-        s_Length = station_dom.select(length_query)
-        for i in s_Length:
-            sDict[ea] = i['length_mid']
-
-
-    #NEED TO STILL GET dLIST SOMEHOW
-    dList = [1345,1346,1347,1348,1353,1354,1355,1361,1362,1363,1369,1370,1371,1809,1810,1811,1941,1942,1943,1949,1950,1951]
-
-    detectorCount = len(dList)
+    for h, (first_hour, end_hour) in enumerate(peak_periods.hour_windows):
+        for w, weekday in enumerate(peak_periods.weekdays):
+            print "%s %s-%s Commute Time: %s" %(WEEKDAY_NAMES[weekday], first_hour, end_hour, corridor_times[w, h])
+        print "Average %s-%s Commute Time: %s" %(first_hour, end_hour, numpy.nanmean(corridor_times[:, h]))
 
-    #NEED TO CREAT FUNCTION FOR detector mid length dDict
-    dDict = {1345 : 0.94,1346 : 0.94,1347 : 0.94,1348 : 0.94,1353 : 1.89,1354 : 1.89,1355 : 1.89,1361 : 1.6,1362 : 1.6,1363 : 1.6,1369 : 0.86,1370 : 0.86,1371 : 0.86,1809 : 0.84,1810 : 0.84,1811 : 0.84,1941 : 2.14,1942 : 2.14,1943 : 2.14,1949 : 1.82,1950 : 1.82,1951 : 1.82}
 
-    resCount = 0
-    totalTime = 0.0
-
-    file = open('results.txt', 'w')
-
-    per = "%"
-    year = 2011
-    #------------------------------------ September ------------------------------------
-    start = 258
-    month = "09"
-    begin = 15
-    end = 30
-    for day in range (begin, end):
-        if (start % 7) in [4,5,6]:
-            for det in dList:
-                for hr in  ["07","08","16","17"]:
-                    l_query = 'SELECT speed FROM `%s` WHERE detectorid = "%s" AND starttime like "%s-%s-%s %s:%s" AND speed is not null ' %(LOOP_DOMAIN, det, year, month, day, hr, per)
-                    data = loop_dom.select(l_query)
-                    for d in data:
-                        resCount += 1
-                            #need to determine what impact 0 speeds will have on the results
-                        if not (float(d['speed']) == 0):
-                            file.write('%s\n' %(float(dDict[det])/float(d['speed'])))
-                            totalTime += float(dDict[det])/float(d['speed'])
-        start += 1
-
-    #------------------------------------ October ------------------------------------
-    start = 274
-    month = 10
-    begin = 1
-    end = 31
-    for day in range (begin, end):
-        if (start % 7) in [4,5,6]:
-            for det in dList:
-                for hr in  ["07","08","16","17"]:
-                    l_query = 'SELECT speed FROM `%s` WHERE detectorid = "%s" AND starttime like "%s-%s-%s %s:%s" AND speed is not null ' %(LOOP_DOMAIN, det, year, month, day, hr, per)
-                    data = loop_dom.select(l_query)
-                    for d in data:
-                        resCount += 1
-                        #need to determine what impact 0 speeds will have on the results
-                        if not (float(d['speed']) == 0):
-                            file.write('%s\n' %(float(dDict[det])/float(d['speed'])))
-                            totalTime += float(dDict[det])/float(d['speed'])
-        start += 1
-
-    #------------------------------------ December ------------------------------------
-    start = 305
-    month = 11
-    begin = 1
-    end = 15
-    for day in range (begin, end):
-        if (start % 7) in [4,5,6]:
-            for det in dList:
-                for hr in  ["07","08","16","17"]:
-                    l_query = 'SELECT speed FROM `%s` WHERE detectorid = "%s" AND starttime like "%s-%s-%s %s:%s" AND speed is not null ' %(LOOP_DOMAIN, det, year, month, day, hr, per)
-                    data = loop_dom.select(l_query)
-                    for d in data:
-                        resCount += 1
-                        #need to determine what impact 0 speeds will have on the results
-                        if not (float(d['speed']) == 0):
-                            file.write('%s\n' %(float(dDict[det])/float(d['speed'])))
-                            totalTime += float(dDict[det])/float(d['speed'])
-        start += 1
-
-    file.close()
-    #decide if running map reduce job makes sense or not
-
-    print totalTime
-    print resCount
-                                          
-    print "Average Commute Time: ", totalTime/(resCount/stationCount)
-
-
-def station_to_station_travel_times():
+def station_to_station_travel_times(timestamps=None,
+                                     from_station_name='Sunnyside NB',
+                                     to_station_name='Columbia to I-205 NB',
+                                     highway_name='I-205', short_direction='N',
+                                     window_seconds=BIN_SECONDS):
     """Find travel time for all station-to-station NB pairs for 8AM on
     Sept 22, 2011.
+    @param: timestamps - datetimes to compute a pair matrix for, default to
+            8AM on Sept 22, 2011
+    @param: window_seconds - the speeds are averaged over this many seconds
+            from each timestamp
+    @return: array of shape (timestamps, stations, stations), the travel
+             time from the first station through the second one
     """
     print('Query d: Station-to-Station Travel Times')
-    print(NotImplemented)
-
-
-def init_conn():
-    """Initialize global variables for data connection"""
-    global conn, detector_dom, loop_dom, station_dom, detector_meta, loop_meta, station_meta
+    if timestamps is None:
+        timestamps = [datetime.datetime(2011, 9, 22, 8)]
 
+    station_id_chain, detector_ids_by_station_chain = corridor_chain(
+        from_station_name, to_station_name, highway_name, short_direction)
+    print("Station IDs chain:  %s" % (" --> ".join(station_id_chain)))
+    if not station_id_chain:
+        return numpy.empty((len(timestamps), 0, 0))
+    detector_group = dict((int(det), i)
+                          for i, station_id in enumerate(station_id_chain)
+                          for det in detector_ids_by_station_chain[station_id])
+    detector_ids = [det for station_id in station_id_chain
+                    for det in detector_ids_by_station_chain[station_id]]
+
+    # Travel time of each station segment once per timestamp, the pairs are
+    # derived from their prefix sums
+    segment_times = numpy.empty((len(timestamps), len(station_id_chain)))
+    lengths = [metadata.station_length.get(station_id, numpy.nan)
+               for station_id in station_id_chain]
+    window = datetime.timedelta(seconds=window_seconds)
+    for t, timestamp in enumerate(timestamps):
+        readings = speed_readings(detector_ids, window_seconds, timestamp,
+                                  timestamp + window)
+        sums, counts = binned_speeds(readings, detector_group,
+                                     len(station_id_chain), timestamp,
+                                     timestamp + window, window_seconds)
+        segment_times[t] = travel_times(mean_speeds(sums, counts), lengths)[:, 0]
+    pair_times = pair_travel_times(segment_times)
+
+    with open('query_4_station_to_station.txt', 'w') as result_file:
+        result_file.write("timestamp,from_station,to_station,travel_time\n")
+        for t, timestamp in enumerate(timestamps):
+            for i, from_station in enumerate(station_id_chain):
+                for j in range(i, len(station_id_chain)):
+                    result_file.write("%s,%s,%s,%s\n" % (
+                        timestamp.strftime(STARTTIME_FORMAT), from_station,
+                        station_id_chain[j], pair_times[t, i, j]))
+    for t, timestamp in enumerate(timestamps):
+        print("%s from %s to %s: %s" % (timestamp, station_id_chain[0],
+                                        station_id_chain[-1],
+                                        pair_times[t, 0, -1]))
+    return pair_times
+
+
+def _connect_to_region():
     # Store aws_access credential in Boto config file (not in source code)
     # http://boto.readthedocs.org/en/latest/boto_config_tut.html
     #   for Linux, /etc/boto.cfg or ~/.boto
     #   for Windows create BOTO_CONFIG environment variable that points to the
     #   config file
-    conn = boto.sdb.connect_to_region(AWS_WEST_OR_REGION)  #DO NOT SPECIFY KEY
+    return boto.sdb.connect_to_region(AWS_WEST_OR_REGION)  #DO NOT SPECIFY KEY
+
+
+def check_starttime_format(domain):
+    """Raise RuntimeError when the readings of a loop domain have a space
+    between the date and the time of their starttime.  Those sort below the
+    starttime ranges of select_planner, so every window would silently end
+    up a day off.  One reading of each shard is checked, an upload writes
+    them all in the same form.
+    @param: domain - the loop domain, a ShardedDomain
+    """
+    query = ("SELECT starttime FROM `%s` WHERE starttime IS NOT NULL LIMIT 1"
+             % domain.name)
+    for shard in domain.domains:
+        for item in throttled_select(shard, domain.shard_query(query, shard),
+                                     max_items=1):
+            if space_separated(item.get("starttime")):
+                raise RuntimeError(
+                    "%s was uploaded with space separated starttimes, upload "
+                    "it again with this version of aws_simpleDB_uploader"
+                    % domain.name)
+
+
+def init_conn(new_connection=None):
+    """Initialize global variables for data connection
+    @param: new_connection - a callable returning a new boto.sdb connection,
+            used here and by the worker processes, default to a connection
+            to AWS_WEST_OR_REGION.  See sdb_fake for a local stand-in.
+    """
+    global conn, detector_dom, loop_dom, station_dom, rollup_dom, detector_meta, loop_meta, station_meta, metadata, select_cache, connection_factory
+
+    connection_factory = new_connection or _connect_to_region
+    conn = connection_factory()
 
+    # Throttled requests are retried like the selects
+    throttle = shared_throttle()
     #print(conn.get_all_domains())
-    detector_dom = conn.get_domain(DETECTOR_DOMAIN)
-    loop_dom = conn.get_domain(LOOP_DOMAIN)
-    station_dom = conn.get_domain(STATION_DOMAIN)
+    detector_dom = throttle.call(conn.get_domain, DETECTOR_DOMAIN)
+    loop_dom = ShardedDomain(conn, LOOP_DOMAIN, LOOP_SHARD_COUNT)
+    check_starttime_format(loop_dom)
+    station_dom = throttle.call(conn.get_domain, STATION_DOMAIN)
 
     #print(detector_dom, loopdata_dom, station_dom)
-    detector_meta = conn.domain_metadata(detector_dom)
-    loop_meta = conn.domain_metadata(loop_dom)
-    station_meta = conn.domain_metadata(station_dom)
+    detector_meta = throttle.call(conn.domain_metadata, detector_dom)
+    loop_meta = loop_dom.get_metadata()
+    station_meta = throttle.call(conn.domain_metadata, station_dom)
+
+    # Loaded again from the domains only when their metadata changed
+    metadata = load_metadata_index(station_dom, detector_dom, station_meta,
+                                   detector_meta, METADATA_INDEX_FILE)
+
+    # Select through the cache from now on, the entries of a domain whose
+    # metadata changed are dropped
+    select_cache = SelectCache(SELECT_CACHE_DIR)
+    select_cache.validate(DETECTOR_DOMAIN, detector_meta)
+    select_cache.validate(LOOP_DOMAIN, loop_meta)
+    select_cache.validate(STATION_DOMAIN, station_meta)
+    detector_dom = CachedDomain(detector_dom, select_cache)
+    loop_dom = CachedDomain(loop_dom, select_cache)
+    station_dom = CachedDomain(station_dom, select_cache)
+
+    try:
+        rollup_dom = ShardedDomain(conn, ROLLUP_DOMAIN)
+    except boto.exception.SDBResponseError as e:
+        if is_throttling_error(e):
+            # Still throttled once the retries are exhausted
+            raise
+        # Uploaded without a rollup, the queries read the readings
+        rollup_dom = None
+    else:
+        select_cache.validate(ROLLUP_DOMAIN, rollup_dom.get_metadata())
+        rollup_dom = CachedDomain(rollup_dom, select_cache)
 
 
 def main():
@@ -551,6 +658,10 @@ def main():
     show_domains_stat()
     print("-" * 50)
 
+    # Read the loop data locally once exported, see open_loop_cache
+    if os.path.isdir(LOOP_CACHE_DIR):
+        open_loop_cache()
+
     query_top_5_samples()
     print("-" * 50)
 
@@ -573,6 +684,10 @@ def main():
     #station_to_station_travel_times()
     #print("-" * 50)
 
+    select_cache.close()
+    print("Select cache: %s hits, %s misses" % (select_cache.hits,
+                                                 select_cache.misses))
+
 
 if __name__ == '__main__':
 
@@ -0,0 +1,312 @@
+"""Upload and query benchmarks against the in-process SimpleDB of sdb_fake.
+
+    python sdb_benchmark.py --stations 8 --days 3 --latency 0.02 \\
+        --json benchmarks.jsonl
+
+Synthetic I-205 NB stations, their detectors and loop readings are generated
+from a fixed seed, the readings are uploaded with upload_to_simpleDB and each
+query of queries.py runs against the result.  Every benchmark reports its
+wall time and the SimpleDB requests it sent, and --json appends the run to a
+JSON lines file so regressions can be tracked from run to run.
+"""
+import argparse
+import bz2
+import contextlib
+import datetime
+import functools
+import gzip
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+import aws_simpleDB_uploader
+import queries
+from loop_rollup import LoopRollup
+from sdb_fake import FakeSDBConnection
+from sdb_schema import LOOP_SCHEMA
+from sdb_throttle import shared_throttle
+
+
+LOOP_COLUMNS = "detectorid,starttime,volume,speed,occupancy,status,dqflags"
+FIRST_STATION_NAME = "Sunnyside NB"
+LAST_STATION_NAME = "Columbia to I-205 NB"
+# The readings start on the day single_day_station_travel_times looks at
+READINGS_START = datetime.datetime(2011, 9, 21)
+QUERY_BENCHMARKS = ("query_top_5_samples", "single_day_station_travel_times",
+                    "hourly_corridor_travel_times",
+                    "mid_weekday_peak_period_travel_times",
+                    "station_to_station_travel_times")
+# Arguments of the queries, as main of queries.py calls them
+QUERY_ARGS = {"hourly_corridor_travel_times": {
+    "from_station_name": FIRST_STATION_NAME,
+    "to_station_name": LAST_STATION_NAME,
+    "highway_name": "I-205", "short_direction": "N"}}
+
+
+def generate_stations(station_count, seed=0):
+    """Mainline I-205 NB stations chained by their downstream attribute
+    @return: {item name: attributes}
+    """
+    rand = random.Random(seed)
+    station_ids = [str(1000 + 10 * i) for i in range(station_count)]
+    stations = {}
+    for i, station_id in enumerate(station_ids):
+        if i == 0:
+            location = FIRST_STATION_NAME
+        elif i == station_count - 1:
+            location = LAST_STATION_NAME
+        else:
+            location = "Station %s NB" % station_id
+        stations[station_id] = {
+            "stationid": station_id, "locationtext": location,
+            "highwayname": "I-205", "shortdirection": "N",
+            "stationclass": queries.STATION_CLASS_MAINLINE,
+            "length_mid": "%.2f" % rand.uniform(0.5, 2.5),
+            "downstream": (station_ids[i + 1] if i + 1 < station_count
+                           else "")}
+    return stations
+
+
+def generate_detectors(stations, detectors_per_station=3):
+    """Mainline detectors, one per lane of each station
+    @return: {item name: attributes}
+    """
+    detectors = {}
+    for station_id in sorted(stations, key=int):
+        for lane in range(detectors_per_station):
+            detector_id = str(int(station_id) + lane + 1)
+            detectors[detector_id] = {
+                "detectorid": detector_id, "stationid": station_id,
+                "detectorclass": queries.DETECTOR_CLASS_MAINLINE,
+                "lanenumber": str(lane + 1)}
+    return detectors
+
+
+def write_loop_files(out_dir, detector_ids, days, interval=20, file_count=4,
+                     seed=0, first_day=0):
+    """Append loop readings of the detectors every interval seconds from
+    first_day days after READINGS_START, as LOOP_COLUMNS lines spread across
+    file_count files.  About one reading in fifty has no speed and one in a
+    hundred a bad status, like the real data.
+    @return: the number of lines written
+    """
+    rand = random.Random(seed + first_day)
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+    handlers = [open(os.path.join(out_dir, "loop_%02d.csv" % i), "a")
+                for i in range(file_count)]
+    line_count = 0
+    first = READINGS_START + datetime.timedelta(days=first_day)
+    try:
+        for step in range(days * 86400 // interval):
+            starttime = first + datetime.timedelta(seconds=step * interval)
+            # Slower at the peak hours
+            peak = starttime.hour in (7, 8, 16, 17)
+            for detector_id in detector_ids:
+                speed = ("" if rand.random() < 0.02 else
+                         str(max(0, int(rand.gauss(35 if peak else 58, 8)))))
+                status = "1" if rand.random() < 0.01 else \
+                    queries.LOOP_STATUS_OK
+                handler = handlers[line_count % file_count]
+                handler.write("%s,%s-07,%d,%s,%d,%s,0\n" % (
+                    detector_id, starttime.strftime("%Y-%m-%dT%H:%M:%S"),
+                    rand.randint(0, 12), speed, rand.randint(0, 30), status))
+                line_count += 1
+    finally:
+        for handler in handlers:
+            handler.close()
+    return line_count
+
+
+def compress_loop_files(out_dir, compression):
+    """Move the loop files into compressed files, appended as a new gzip
+    member or bzip2 stream to the compressed file of an earlier call
+    @param: compression - "gzip" or "bz2"
+    """
+    for name in sorted(os.listdir(out_dir)):
+        if not name.endswith(".csv"):
+            continue
+        path = os.path.join(out_dir, name)
+        with open(path, "rb") as plain_handler:
+            data = plain_handler.read()
+        if compression == "gzip":
+            with gzip.open(path + ".gz", "ab") as compressed_handler:
+                compressed_handler.write(data)
+        else:
+            with open(path + ".bz2", "ab") as compressed_handler:
+                compressed_handler.write(bz2.compress(data))
+        os.remove(path)
+
+
+def put_items(sdb_conn, domain_name, items):
+    """Create the domain and put the items 25 at a time, retrying the
+    throttled requests
+    """
+    throttle = shared_throttle()
+    domain = throttle.call(sdb_conn.create_domain, domain_name)
+    names = sorted(items)
+    for i in range(0, len(names), aws_simpleDB_uploader.SIMPLE_DB_BATCH_LIMIT):
+        batch = names[i:i + aws_simpleDB_uploader.SIMPLE_DB_BATCH_LIMIT]
+        throttle.call(domain.batch_put_attributes,
+                      dict((n, items[n]) for n in batch))
+
+
+@contextlib.contextmanager
+def _quiet(verbose):
+    """Silence the progress the benchmarked code prints"""
+    if verbose:
+        yield
+        return
+    stdout = sys.stdout
+    with open(os.devnull, "w") as devnull:
+        sys.stdout = devnull
+        try:
+            yield
+        finally:
+            sys.stdout = stdout
+
+
+def measure(name, sdb_conn, func, item_count=None, verbose=False):
+    """Run func once and time it
+    @return: the benchmark result as a dict
+    """
+    requests_before = sdb_conn.request_count()
+    throttled_before = sdb_conn.throttled
+    started = time.time()
+    with _quiet(verbose):
+        func()
+    seconds = time.time() - started
+    result = {"name": name, "seconds": seconds,
+              "requests": sdb_conn.request_count() - requests_before,
+              "throttled": sdb_conn.throttled - throttled_before}
+    if item_count is not None:
+        result["items"] = item_count
+        result["items_per_second"] = item_count / seconds if seconds else None
+    return result
+
+
+def run_benchmarks(options):
+    """Generate the data, upload it and run the queries in a scratch
+    directory
+    @param: options - the parsed command line, see main
+    @return: list of benchmark results
+    """
+    sdb_conn = FakeSDBConnection(latency=options.latency,
+                                 latency_jitter=options.latency_jitter,
+                                 throttle_rate=options.throttle_rate,
+                                 page_size=options.page_size,
+                                 seed=options.seed)
+    stations = generate_stations(options.stations, options.seed)
+    detectors = generate_detectors(stations, options.detectors_per_station)
+    results = []
+    work_dir = tempfile.mkdtemp(prefix="sdb_benchmark_")
+    cwd = os.getcwd()
+    os.chdir(work_dir)
+    try:
+        put_items(sdb_conn, queries.STATION_DOMAIN, stations)
+        put_items(sdb_conn, queries.DETECTOR_DOMAIN, detectors)
+        line_count = write_loop_files(
+            "loop_data", sorted(detectors, key=int), options.days,
+            options.interval, options.files, options.seed)
+        if options.compress:
+            compress_loop_files("loop_data", options.compress)
+
+        upload = lambda: aws_simpleDB_uploader.upload_to_simpleDB(
+            sdb_conn, queries.LOOP_DOMAIN, "loop_data", LOOP_COLUMNS,
+            worker_count=options.workers, sender_count=options.senders,
+            connection_factory=lambda: sdb_conn,
+            report_interval=options.report_interval,
+            shard_count=options.shards, shard_key="detectorid",
+            rollup=LoopRollup() if options.rollup else None,
+            schema=LOOP_SCHEMA if options.schema else None,
+            delta=options.delta)
+        results.append(measure("upload_to_simpleDB", sdb_conn, upload,
+                                line_count, options.verbose))
+        if options.delta:
+            # One more day appended to every file, only it is uploaded
+            line_count = write_loop_files(
+                "loop_data", sorted(detectors, key=int), 1, options.interval,
+                options.files, options.seed, first_day=options.days)
+            if options.compress:
+                compress_loop_files("loop_data", options.compress)
+            results.append(measure("delta_upload", sdb_conn, upload,
+                                   line_count, options.verbose))
+
+        queries.LOOP_SHARD_COUNT = options.shards
+        results.append(measure("init_conn", sdb_conn,
+                               lambda: queries.init_conn(lambda: sdb_conn),
+                               verbose=options.verbose))
+        for name in options.queries:
+            query = functools.partial(getattr(queries, name),
+                                      **QUERY_ARGS.get(name, {}))
+            results.append(measure(name, sdb_conn, query,
+                                   verbose=options.verbose))
+    finally:
+        os.chdir(cwd)
+        if options.keep:
+            print("Kept the benchmark files in %s" % work_dir)
+        else:
+            shutil.rmtree(work_dir)
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--stations", type=int, default=6)
+    parser.add_argument("--detectors-per-station", type=int, default=3)
+    parser.add_argument("--days", type=int, default=2)
+    parser.add_argument("--interval", type=int, default=60,
+                        help="seconds between two readings of a detector")
+    parser.add_argument("--files", type=int, default=4)
+    parser.add_argument("--latency", type=float, default=0.0,
+                        help="seconds of every SimpleDB request")
+    parser.add_argument("--latency-jitter", type=float, default=0.0)
+    parser.add_argument("--throttle-rate", type=float, default=0.0,
+                        help="fraction of the requests throttled with a 503")
+    parser.add_argument("--page-size", type=int, default=100)
+    parser.add_argument("--shards", type=int, default=1)
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--senders", type=int,
+                        default=aws_simpleDB_uploader.SENDER_COUNT)
+    parser.add_argument("--rollup", action="store_true",
+                        help="upload the rollups too, the queries read them")
+    parser.add_argument("--schema", action="store_true",
+                        help="upload the values encoded with LOOP_SCHEMA")
+    parser.add_argument("--delta", action="store_true",
+                        help="upload a delta, then append a day and upload "
+                        "the new lines only")
+    parser.add_argument("--compress", choices=("gzip", "bz2"),
+                        help="upload the loop files compressed")
+    parser.add_argument("--report-interval", type=float, default=3600)
+    parser.add_argument("--queries", nargs="*", default=QUERY_BENCHMARKS,
+                        choices=QUERY_BENCHMARKS)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="JSON lines file to append the run to")
+    parser.add_argument("--keep", action="store_true",
+                        help="keep the generated files and results")
+    parser.add_argument("--verbose", action="store_true",
+                        help="show the output of the benchmarked code")
+    options = parser.parse_args(argv)
+
+    results = run_benchmarks(options)
+    print("%-40s %10s %10s %10s %12s" % ("benchmark", "seconds", "requests",
+                                         "throttled", "items/s"))
+    for result in results:
+        per_second = result.get("items_per_second")
+        print("%-40s %10.3f %10d %10d %12s" % (
+            result["name"], result["seconds"], result["requests"],
+            result["throttled"],
+            "%.0f" % per_second if per_second else ""))
+    if options.json:
+        with open(options.json, "a") as json_handler:
+            json_handler.write(json.dumps({
+                "time": datetime.datetime.now().isoformat(),
+                "options": vars(options), "results": results}) + "\n")
+
+
+if __name__ == "__main__":
+    main()
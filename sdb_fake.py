@@ -0,0 +1,492 @@
+"""In-process stand-in for the subset of boto.sdb the project uses.
+
+FakeSDBConnection keeps the domains in memory and implements get_domain,
+create_domain, lookup, delete_domain, batch_put_attributes, select with
+next_token pages, SELECT COUNT(*) and domain_metadata, with an optional
+latency per request, a rate of 503 throttling errors and the page size.
+Like boto, a request given a domain name rather than a domain first
+validates the domain with a select, counted as a request of its own.  The
+select expressions understood are the ones the uploader and queries.py
+send: comparisons, IN, BETWEEN, LIKE, IS [NOT] NULL, itemName(), AND, OR,
+NOT, parentheses, ORDER BY and LIMIT.  A select with more than
+MAX_COMPARISONS comparisons is rejected, each value of an IN list counting
+as one.
+
+It is meant for benchmarks and experiments without AWS credentials, see
+sdb_benchmark.py.
+"""
+import itertools
+import random
+import re
+import threading
+import time
+
+import boto.exception
+
+
+# Items of a select page without a LIMIT, and the highest LIMIT allowed
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 2500
+# Unfinished selects whose next pages are kept, the oldest are dropped
+OPEN_SELECT_LIMIT = 256
+BATCH_PUT_ITEM_LIMIT = 25
+BATCH_PUT_ATTRIBUTE_LIMIT = 256
+# Comparisons of a select, each value of an IN list is one
+MAX_COMPARISONS = 20
+
+_ERROR_BODY = ('<?xml version="1.0"?><Response><Errors><Error><Code>%s</Code>'
+               '<Message>%s</Message></Error></Errors></Response>')
+_TOKEN = re.compile(r"""\s*(?:
+    (?P<string>"(?:[^"]|"")*"|'(?:[^']|'')*')|
+    (?P<name>`(?:[^`]|``)*`)|
+    (?P<op>!=|>=|<=|=|>|<|\(|\)|,|\*)|
+    (?P<number>\d+)|
+    (?P<word>[A-Za-z_$][\w$.-]*(?:\(\))?)
+    )""", re.VERBOSE)
+
+
+def _sdb_error(status, reason, code, message):
+    return boto.exception.SDBResponseError(status, reason,
+                                           _ERROR_BODY % (code, message))
+
+
+class FakeItem(dict):
+    """A select result item, the attributes with the item name"""
+
+    def __init__(self, name, attributes):
+        dict.__init__(self, attributes)
+        self.name = name
+
+
+class FakeResultPage(list):
+    """One page of select results, like boto's ResultSet"""
+    next_token = None
+
+
+class FakeDomainMetaData(object):
+    def __init__(self, domain_name, items, timestamp):
+        self.name = domain_name
+        self.item_count = len(items)
+        self.item_names_size = sum(len(name) for name in items)
+        names = set(itertools.chain.from_iterable(items.values()))
+        self.attr_name_count = len(names)
+        self.attr_names_size = sum(len(name) for name in names)
+        values = [value for attributes in items.values()
+                  for value_list in attributes.values()
+                  for value in value_list]
+        self.attr_value_count = len(values)
+        self.attr_values_size = sum(len(value) for value in values)
+        self.timestamp = timestamp
+
+
+class FakeDomain(object):
+    """The client side of a fake domain, like a boto Domain"""
+
+    def __init__(self, connection, name):
+        self.connection = connection
+        self.name = name
+
+    def select(self, query, next_token=None, consistent_read=False,
+               max_items=None):
+        """Every page of a select, like boto's Domain.select"""
+        item_count = 0
+        while True:
+            page = self.connection.select(self, query, next_token,
+                                          consistent_read)
+            for item in page:
+                yield item
+                item_count += 1
+                if max_items is not None and item_count >= max_items:
+                    return
+            next_token = page.next_token
+            if not next_token:
+                return
+
+    def batch_put_attributes(self, items, replace=True):
+        return self.connection.batch_put_attributes(self, items, replace)
+
+    def get_metadata(self):
+        return self.connection.domain_metadata(self)
+
+
+class FakeSDBConnection(object):
+    """Thread safe in memory SimpleDB.  Share one between the threads of a
+    process, a forked process gets its own copy of the data.
+    """
+
+    def __init__(self, latency=0.0, latency_jitter=0.0, throttle_rate=0.0,
+                 page_size=DEFAULT_PAGE_SIZE, seed=None):
+        """
+        @param: latency - seconds every request waits before being answered
+        @param: latency_jitter - up to this many more seconds, at random
+        @param: throttle_rate - fraction of the requests answered with a 503
+                ServiceUnavailable error
+        @param: page_size - items of a select page without a LIMIT
+        @param: seed - seed of the random latency and throttling
+        """
+        self.latency = latency
+        self.latency_jitter = latency_jitter
+        self.throttle_rate = throttle_rate
+        self.page_size = page_size
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        # {domain name: {item name: {attribute: [values]}}}
+        self.domains = {}
+        self.timestamps = {}
+        # {request name: count}, throttled requests included
+        self.requests = {}
+        self.throttled = 0
+        self._results = {}
+        self._result_ids = itertools.count()
+
+    def _request(self, name):
+        with self.lock:
+            self.requests[name] = self.requests.get(name, 0) + 1
+            delay = self.latency + self.random.uniform(0, self.latency_jitter)
+            throttled = self.random.random() < self.throttle_rate
+            if throttled:
+                self.throttled += 1
+        if delay > 0:
+            time.sleep(delay)
+        if throttled:
+            raise _sdb_error(503, "Service Unavailable", "ServiceUnavailable",
+                             "Service AmazonSimpleDB is currently unavailable")
+
+    def _validated(self, domain_or_name):
+        """The domain of a request, validated with a select when given by
+        name, like boto's get_domain_and_name
+        """
+        if isinstance(domain_or_name, FakeDomain):
+            return domain_or_name
+        return self.get_domain(domain_or_name)
+
+    def _domain_name(self, domain_or_name):
+        name = getattr(domain_or_name, "name", domain_or_name)
+        if name not in self.domains:
+            raise _sdb_error(400, "Bad Request", "NoSuchDomain",
+                             "The specified domain does not exist.")
+        return name
+
+    def request_count(self):
+        with self.lock:
+            return sum(self.requests.values())
+
+    def get_all_domains(self):
+        self._request("ListDomains")
+        return [FakeDomain(self, name) for name in sorted(self.domains)]
+
+    def get_domain(self, domain_name, validate=True):
+        if validate:
+            self._request("Select")
+            self._domain_name(domain_name)
+        return FakeDomain(self, domain_name)
+
+    def lookup(self, domain_name, validate=True):
+        try:
+            return self.get_domain(domain_name, validate)
+        except boto.exception.SDBResponseError:
+            return None
+
+    def create_domain(self, domain_name):
+        self._request("CreateDomain")
+        with self.lock:
+            if domain_name not in self.domains:
+                self.domains[domain_name] = {}
+                self.timestamps[domain_name] = int(time.time())
+        return FakeDomain(self, domain_name)
+
+    def delete_domain(self, domain_or_name):
+        domain_or_name = self._validated(domain_or_name)
+        self._request("DeleteDomain")
+        with self.lock:
+            name = getattr(domain_or_name, "name", domain_or_name)
+            self.domains.pop(name, None)
+            self.timestamps.pop(name, None)
+        return True
+
+    def domain_metadata(self, domain_or_name):
+        domain_or_name = self._validated(domain_or_name)
+        self._request("DomainMetadata")
+        with self.lock:
+            name = self._domain_name(domain_or_name)
+            return FakeDomainMetaData(name, self.domains[name],
+                                      self.timestamps[name])
+
+    def batch_put_attributes(self, domain_or_name, items, replace=True):
+        """@param: items - {item name: {attribute: value or list of values}}"""
+        domain_or_name = self._validated(domain_or_name)
+        self._request("BatchPutAttributes")
+        if len(items) > BATCH_PUT_ITEM_LIMIT:
+            raise _sdb_error(400, "Bad Request", "NumberSubmittedItemsExceeded",
+                             "Too many items in a single call.")
+        for attributes in items.values():
+            if sum(len(_values(v)) for v in attributes.values()) > \
+                    BATCH_PUT_ATTRIBUTE_LIMIT:
+                raise _sdb_error(400, "Bad Request",
+                                 "NumberSubmittedAttributesExceeded",
+                                 "Too many attributes for item in a single "
+                                 "call.")
+        with self.lock:
+            name = self._domain_name(domain_or_name)
+            domain = self.domains[name]
+            for item_name, attributes in items.items():
+                item = domain.setdefault(item_name, {})
+                for attribute, value in attributes.items():
+                    values = [unicode(v) for v in _values(value)]
+                    if replace or attribute not in item:
+                        item[attribute] = values
+                    else:
+                        item[attribute].extend(v for v in values
+                                               if v not in item[attribute])
+            self.timestamps[name] = int(time.time())
+        return True
+
+    def select(self, domain_or_name, query, next_token=None,
+               consistent_read=False):
+        """One page of the select, next_token of the page is set when more
+        items follow
+        """
+        domain_or_name = self._validated(domain_or_name)
+        self._request("Select")
+        with self.lock:
+            if next_token:
+                result_id, offset = next_token.split(":")
+                result_id, offset = int(result_id), int(offset)
+                if result_id not in self._results:
+                    raise _sdb_error(400, "Bad Request", "InvalidNextToken",
+                                     "The specified next token is not valid.")
+                results, page_size = self._results[result_id]
+            else:
+                select = _parse_select(query)
+                name = self._domain_name(select["domain"])
+                results = _run_select(select, self.domains[name])
+                page_size = min(select["limit"] or self.page_size,
+                                MAX_PAGE_SIZE)
+                result_id = next(self._result_ids)
+                offset = 0
+            page = FakeResultPage(results[offset:offset + page_size])
+            offset += page_size
+            if offset < len(results):
+                self._results[result_id] = (results, page_size)
+                page.next_token = "%s:%s" % (result_id, offset)
+                if len(self._results) > OPEN_SELECT_LIMIT:
+                    del self._results[min(self._results)]
+            else:
+                self._results.pop(result_id, None)
+        return page
+
+
+def _values(value):
+    return value if isinstance(value, (list, tuple, set)) else [value]
+
+
+def _tokenize(query):
+    tokens = []
+    position = 0
+    query = query.strip()
+    while position < len(query):
+        match = _TOKEN.match(query, position)
+        if not match or match.end() == position:
+            raise _sdb_error(400, "Bad Request", "InvalidQueryExpression",
+                             "The specified query expression syntax is not "
+                             "valid: %s" % query[position:])
+        position = match.end()
+        kind = match.lastgroup
+        text = match.group(kind)
+        if kind == "string":
+            tokens.append(("string", text[1:-1].replace(text[0] * 2, text[0])))
+        elif kind == "name":
+            tokens.append(("name", text[1:-1].replace("``", "`")))
+        elif kind == "number":
+            tokens.append(("number", text))
+        elif kind == "word" and text.upper() in _KEYWORDS:
+            tokens.append(("keyword", text.upper()))
+        elif kind == "word":
+            tokens.append(("name", text))
+        else:
+            tokens.append(("op", text))
+    return tokens
+
+
+_KEYWORDS = frozenset(["SELECT", "FROM", "WHERE", "AND", "OR", "NOT", "IN",
+                       "BETWEEN", "LIKE", "IS", "NULL", "ORDER", "BY", "ASC",
+                       "DESC", "LIMIT", "COUNT", "EVERY"])
+
+
+class _Parser(object):
+    def __init__(self, query):
+        self.tokens = _tokenize(query)
+        self.position = 0
+        self.comparisons = 0
+
+    def peek(self, kind=None, text=None):
+        if self.position >= len(self.tokens):
+            return False
+        token_kind, token_text = self.tokens[self.position]
+        return ((kind is None or token_kind == kind) and
+                (text is None or token_text == text))
+
+    def take(self, kind=None, text=None):
+        if not self.peek(kind, text):
+            raise _sdb_error(400, "Bad Request", "InvalidQueryExpression",
+                             "Expected %s %s at token %s"
+                             % (kind, text, self.position))
+        self.position += 1
+        return self.tokens[self.position - 1][1]
+
+    def select(self):
+        self.take("keyword", "SELECT")
+        output = []
+        count = False
+        if self.peek("keyword", "COUNT"):
+            self.take()
+            self.take("op", "(")
+            self.take("op", "*")
+            self.take("op", ")")
+            count = True
+        elif self.peek("op", "*"):
+            self.take()
+        else:
+            output.append(self.take("name"))
+            while self.peek("op", ","):
+                self.take()
+                output.append(self.take("name"))
+        self.take("keyword", "FROM")
+        domain = self.take("name")
+        where = None
+        if self.peek("keyword", "WHERE"):
+            self.take()
+            where = self.disjunction()
+        order = None
+        if self.peek("keyword", "ORDER"):
+            self.take()
+            self.take("keyword", "BY")
+            attribute = self.take("name")
+            descending = False
+            if self.peek("keyword", "DESC") or self.peek("keyword", "ASC"):
+                descending = self.take() == "DESC"
+            order = (attribute, descending)
+        limit = None
+        if self.peek("keyword", "LIMIT"):
+            self.take()
+            limit = int(self.take("number"))
+        if self.position != len(self.tokens):
+            raise _sdb_error(400, "Bad Request", "InvalidQueryExpression",
+                             "Unexpected %s" % (self.tokens[self.position],))
+        if self.comparisons > MAX_COMPARISONS:
+            raise _sdb_error(400, "Bad Request", "InvalidQueryExpression",
+                             "Too many comparisons, %s over %s"
+                             % (self.comparisons, MAX_COMPARISONS))
+        return {"output": output, "count": count, "domain": domain,
+                "where": where, "order": order, "limit": limit}
+
+    def disjunction(self):
+        terms = [self.conjunction()]
+        while self.peek("keyword", "OR"):
+            self.take()
+            terms.append(self.conjunction())
+        if len(terms) == 1:
+            return terms[0]
+        return lambda name, item: any(t(name, item) for t in terms)
+
+    def conjunction(self):
+        terms = [self.negation()]
+        while self.peek("keyword", "AND"):
+            self.take()
+            terms.append(self.negation())
+        if len(terms) == 1:
+            return terms[0]
+        return lambda name, item: all(t(name, item) for t in terms)
+
+    def negation(self):
+        if self.peek("keyword", "NOT"):
+            self.take()
+            term = self.negation()
+            return lambda name, item: not term(name, item)
+        if self.peek("op", "("):
+            self.take()
+            term = self.disjunction()
+            self.take("op", ")")
+            return term
+        return self.comparison()
+
+    def comparison(self):
+        attribute = self.take("name")
+        if not self.peek("keyword", "IN"):
+            self.comparisons += 1
+        if attribute == "itemName()":
+            values_of = lambda name, item: [name]
+        else:
+            values_of = lambda name, item: item.get(attribute, [])
+        if self.peek("keyword", "IS"):
+            self.take()
+            not_null = self.peek("keyword", "NOT")
+            if not_null:
+                self.take()
+            self.take("keyword", "NULL")
+            return lambda name, item: bool(values_of(name, item)) == not_null
+        if self.peek("keyword", "IN"):
+            self.take()
+            self.take("op", "(")
+            choices = set([self.take("string")])
+            while self.peek("op", ","):
+                self.take()
+                choices.add(self.take("string"))
+            self.take("op", ")")
+            self.comparisons += len(choices)
+            return lambda name, item: any(v in choices
+                                          for v in values_of(name, item))
+        if self.peek("keyword", "BETWEEN"):
+            self.take()
+            low = self.take("string")
+            self.take("keyword", "AND")
+            high = self.take("string")
+            return lambda name, item: any(low <= v <= high
+                                          for v in values_of(name, item))
+        if self.peek("keyword", "LIKE"):
+            self.take()
+            pattern = re.compile("^%s$" % ".*".join(
+                re.escape(part) for part in self.take("string").split("%")),
+                re.DOTALL)
+            return lambda name, item: any(pattern.match(v)
+                                          for v in values_of(name, item))
+        operator = _OPERATORS[self.take("op")]
+        value = self.take("string")
+        return lambda name, item: any(operator(v, value)
+                                      for v in values_of(name, item))
+
+
+_OPERATORS = {"=": lambda a, b: a == b, "!=": lambda a, b: a != b,
+              ">": lambda a, b: a > b, ">=": lambda a, b: a >= b,
+              "<": lambda a, b: a < b, "<=": lambda a, b: a <= b}
+
+
+def _parse_select(query):
+    return _Parser(query).select()
+
+
+def _run_select(select, items):
+    """The result items of a parsed select over {item name: attributes}"""
+    where = select["where"]
+    names = [name for name in sorted(items)
+             if where is None or where(name, items[name])]
+    if select["order"]:
+        attribute, descending = select["order"]
+        names.sort(key=lambda name: items[name].get(attribute, [u""])[0],
+                   reverse=descending)
+    if select["count"]:
+        count = len(names)
+        if select["limit"]:
+            count = min(count, select["limit"])
+        return [FakeItem("Domain", {"Count": str(count)})]
+    results = []
+    for name in names:
+        attributes = items[name]
+        if select["output"]:
+            attributes = dict((a, attributes[a]) for a in select["output"]
+                              if a in attributes)
+        # Single values as strings, like boto
+        results.append(FakeItem(name, dict(
+            (a, v[0] if len(v) == 1 else list(v))
+            for a, v in attributes.items())))
+    return results
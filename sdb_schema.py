@@ -0,0 +1,184 @@
+"""Order-preserving typed encoding of SimpleDB attribute values.
+
+SimpleDB stores and compares every value as a string, so "9" > "55" and a
+numeric predicate only works on values of the same width.  A Schema maps
+attribute names to types whose encoded strings sort like the values they
+stand for:
+    IntegerType     zero-padded to a fixed number of digits, plus an offset
+                    so negative values sort below the positive ones
+    DecimalType     the same with a fixed number of decimals
+    TimestampType   TIMESTAMP_FORMAT, any time zone suffix dropped
+The uploader encodes the items with a schema, see upload_to_simpleDB, so
+predicates such as speed > 0, starttime ranges and ORDER BY run on the
+server.  Without a schema it still puts a "T" in the starttime, see
+normalize_separator, the ranges compare with that form.  With no offset a
+decoded value is what float() or int() of the encoded string reads, so items
+uploaded without the schema still decode.
+"""
+import calendar
+import datetime
+import time
+
+
+# Timestamps sort like the times they stand for in this format
+TIMESTAMP_FORMAT = "%Y-%m-%dT%H:%M:%S"
+
+
+def parse_starttime(value):
+    """Seconds since the epoch of a starttime string, taken as UTC so no DST
+    shift applies.  Accepts a "T" or a space between the date and the time.
+    """
+    value = value[:19].replace(" ", "T")
+    return calendar.timegm(time.strptime(value, TIMESTAMP_FORMAT))
+
+
+def format_starttime(epoch):
+    """The starttime string of seconds since the epoch"""
+    return time.strftime(TIMESTAMP_FORMAT, time.gmtime(epoch))
+
+
+def space_separated(value):
+    """True for a timestamp string with a space between the date and the
+    time, which sorts below the TIMESTAMP_FORMAT strings of its day
+    """
+    return (isinstance(value, basestring) and len(value) >= 19 and
+            value[4] == "-" and value[10] == " " and value[13] == ":")
+
+
+def normalize_separator(value):
+    """A timestamp string with a "T" between the date and the time and the
+    rest, such as a time zone suffix, kept.  Anything else is unchanged.
+    """
+    if space_separated(value):
+        return "%sT%s" % (value[:10], value[11:])
+    return value
+
+
+def to_epoch(moment):
+    """Seconds since the epoch of a datetime.datetime, a starttime string or
+    a number, None stays None
+    """
+    if moment is None or isinstance(moment, (int, long, float)):
+        return moment
+    if isinstance(moment, datetime.datetime):
+        return calendar.timegm(moment.timetuple())
+    return parse_starttime(moment)
+
+
+class IntegerType(object):
+    """Integers in [-offset, 10 ** digits - offset)"""
+
+    def __init__(self, digits, offset=0):
+        self.digits = digits
+        self.offset = offset
+
+    def encode(self, value):
+        shifted = int(value) + self.offset
+        if not 0 <= shifted < 10 ** self.digits:
+            raise ValueError("%s out of the %s digits range" %
+                             (value, self.digits))
+        return "%0*d" % (self.digits, shifted)
+
+    def decode(self, text):
+        return int(text) - self.offset
+
+
+class DecimalType(object):
+    """Numbers rounded to scale decimals in [-offset, 10 ** digits - offset)"""
+
+    def __init__(self, digits, scale, offset=0):
+        self.digits = digits
+        self.scale = scale
+        self.offset = offset
+
+    def encode(self, value):
+        shifted = round(float(value) + self.offset, self.scale)
+        if not 0 <= shifted < 10 ** self.digits:
+            raise ValueError("%s out of the %s digits range" %
+                             (value, self.digits))
+        return "%0*.*f" % (self.digits + 1 + self.scale, self.scale, shifted)
+
+    def decode(self, text):
+        return float(text) - self.offset
+
+
+class TimestampType(object):
+    """Timestamps as TIMESTAMP_FORMAT strings, decoded to seconds since the
+    epoch
+    """
+
+    def encode(self, value):
+        if (isinstance(value, basestring) and len(value) >= 19 and
+                value[4] == "-" and value[10] in " T" and value[13] == ":"):
+            # Already in the format, short of the separator and time zone
+            return "%sT%s" % (value[:10], value[11:19])
+        return format_starttime(to_epoch(value))
+
+    def decode(self, text):
+        return parse_starttime(text)
+
+
+class Schema(object):
+    """Types of some attributes of a domain, the others are left as is"""
+
+    def __init__(self, types):
+        """
+        @param: types - {attribute name: IntegerType, DecimalType or
+                TimestampType}
+        """
+        self.types = types
+
+    def encode_value(self, name, value):
+        """The encoded string of a value of an attribute, e.g. to compare
+        the attribute to in a predicate.  Raise ValueError when the value
+        does not fit the type.
+        """
+        attribute_type = self.types.get(name)
+        if attribute_type is None:
+            return value
+        return attribute_type.encode(value)
+
+    def decode_value(self, name, text):
+        """The typed value of an encoded string, None when empty"""
+        attribute_type = self.types.get(name)
+        if attribute_type is None:
+            return text
+        if text is None or text == "":
+            return None
+        return attribute_type.decode(text)
+
+    def encode_item(self, item):
+        """Encode the typed attributes of an item in place.  Empty values
+        stay empty, values that do not fit their type are emptied.
+        @param: item - {attribute name: value}
+        @return: the number of values emptied
+        """
+        invalid = 0
+        for name, attribute_type in self.types.items():
+            value = item.get(name)
+            if value is None or value == "":
+                continue
+            try:
+                item[name] = attribute_type.encode(value)
+            except (TypeError, ValueError):
+                item[name] = ""
+                invalid += 1
+        return invalid
+
+    def decode_item(self, item):
+        """A copy of an item with the typed attributes decoded, None for the
+        empty ones
+        """
+        decoded = dict(item)
+        for name in self.types:
+            if name in decoded:
+                decoded[name] = self.decode_value(name, decoded[name])
+        return decoded
+
+
+# Schema of the loop readings, detectorid and status are only compared for
+# equality and stay as uploaded
+LOOP_SCHEMA = Schema({"starttime": TimestampType(),
+                      "speed": DecimalType(4, 2),
+                      "volume": IntegerType(6),
+                      "occupancy": DecimalType(4, 2)})
@@ -0,0 +1,269 @@
+"""Persistent cache of SimpleDB select results.
+
+CachedDomain wraps a boto Domain or a ShardedDomain and answers its selects
+from files in a cache directory when the same select ran before against the
+same version of the domain.  Entries are keyed by the domain, the select with
+its whitespace normalized, the consistency flag and max_items.  The version
+of a domain is its item count and timestamp from domain_metadata: once they
+change every entry of the domain is dropped.  The least recently used
+entries are evicted to keep the cache under max_bytes.
+
+Entries are JSON lines, one item per line, written to a temp file as the
+select streams and renamed into place once it is consumed to the end, and
+read back line by line, so neither a miss nor a hit holds the result in
+memory.
+"""
+import hashlib
+import json
+import os
+import threading
+import time
+
+from metadata_index import domain_stamp
+from sdb_throttle import throttled_select
+
+
+SELECT_CACHE_DIR = ".select_cache"
+SELECT_CACHE_MAX_BYTES = 256 * 1024 * 1024
+_INDEX_FILE = "index.json"
+_QUOTES = "\"'`"
+
+
+def normalize_query(query):
+    """The select with runs of whitespace outside quotes collapsed, so
+    queries differing only by layout share an entry
+    """
+    normalized = []
+    quote = None
+    space = False
+    for char in query.strip():
+        if quote:
+            normalized.append(char)
+            if char == quote:
+                quote = None
+        elif char.isspace():
+            space = True
+        else:
+            if space:
+                normalized.append(" ")
+                space = False
+            normalized.append(char)
+            if char in _QUOTES:
+                quote = char
+    return "".join(normalized)
+
+
+class CachedItem(dict):
+    """An item read back from the cache, the attributes with the item name"""
+
+    def __init__(self, name, attributes):
+        dict.__init__(self, attributes)
+        self.name = name
+
+
+class SelectCache(object):
+    """Select results on disk, one JSON lines file per entry and an index of
+    the entries with their domain version, size and last use
+    """
+
+    def __init__(self, cache_dir=SELECT_CACHE_DIR,
+                 max_bytes=SELECT_CACHE_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        # {key: {"domain": name, "stamp": stamp, "bytes": size, "used": time}}
+        self.entries = {}
+        # {domain name: stamp} of the domains validated by this process, the
+        # entries of the others are not served
+        self.stamps = {}
+        index_path = os.path.join(cache_dir, _INDEX_FILE)
+        if os.path.isfile(index_path):
+            try:
+                with open(index_path) as index_handler:
+                    self.entries = json.load(index_handler)["entries"]
+            except (KeyError, ValueError):
+                pass
+
+    def validate(self, domain_name, domain_meta):
+        """Record the current version of a domain and drop its entries of
+        another version
+        @param: domain_meta - the domain metadata from
+                connection.domain_metadata or ShardedDomain.get_metadata
+        """
+        stamp = domain_stamp(domain_meta)
+        with self.lock:
+            self.stamps[domain_name] = stamp
+            stale = [key for key, entry in self.entries.items()
+                     if entry["domain"] == domain_name and
+                     entry["stamp"] != stamp]
+            for key in stale:
+                self._remove(key)
+            if stale:
+                self._save_index()
+        return len(stale)
+
+    def key(self, domain_name, queries, consistent_read, max_items,
+            ordered=False):
+        if isinstance(queries, basestring):
+            queries = [queries]
+        text = "\0".join([domain_name, str(bool(consistent_read)),
+                          str(max_items), str(bool(ordered))] +
+                         [normalize_query(q) for q in queries])
+        return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+    def open_entry(self, key):
+        """The open file of the cached items of the key, None when missing or
+        stale
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if (entry is None or
+                    entry["stamp"] != self.stamps.get(entry["domain"])):
+                self.misses += 1
+                return None
+            try:
+                # An entry evicted while it is read stays readable once open
+                entry_handler = open(self._path(key))
+            except IOError:
+                self._remove(key)
+                self.misses += 1
+                return None
+            entry["used"] = time.time()
+            self.hits += 1
+        return entry_handler
+
+    def store(self, key, domain_name, items):
+        """Write the items of the key to a temp file as they come and store
+        it once items is exhausted, unless they alone exceed max_bytes
+        @param: items - iterator of the items
+        @yield: items
+        """
+        temp_path = "%s.%s.%s.tmp" % (self._path(key), os.getpid(),
+                                      threading.current_thread().ident)
+        temp_handler = open(temp_path, "w")
+        size = 0
+        try:
+            for item in items:
+                if temp_handler is not None:
+                    line = "%s\n" % json.dumps([getattr(item, "name", None),
+                                                dict(item)])
+                    size += len(line)
+                    if size > self.max_bytes:
+                        temp_handler.close()
+                        os.remove(temp_path)
+                        temp_handler = None
+                    else:
+                        temp_handler.write(line)
+                yield item
+            if temp_handler is not None:
+                temp_handler.close()
+                temp_handler = None
+                self._commit(key, domain_name, temp_path, size)
+        finally:
+            # Abandoned or failed half way, the partial entry is dropped
+            if temp_handler is not None:
+                temp_handler.close()
+                os.remove(temp_path)
+
+    def cached(self, domain_name, queries, consistent_read, max_items, fetch,
+               ordered=False):
+        """Items of the queries from the cache, otherwise from fetch() and
+        stored once fetch is consumed to the end
+        @param: fetch - function returning an iterator of the items
+        @param: ordered - whether the items of several queries come in query
+                order, part of the key
+        @yield: items
+        """
+        key = self.key(domain_name, queries, consistent_read, max_items,
+                       ordered)
+        entry_handler = self.open_entry(key)
+        if entry_handler is not None:
+            with entry_handler:
+                for line in entry_handler:
+                    name, attributes = json.loads(line)
+                    yield CachedItem(name, attributes)
+            return
+        for item in self.store(key, domain_name, fetch()):
+            yield item
+
+    def close(self):
+        """Save the last use of the entries"""
+        with self.lock:
+            self._save_index()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, "%s.jsonl" % key)
+
+    def _commit(self, key, domain_name, temp_path, size):
+        with self.lock:
+            if domain_name not in self.stamps:
+                # A domain never validated has no known version to tie to
+                os.remove(temp_path)
+                return False
+            os.rename(temp_path, self._path(key))
+            self.entries[key] = {"domain": domain_name,
+                                 "stamp": self.stamps[domain_name],
+                                 "bytes": size, "used": time.time()}
+            self._evict()
+            self._save_index()
+        return True
+
+    def _remove(self, key):
+        self.entries.pop(key, None)
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass
+
+    def _evict(self):
+        total = sum(entry["bytes"] for entry in self.entries.values())
+        for key, entry in sorted(self.entries.items(),
+                                 key=lambda e: e[1]["used"]):
+            if total <= self.max_bytes:
+                break
+            total -= entry["bytes"]
+            self._remove(key)
+
+    def _save_index(self):
+        index_path = os.path.join(self.cache_dir, _INDEX_FILE)
+        with open("%s.tmp" % index_path, "w") as index_handler:
+            json.dump({"entries": self.entries}, index_handler)
+        os.rename("%s.tmp" % index_path, index_path)
+
+
+class CachedDomain(object):
+    """A boto Domain or ShardedDomain whose selects go through a SelectCache,
+    everything else is passed through to the domain
+    """
+
+    def __init__(self, domain, cache):
+        self.domain = domain
+        self.cache = cache
+
+    def __getattr__(self, name):
+        return getattr(self.domain, name)
+
+    def select(self, query, max_items=None, consistent_read=False):
+        if hasattr(self.domain, "select_many"):
+            fetch = lambda: self.domain.select(query, max_items,
+                                               consistent_read)
+        else:
+            fetch = lambda: throttled_select(self.domain, query, max_items,
+                                             consistent_read)
+        return self.cache.cached(self.domain.name, query, consistent_read,
+                                 max_items, fetch)
+
+    def select_many(self, queries, max_items=None, consistent_read=False,
+                    max_workers=None, ordered=False):
+        """The partitions of a query are cached together, in the order they
+        were fetched the first time
+        """
+        fetch = lambda: self.domain.select_many(queries, max_items,
+                                                consistent_read, max_workers,
+                                                ordered)
+        return self.cache.cached(self.domain.name, queries, consistent_read,
+                                 max_items, fetch, ordered)
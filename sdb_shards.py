@@ -0,0 +1,211 @@
+"""Hash-sharded SimpleDB domains.
+
+A logical domain such as TeamA_Loop is stored across shard_count physical
+domains, TeamA_Loop_0 .. TeamA_Loop_<n-1>, picked by a stable hash of a shard
+key (the item name or an attribute such as detectorid).  A single shard keeps
+the logical name so unsharded domains need no change.
+
+ShardedDomain stands in for a boto Domain on the query side: select sends the
+query to every shard in parallel and streams back the merged items, and
+select_many does the same for the partitions of a query so a long scan is
+not limited to one page round trip at a time.
+"""
+import Queue
+import threading
+import zlib
+
+from sdb_throttle import shared_throttle, throttled_select
+
+
+# Items buffered from the shards before the fetching threads wait for the
+# consumer to catch up
+FAN_OUT_QUEUE_DEPTH = 1000
+# Seconds between checks for an abandoned fan out by a waiting thread
+_FAN_OUT_POLL = 0.5
+
+_SHARD_DONE = object()
+
+
+def shard_domain_names(domain_name, shard_count):
+    """Names of the physical domains of a logical domain"""
+    if shard_count <= 1:
+        return [domain_name]
+    return ["%s_%d" % (domain_name, i) for i in range(shard_count)]
+
+
+def shard_index(shard_value, shard_count):
+    """Stable shard of a value, same in every process and Python version"""
+    if shard_count <= 1:
+        return 0
+    if isinstance(shard_value, unicode):
+        shard_value = shard_value.encode("utf-8")
+    return (zlib.crc32(str(shard_value)) & 0xffffffff) % shard_count
+
+
+class _FanOutError(object):
+    """Carries an exception of a fetching thread to the consumer"""
+    __slots__ = ("error",)
+
+    def __init__(self, error):
+        self.error = error
+
+
+def fan_out_select(domain_queries, max_items=None, consistent_read=False,
+                   throttle=None, max_workers=None, ordered=False):
+    """Run several selects concurrently and yield their items as one stream.
+    The fetching threads block once FAN_OUT_QUEUE_DEPTH items of a stream
+    wait for the consumer, and stop when the consumer stops iterating.
+    @param: domain_queries - a list of (boto Domain, query)
+    @param: max_items - stop after this many items in total, None for all
+    @param: consistent_read - set to True for consistent read
+    @param: throttle - an AdaptiveThrottle shared by all the pages of all
+            the selects, default to shared_throttle()
+    @param: max_workers - threads fetching at once, each takes the next
+            select once done with one, default to one thread per select
+    @param: ordered - set to True to yield the items of each select after
+            those of the selects before it, sorted output when the selects
+            are disjoint ranges in order.  The selects after the current one
+            are still fetched ahead, FAN_OUT_QUEUE_DEPTH items each at most.
+    @yield: items, in select order if ordered, otherwise as they arrive
+    """
+    if not domain_queries:
+        return
+    throttle = throttle or shared_throttle()
+    if ordered:
+        streams = [Queue.Queue(FAN_OUT_QUEUE_DEPTH) for _ in domain_queries]
+    else:
+        streams = [Queue.Queue(FAN_OUT_QUEUE_DEPTH)] * len(domain_queries)
+    tasks = Queue.Queue()
+    for task in enumerate(domain_queries):
+        tasks.put(task)
+    abandoned = threading.Event()
+
+    def put(results, value):
+        while not abandoned.is_set():
+            try:
+                results.put(value, timeout=_FAN_OUT_POLL)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    def fetch():
+        while not abandoned.is_set():
+            try:
+                index, (domain, query) = tasks.get_nowait()
+            except Queue.Empty:
+                return
+            results = streams[index]
+            try:
+                for item in throttled_select(domain, query,
+                                             consistent_read=consistent_read,
+                                             throttle=throttle):
+                    if not put(results, item):
+                        return
+            except Exception as e:
+                put(results, _FanOutError(e))
+            finally:
+                put(results, _SHARD_DONE)
+
+    worker_count = min(max_workers or len(domain_queries), len(domain_queries))
+    fetchers = [threading.Thread(target=fetch) for _ in range(worker_count)]
+    for fetcher in fetchers:
+        fetcher.daemon = True
+        fetcher.start()
+    if ordered:
+        # One done marker per stream, consumed in select order
+        consumed = [(results, 1) for results in streams]
+    else:
+        consumed = [(streams[0], len(domain_queries))]
+    try:
+        item_count = 0
+        for results, running in consumed:
+            while running:
+                item = results.get()
+                if item is _SHARD_DONE:
+                    running -= 1
+                elif isinstance(item, _FanOutError):
+                    raise item.error
+                else:
+                    yield item
+                    item_count += 1
+                    if max_items is not None and item_count >= max_items:
+                        return
+        # Every select is done, the fetchers are only left to exit
+        for fetcher in fetchers:
+            fetcher.join()
+    finally:
+        abandoned.set()
+
+
+class ShardedDomainMetaData(object):
+    """Sum of the boto DomainMetaData of the shards"""
+    _SUMMED = ("item_count", "item_names_size", "attr_name_count",
+               "attr_names_size", "attr_value_count", "attr_values_size")
+
+    def __init__(self, shard_metadata):
+        for attr in self._SUMMED:
+            setattr(self, attr, sum(int(getattr(m, attr) or 0)
+                                    for m in shard_metadata))
+        # The most recent shard timestamp
+        self.timestamp = max(getattr(m, "timestamp", None)
+                             for m in shard_metadata)
+
+
+class ShardedDomain(object):
+    """Query side of a logical domain stored across hash shards, a drop in for
+    the boto Domain select and get_metadata.
+    """
+
+    def __init__(self, connection, domain_name, shard_count=1, throttle=None):
+        """
+        @param: connection - a boto.sdb connection
+        @param: domain_name - the logical domain name used in the queries
+        @param: shard_count - the number of shards of the domain
+        @param: throttle - an AdaptiveThrottle, default to shared_throttle()
+        """
+        self.connection = connection
+        self.name = domain_name
+        self.throttle = throttle
+        self.domains = [(throttle or shared_throttle()).call(
+                            connection.get_domain, name)
+                        for name in shard_domain_names(domain_name,
+                                                       shard_count)]
+
+    def shard_query(self, query, shard_domain):
+        """Rewrite the query of the logical domain for one shard"""
+        if shard_domain.name == self.name:
+            return query
+        return query.replace("`%s`" % self.name, "`%s`" % shard_domain.name)
+
+    def select(self, query, max_items=None, consistent_read=False):
+        """Send the query to every shard in parallel.  SELECT COUNT(*) yields
+        one count item per shard, add them up.
+        @yield: items of all the shards
+        """
+        if len(self.domains) == 1:
+            return throttled_select(self.domains[0], query, max_items,
+                                    consistent_read, self.throttle)
+        return fan_out_select([(d, self.shard_query(query, d))
+                               for d in self.domains],
+                              max_items, consistent_read, self.throttle)
+
+    def select_many(self, queries, max_items=None, consistent_read=False,
+                    max_workers=None, ordered=False):
+        """Send disjoint partitions of a query to every shard at once, see
+        fan_out_select
+        @param: queries - selects of the logical domain, e.g. from
+                select_planner.partition_query
+        @param: ordered - set to True to yield the items of each query after
+                those of the queries before it
+        @yield: items of all the queries and shards
+        """
+        return fan_out_select([(d, self.shard_query(query, d))
+                               for query in queries for d in self.domains],
+                              max_items, consistent_read, self.throttle,
+                              max_workers, ordered)
+
+    def get_metadata(self):
+        throttle = self.throttle or shared_throttle()
+        return ShardedDomainMetaData([throttle.call(
+            self.connection.domain_metadata, d) for d in self.domains])
@@ -0,0 +1,246 @@
+"""Counters and latency histograms of the SimpleDB upload, per worker.
+
+Each worker, a parser process or a sender thread, records into its own
+WorkerMetrics.  Parser processes send theirs back with each finished work
+unit as a plain dict and Telemetry merges them, so the totals cover every
+process.  TelemetryReporter prints a live progress line with the ETA and
+appends the snapshots to a JSON lines file for the dashboards.
+"""
+import datetime
+import json
+import threading
+import time
+
+
+# Upper bounds in seconds of the histogram buckets, 1ms doubling up to ~65s.
+# The last bucket counts everything slower.
+HISTOGRAM_BOUNDS = tuple(0.001 * 2 ** k for k in range(17))
+# Seconds between two reports
+REPORT_INTERVAL = 10
+
+
+class LatencyHistogram(object):
+    """Fixed log-scale buckets of durations in seconds, mergeable"""
+    __slots__ = ("buckets", "count", "total", "min", "max")
+
+    def __init__(self):
+        self.buckets = [0] * (len(HISTOGRAM_BOUNDS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def record(self, seconds):
+        index = 0
+        while index < len(HISTOGRAM_BOUNDS) and seconds > HISTOGRAM_BOUNDS[index]:
+            index += 1
+        self.buckets[index] += 1
+        self.count += 1
+        self.total += seconds
+        self.min = seconds if self.min is None else min(self.min, seconds)
+        self.max = seconds if self.max is None else max(self.max, seconds)
+
+    def merge(self, other):
+        for index, bucket_count in enumerate(other.buckets):
+            self.buckets[index] += bucket_count
+        self.count += other.count
+        self.total += other.total
+        for value in (other.min, other.max):
+            if value is not None:
+                self.min = value if self.min is None else min(self.min, value)
+                self.max = value if self.max is None else max(self.max, value)
+
+    def percentile(self, p):
+        """Upper bound of the bucket holding the p-th percentile, p in [0, 100]"""
+        if not self.count:
+            return None
+        rank = p / 100.0 * self.count
+        seen = 0
+        for index, bucket_count in enumerate(self.buckets):
+            seen += bucket_count
+            if seen >= rank and bucket_count:
+                if index < len(HISTOGRAM_BOUNDS):
+                    return min(HISTOGRAM_BOUNDS[index], self.max)
+                return self.max
+        return self.max
+
+    def to_dict(self):
+        return {"count": self.count, "sum": self.total, "min": self.min,
+                "max": self.max, "p50": self.percentile(50),
+                "p90": self.percentile(90), "p99": self.percentile(99),
+                "buckets": list(self.buckets)}
+
+    @classmethod
+    def from_dict(cls, data):
+        histogram = cls()
+        histogram.buckets = list(data["buckets"])
+        histogram.count = data["count"]
+        histogram.total = data["sum"]
+        histogram.min = data["min"]
+        histogram.max = data["max"]
+        return histogram
+
+
+class WorkerMetrics(object):
+    """Named counters and latency histograms of one worker.  Only the owning
+    worker records into it, readers iterate over copies of the dicts.
+    """
+
+    def __init__(self):
+        self.counters = {}
+        self.histograms = {}
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def observe(self, name, seconds):
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms[name] = LatencyHistogram()
+        histogram.record(seconds)
+
+    def merge(self, other):
+        for name, n in list(other.counters.items()):
+            self.count(name, n)
+        for name, histogram in list(other.histograms.items()):
+            if name not in self.histograms:
+                self.histograms[name] = LatencyHistogram()
+            self.histograms[name].merge(histogram)
+
+    def to_dict(self):
+        histograms = list(self.histograms.items())
+        return {"counters": dict(self.counters),
+                "histograms": dict((name, h.to_dict())
+                                   for name, h in histograms)}
+
+    @classmethod
+    def from_dict(cls, data):
+        metrics = cls()
+        metrics.counters = dict(data["counters"])
+        metrics.histograms = dict((name, LatencyHistogram.from_dict(h))
+                                  for name, h in data["histograms"].items())
+        return metrics
+
+
+class Telemetry(object):
+    """The metrics of all the workers of an upload, and its progress toward
+    the total lines and bytes of the files discovered so far.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.total_lines = 0
+        self.total_bytes = 0
+        self._workers = {}
+
+    def worker(self, worker_id):
+        """The WorkerMetrics of a thread of this process, to record into"""
+        with self.lock:
+            if worker_id not in self._workers:
+                self._workers[worker_id] = WorkerMetrics()
+            return self._workers[worker_id]
+
+    def merge_worker(self, worker_id, metrics_dict):
+        """Merge the WorkerMetrics.to_dict() sent back by another process"""
+        metrics = WorkerMetrics.from_dict(metrics_dict)
+        with self.lock:
+            if worker_id in self._workers:
+                self._workers[worker_id].merge(metrics)
+            else:
+                self._workers[worker_id] = metrics
+
+    def add_totals(self, line_count, byte_count):
+        with self.lock:
+            self.total_lines += line_count
+            self.total_bytes += byte_count
+
+    def snapshot(self, progress_counter="items_sent"):
+        """A JSON serializable snapshot of all the workers and their total
+        @param: progress_counter - the counter compared with total_lines for
+                the ETA
+        """
+        with self.lock:
+            workers = dict((worker_id, metrics.to_dict())
+                           for worker_id, metrics in self._workers.items())
+            total = WorkerMetrics()
+            for metrics in self._workers.values():
+                total.merge(metrics)
+            total_lines = self.total_lines
+            total_bytes = self.total_bytes
+        elapsed = time.time() - self.started
+        done = total.counters.get(progress_counter, 0)
+        rate = done / elapsed if elapsed > 0 else 0.0
+        eta = None
+        if rate > 0 and total_lines >= done:
+            eta = (total_lines - done) / rate
+        return {"time": datetime.datetime.now().isoformat(),
+                "elapsed_seconds": elapsed,
+                "total_lines": total_lines,
+                "total_bytes": total_bytes,
+                "done": done,
+                "per_second": rate,
+                "eta_seconds": eta,
+                "total": total.to_dict(),
+                "workers": workers}
+
+
+def _format_ms(seconds):
+    return "?" if seconds is None else "%.0fms" % (seconds * 1000)
+
+
+def format_progress(snapshot):
+    """One line summary of a Telemetry snapshot"""
+    counters = snapshot["total"]["counters"]
+    histograms = snapshot["total"]["histograms"]
+    request = histograms.get("request_seconds", {})
+    eta = snapshot["eta_seconds"]
+    percent = (100.0 * snapshot["done"] / snapshot["total_lines"]
+               if snapshot["total_lines"] else 0.0)
+    return ("%s/%s items (%.1f%%)\t%.0f items/s\trequest p50 %s p99 %s\t"
+            "%s retries\t%s throttled\tETA %s" %
+            (snapshot["done"], snapshot["total_lines"], percent,
+             snapshot["per_second"], _format_ms(request.get("p50")),
+             _format_ms(request.get("p99")),
+             counters.get("retries", 0), counters.get("throttled", 0),
+             datetime.timedelta(seconds=int(eta)) if eta is not None else "?"))
+
+
+class TelemetryReporter(threading.Thread):
+    """Print the progress and export the Telemetry snapshots every interval
+    until stopped, and once more when stopped.
+    """
+
+    def __init__(self, telemetry, telemetry_file=None, interval=REPORT_INTERVAL):
+        """
+        @param: telemetry - the Telemetry to report
+        @param: telemetry_file - path of the JSON lines file to append the
+                snapshots to, None to only print
+        @param: interval - seconds between two reports
+        """
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.telemetry = telemetry
+        self.telemetry_file = telemetry_file
+        self.interval = interval
+        self._stopped = threading.Event()
+
+    def report(self):
+        snapshot = self.telemetry.snapshot()
+        print(format_progress(snapshot))
+        if self.telemetry_file:
+            with open(self.telemetry_file, "a") as telemetry_handler:
+                telemetry_handler.write(json.dumps(snapshot) + "\n")
+        return snapshot
+
+    def run(self):
+        while not self._stopped.wait(self.interval):
+            self.report()
+
+    def stop(self):
+        """Stop reporting and make a final report
+        @return: the final snapshot
+        """
+        self._stopped.set()
+        self.join()
+        return self.report()
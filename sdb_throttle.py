@@ -0,0 +1,183 @@
+"""Adaptive concurrency control and retries for SimpleDB requests.
+
+AdaptiveThrottle caps the number of concurrent requests with an additive
+increase / multiplicative decrease limit: the limit grows by one after a full
+window of healthy responses and halves when SimpleDB answers with 503
+ServiceUnavailable.  Throttled and transient failures are retried with full
+jitter exponential backoff.  One throttle is meant to be shared by every
+thread talking to the same SimpleDB endpoint, the upload senders as well as
+the query selects.
+"""
+import httplib
+import random
+import socket
+import threading
+import time
+
+import boto.exception
+
+
+# Error codes SimpleDB uses to ask clients to slow down
+THROTTLING_ERROR_CODES = ('ServiceUnavailable', 'RequestThrottled',
+                          'Throttling')
+
+_shared_throttle = None
+_shared_throttle_lock = threading.Lock()
+
+
+def is_throttling_error(error):
+    """True if the error is SimpleDB asking to slow down"""
+    if isinstance(error, boto.exception.SDBResponseError):
+        return (error.status == 503 or
+                getattr(error, 'error_code', None) in THROTTLING_ERROR_CODES)
+    return False
+
+
+def is_retryable_error(error):
+    """True if the request may succeed when sent again"""
+    if is_throttling_error(error):
+        return True
+    if isinstance(error, boto.exception.SDBResponseError):
+        # Internal errors are transient, client errors are not
+        return error.status >= 500
+    return isinstance(error, (socket.error, httplib.HTTPException))
+
+
+class AdaptiveThrottle(object):
+    """Shared AIMD limit on concurrent SimpleDB requests with jittered
+    retries.  Use call() to send a request through the throttle.
+    """
+
+    def __init__(self, initial_limit=4, min_limit=1, max_limit=64,
+                 target_latency=1.0, max_retries=8, base_delay=0.1,
+                 max_delay=20.0):
+        """
+        @param: initial_limit - concurrent requests allowed at first
+        @param: min_limit - the limit never drops below this
+        @param: max_limit - the limit never grows above this
+        @param: target_latency - seconds, a response slower than this stops
+                the limit from growing.  Also the minimum seconds between two
+                decreases, so one 503 storm only halves the limit once.
+        @param: max_retries - retries of a request before giving up
+        @param: base_delay - seconds of the first backoff
+        @param: max_delay - seconds, cap of the backoff
+        """
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.limit = float(max(min_limit, min(initial_limit, max_limit)))
+        self.target_latency = target_latency
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.in_flight = 0
+        # Counters
+        self.requests = 0
+        self.throttled = 0
+        self.retries = 0
+        self._healthy = 0
+        self._last_decrease = 0
+        self._cond = threading.Condition()
+
+    def _acquire(self):
+        with self._cond:
+            while self.in_flight >= int(self.limit):
+                self._cond.wait()
+            self.in_flight += 1
+
+    def _release(self):
+        with self._cond:
+            self.in_flight -= 1
+            self._cond.notify()
+
+    def _on_success(self, latency):
+        with self._cond:
+            self.requests += 1
+            if latency > self.target_latency:
+                self._healthy = 0
+                return
+            self._healthy += 1
+            if self._healthy >= int(self.limit) and self.limit < self.max_limit:
+                # A full window of healthy responses, allow one more
+                self.limit += 1
+                self._healthy = 0
+                self._cond.notify()
+
+    def _on_throttled(self):
+        with self._cond:
+            self.requests += 1
+            self.throttled += 1
+            self._healthy = 0
+            now = time.time()
+            if now - self._last_decrease >= self.target_latency:
+                self.limit = max(self.min_limit, self.limit / 2)
+                self._last_decrease = now
+
+    def backoff(self, attempt):
+        """Seconds to wait before the retry attempt, full jitter"""
+        return random.uniform(0, min(self.max_delay,
+                                     self.base_delay * 2 ** attempt))
+
+    def call(self, func, *args, **kwargs):
+        """Call func(*args, **kwargs) within the concurrency limit, retrying
+        throttled and transient failures.
+        @return: the result of func
+        @raise: the last error once the retries are exhausted, or any error
+                which is not retryable
+        """
+        attempt = 0
+        while True:
+            self._acquire()
+            started = time.time()
+            try:
+                result = func(*args, **kwargs)
+            except Exception as e:
+                self._release()
+                if is_throttling_error(e):
+                    self._on_throttled()
+                if not is_retryable_error(e) or attempt >= self.max_retries:
+                    raise
+                with self._cond:
+                    self.retries += 1
+                time.sleep(self.backoff(attempt))
+                attempt += 1
+                continue
+            self._release()
+            self._on_success(time.time() - started)
+            return result
+
+
+def shared_throttle():
+    """The process wide AdaptiveThrottle, created on first use"""
+    global _shared_throttle
+    with _shared_throttle_lock:
+        if _shared_throttle is None:
+            _shared_throttle = AdaptiveThrottle()
+    return _shared_throttle
+
+
+def throttled_select(domain, query, max_items=None, consistent_read=False,
+                     throttle=None):
+    """Same as domain.select but each page is requested through the throttle,
+    so a 503 on page 50 retries that page instead of failing the scan.
+    @param: domain - a boto.sdb Domain
+    @param: query - the SELECT expression
+    @param: max_items - stop after this many items, None for all
+    @param: consistent_read - set to True for consistent read
+    @param: throttle - an AdaptiveThrottle, default to shared_throttle()
+    @yield: items
+    """
+    throttle = throttle or shared_throttle()
+    next_token = None
+    item_count = 0
+    while True:
+        page = throttle.call(domain.connection.select, domain, query,
+                             next_token=next_token,
+                             consistent_read=consistent_read)
+        for item in page:
+            yield item
+            item_count += 1
+            if max_items is not None and item_count >= max_items:
+                return
+        next_token = page.next_token
+        if not next_token:
+            return
@@ -0,0 +1,317 @@
+"""Plan the fewest SimpleDB selects for a request of loop readings.
+
+A logical request names a set of detectors, a time window and equality
+filters.  LoopSelectPlan turns it into selects with the detectors batched in
+"detectorid IN (...)" lists and the window as a lexicographic starttime
+range, which SimpleDB answers from its indexes, instead of one LIKE select per
+detector and minute.  Several ranges, such as the peak hours of many days,
+are ORed into the same selects.  Comparisons of the values encoded by a
+sdb_schema Schema, such as speed > 0, filter the readings on the server too.
+Long windows can be split so the results stream back one window at a time,
+grouped by the caller's keys.
+
+partition_query splits any select into disjoint partitions by detectorid,
+starttime range or itemName range, for ShardedDomain.select_many to fetch
+them concurrently.
+"""
+import re
+
+from sdb_schema import format_starttime, to_epoch
+
+
+# SimpleDB allows at most 20 comparisons in a select, an IN list counts each
+# of its values
+MAX_COMPARISONS = 20
+# Comparisons the loop plans of queries.py add to the detectorid IN list at
+# most: the starttime >= and <, the status filter and speed > 0
+PLAN_COMPARISONS = 4
+# Detectors of an IN list, the rest of the comparisons are left to the plan
+DETECTORS_PER_SELECT = MAX_COMPARISONS - PLAN_COMPARISONS
+LOOP_ATTRIBUTES = ("detectorid", "starttime", "speed", "status")
+# Partitions fetched at once by a fan out select
+FAN_OUT_WORKERS = 8
+# The clauses a predicate has to go before
+_TRAILING_CLAUSES = re.compile(r"\s+(ORDER\s+BY|LIMIT)\s", re.IGNORECASE)
+_QUOTED = re.compile(r'"(?:[^"]|"")*"|\'(?:[^\']|\'\')*\'|`(?:[^`]|``)*`')
+_COMPARISONS = re.compile(r"!=|>=|<=|=|>|<|\bLIKE\b|\bIS\b|\bBETWEEN\b|"
+                          r"\bIN\s*\(([^)]*)\)", re.IGNORECASE)
+
+
+def quote_value(value):
+    """A SimpleDB string literal, double quotes are escaped by doubling"""
+    return '"%s"' % str(value).replace('"', '""')
+
+
+def quote_name(name):
+    """A SimpleDB attribute or domain name, backticks escaped by doubling"""
+    return "`%s`" % name.replace("`", "``")
+
+
+def detector_predicate(detector_ids):
+    """detectorid = or IN predicate of a list of detector IDs"""
+    if len(detector_ids) == 1:
+        return "detectorid = %s" % quote_value(detector_ids[0])
+    return "detectorid IN (%s)" % ", ".join(quote_value(d)
+                                            for d in detector_ids)
+
+
+def starttime_predicate(start=None, end=None):
+    """Range predicate of [start, end) on starttime, the starttime strings
+    sort like the times they stand for.  None when both are None.
+    """
+    predicates = []
+    if start is not None:
+        predicates.append("starttime >= %s"
+                          % quote_value(format_starttime(to_epoch(start))))
+    if end is not None:
+        predicates.append("starttime < %s"
+                          % quote_value(format_starttime(to_epoch(end))))
+    return " AND ".join(predicates) or None
+
+
+def ranges_predicate(ranges):
+    """starttime predicate of the union of [start, end) ranges"""
+    if len(ranges) == 1:
+        return starttime_predicate(*ranges[0])
+    return "(%s)" % " OR ".join("(%s)" % starttime_predicate(start, end)
+                                for start, end in ranges)
+
+
+def typed_predicate(name, operator, value, schema):
+    """Comparison of an attribute to a value encoded with the schema, e.g.
+    typed_predicate("speed", ">", 0, LOOP_SCHEMA)
+    """
+    return "%s %s %s" % (quote_name(name), operator,
+                         quote_value(schema.encode_value(name, value)))
+
+
+def comparison_count(predicate):
+    """Comparisons of a predicate counted against MAX_COMPARISONS, each value
+    of an IN list is one
+    """
+    count = 0
+    for match in _COMPARISONS.finditer(_QUOTED.sub('""', predicate)):
+        if match.group(1) is None:
+            count += 1
+        else:
+            count += match.group(1).count(",") + 1
+    return count
+
+
+def add_predicate(query, predicate):
+    """The query with one more predicate ANDed to its WHERE clause"""
+    match = _TRAILING_CLAUSES.search(query)
+    head, tail = ((query[:match.start()], query[match.start():]) if match
+                  else (query, ""))
+    if re.search(r"\sWHERE\s", head, re.IGNORECASE):
+        head = "%s AND (%s)" % (head.rstrip(), predicate)
+    else:
+        head = "%s WHERE %s" % (head.rstrip(), predicate)
+    return head + tail
+
+
+def detector_partitions(detector_ids, detectors_per_select=DETECTORS_PER_SELECT):
+    """Predicates splitting the readings by detector"""
+    detector_ids = sorted(set(str(d) for d in detector_ids))
+    return [detector_predicate(detector_ids[i:i + detectors_per_select])
+            for i in range(0, len(detector_ids), detectors_per_select)]
+
+
+def starttime_partitions(start, end, partition_seconds):
+    """Predicates splitting [start, end) into ranges of partition_seconds, in
+    time order
+    """
+    start, end = to_epoch(start), to_epoch(end)
+    return [starttime_predicate(s, min(s + partition_seconds, end))
+            for s in range(start, end, partition_seconds)]
+
+
+def item_name_partitions(boundaries):
+    """Predicates splitting the items by name at the boundaries, in order"""
+    boundaries = sorted(boundaries)
+    if not boundaries:
+        return ["itemName() IS NOT NULL"]
+    predicates = ["itemName() < %s" % quote_value(boundaries[0])]
+    for low, high in zip(boundaries, boundaries[1:]):
+        predicates.append("itemName() >= %s AND itemName() < %s"
+                          % (quote_value(low), quote_value(high)))
+    predicates.append("itemName() >= %s" % quote_value(boundaries[-1]))
+    return predicates
+
+
+def hex_boundaries(partition_count):
+    """Boundaries splitting names starting with a hex digit, such as the
+    UUID item names of the uploader, into about partition_count ranges
+    """
+    partition_count = max(1, min(partition_count, 256))
+    return ["%02x" % (256 * i // partition_count)
+            for i in range(1, partition_count)]
+
+
+def partition_query(query, predicates):
+    """The disjoint partitions of a query, one per predicate"""
+    return [add_predicate(query, predicate) for predicate in predicates]
+
+
+class LoopSelectPlan(object):
+    """The selects answering a request of loop readings"""
+
+    def __init__(self, domain_name, detector_ids=None, start=None, end=None,
+                 filters=None, attributes=LOOP_ATTRIBUTES,
+                 detectors_per_select=DETECTORS_PER_SELECT,
+                 window_seconds=None, predicates=None, ranges=None):
+        """
+        @param: domain_name - the logical loop domain
+        @param: detector_ids - an iterable of detector IDs, None for all
+        @param: start - inclusive, a datetime, starttime string or epoch
+        @param: end - exclusive, same types as start
+        @param: filters - {attribute: value} the items must equal
+        @param: attributes - attributes to select, None for all
+        @param: detectors_per_select - most detectors of a detectorid IN
+                list, fewer when the other comparisons of the plan would take
+                a select over MAX_COMPARISONS
+        @param: window_seconds - split [start, end) into windows of this many
+                seconds, None for a single window
+        @param: predicates - more predicates the items must match, see
+                typed_predicate
+        @param: ranges - a list of [start, end) to select instead of
+                [start, end), e.g. the peak hours of several days.  Without
+                window_seconds the ranges are ORed together, as many in a
+                select as make the fewest selects with the detectors.
+        """
+        self.domain_name = domain_name
+        self.detector_ids = (None if detector_ids is None else
+                             sorted(set(str(d) for d in detector_ids)))
+        if ranges is None:
+            ranges = [(start, end)]
+        self.ranges = sorted((to_epoch(s), to_epoch(e)) for s, e in ranges)
+        self.filters = filters or {}
+        self.attributes = attributes
+        self.window_seconds = window_seconds
+        self.predicates = list(predicates or [])
+        other_comparisons = sum(comparison_count(p) for p in
+                                self.other_predicates([self.ranges[0]]))
+        if (other_comparisons > MAX_COMPARISONS or
+                other_comparisons == MAX_COMPARISONS and
+                self.detector_ids is not None):
+            raise ValueError("The plan has %s comparisons besides its "
+                             "detectors, SimpleDB allows %s in a select"
+                             % (other_comparisons, MAX_COMPARISONS))
+        self.detectors_per_select = min(detectors_per_select,
+                                        MAX_COMPARISONS - other_comparisons)
+        self.ranges_per_select = 1
+        if window_seconds is None and len(self.ranges) > 1:
+            self._fit_ranges(other_comparisons, detectors_per_select)
+
+    def _fit_ranges(self, other_comparisons, detectors_per_select):
+        """Share the comparisons of a select between the ranges and the
+        detectors for the fewest selects
+        """
+        range_comparisons = comparison_count(
+            ranges_predicate([self.ranges[0]]))
+        fixed = other_comparisons - range_comparisons
+        range_count = len(self.ranges)
+        if self.detector_ids is None:
+            self.ranges_per_select = min(
+                range_count, (MAX_COMPARISONS - fixed) // range_comparisons)
+            return
+        detector_count = len(self.detector_ids)
+        fits = []
+        for per_select in range(1, range_count + 1):
+            room = MAX_COMPARISONS - fixed - per_select * range_comparisons
+            if room < 1:
+                break
+            batch = min(detectors_per_select, room)
+            selects = (-(-detector_count // batch) *
+                       -(-range_count // per_select))
+            fits.append((selects, per_select, batch))
+        _, self.ranges_per_select, self.detectors_per_select = min(fits)
+
+    def windows(self):
+        """The time windows of the plan in time order, each a list of the
+        [start, end) ranges selected together
+        """
+        pieces = []
+        for start, end in self.ranges:
+            if self.window_seconds is None or start is None or end is None:
+                pieces.append((start, end))
+            else:
+                pieces.extend((s, min(s + self.window_seconds, end))
+                              for s in range(start, end, self.window_seconds))
+        return [pieces[i:i + self.ranges_per_select]
+                for i in range(0, len(pieces), self.ranges_per_select)]
+
+    def detector_batches(self):
+        if self.detector_ids is None:
+            return [None]
+        return [self.detector_ids[i:i + self.detectors_per_select]
+                for i in range(0, len(self.detector_ids),
+                               self.detectors_per_select)]
+
+    def other_predicates(self, ranges):
+        """The predicates of a select of the ranges besides its detectors"""
+        predicates = []
+        if any(start is not None or end is not None for start, end in ranges):
+            predicates.append(ranges_predicate(ranges))
+        for name, value in sorted(self.filters.items()):
+            predicates.append("%s = %s" % (quote_name(name),
+                                           quote_value(value)))
+        predicates.extend(self.predicates)
+        return predicates
+
+    def query(self, detector_ids, ranges):
+        """The select of one batch of detectors within the ranges of a
+        window
+        """
+        predicates = []
+        if detector_ids is not None:
+            predicates.append(detector_predicate(detector_ids))
+        predicates.extend(self.other_predicates(ranges))
+        output = ("*" if self.attributes is None else
+                  ", ".join(quote_name(a) for a in self.attributes))
+        query = "SELECT %s FROM %s" % (output, quote_name(self.domain_name))
+        if predicates:
+            query += " WHERE " + " AND ".join(predicates)
+        return query
+
+    def queries(self):
+        """Every select of the plan, window by window"""
+        return [self.query(batch, ranges)
+                for ranges in self.windows()
+                for batch in self.detector_batches()]
+
+    def select(self, domain, max_workers=FAN_OUT_WORKERS):
+        """Run the plan, the selects concurrently when the domain has a
+        select_many method like ShardedDomain
+        @param: domain - the loop domain, a ShardedDomain or anything with a
+                select(query) method
+        @param: max_workers - selects fetched at once
+        @yield: items, window by window
+        """
+        return _select_all(domain, self.queries(), max_workers)
+
+    def iter_groups(self, domain, key, max_workers=FAN_OUT_WORKERS):
+        """Run the plan and group the items of each window by key.  A group
+        is complete when its key does not span two windows, e.g. a time slot
+        shorter than window_seconds.
+        @param: key - function of an item returning its group key
+        @yield: (key, list of items), in key order within each window
+        """
+        for ranges in self.windows():
+            groups = {}
+            queries = [self.query(batch, ranges)
+                       for batch in self.detector_batches()]
+            for item in _select_all(domain, queries, max_workers):
+                groups.setdefault(key(item), []).append(item)
+            for group_key in sorted(groups):
+                yield group_key, groups[group_key]
+
+
+def _select_all(domain, queries, max_workers):
+    """Items of the queries in query order, fetched concurrently when the
+    domain has a select_many method
+    """
+    if hasattr(domain, "select_many"):
+        return domain.select_many(queries, max_workers=max_workers,
+                                  ordered=True)
+    return (item for query in queries for item in domain.select(query))
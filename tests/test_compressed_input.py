@@ -0,0 +1,177 @@
+import bz2
+import gzip
+import os
+import shutil
+import tempfile
+import unittest
+
+import compressed_input
+from compressed_input import LinesReader, build_index
+from tests.test_uploader import (CountingSDBConnection, UploadTestCase,
+                                 domain_items)
+
+
+def lines_of(count, width=40):
+    return b"".join(b"%06d,%s\n" % (i, b"x" * (i % width))
+                    for i in range(count))
+
+
+def read_ranges(reader, ranges):
+    """The lines of each range, and the offset after each line"""
+    lines = []
+    for start, end in ranges:
+        first, block = reader.read(start, end)
+        for line in block.splitlines(True):
+            first += len(line)
+            lines.append((line, first))
+    return lines
+
+
+def plain_lines(data):
+    lines, end = [], 0
+    for line in data.splitlines(True):
+        end += len(line)
+        lines.append((line, end))
+    return lines
+
+
+class CompressedInputTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp(prefix="test_compressed_input_")
+        self.data = lines_of(20000)
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def write_gzip(self, members=1):
+        path = os.path.join(self.work_dir, "loop.csv.gz")
+        step = -(-len(self.data) // members)
+        for i in range(0, len(self.data), step):
+            with gzip.open(path, "ab") as handler:
+                handler.write(self.data[i:i + step])
+        return path
+
+
+class GzipTest(CompressedInputTestCase):
+
+    def test_single_member_is_one_run(self):
+        path = self.write_gzip()
+        index = build_index(path)
+        self.assertEqual(index.uncompressed_size, len(self.data))
+        self.assertEqual(index.line_count, 20000)
+        runs = index.ranges(0, index.complete_end, 16 * 1024)
+        self.assertEqual(len(runs), 1)
+        self.assertGreater(len(runs[0]), 10)
+
+    def test_run_decompressed_once(self):
+        path = self.write_gzip()
+        index = build_index(path)
+        run, = index.ranges(0, index.complete_end, 16 * 1024)
+        starts = []
+        iter_uncompressed = compressed_input.iter_uncompressed
+
+        def recorded(file_path, index, start):
+            starts.append(start)
+            return iter_uncompressed(file_path, index, start)
+        compressed_input.iter_uncompressed = recorded
+        try:
+            lines = read_ranges(LinesReader(path, index), run)
+        finally:
+            compressed_input.iter_uncompressed = iter_uncompressed
+        self.assertEqual(starts, [0])
+        self.assertEqual(lines, plain_lines(self.data))
+
+    def test_members_are_runs(self):
+        path = self.write_gzip(members=8)
+        spacing = compressed_input.SEEK_POINT_SPACING
+        # A seek point every member
+        compressed_input.SEEK_POINT_SPACING = 1
+        try:
+            index = build_index(path)
+        finally:
+            compressed_input.SEEK_POINT_SPACING = spacing
+        self.assertEqual(len(index.points), 8)
+        self.assertEqual(index.uncompressed_size, len(self.data))
+        runs = index.ranges(0, index.complete_end, 16 * 1024)
+        self.assertGreater(len(runs), 1)
+        lines = read_ranges(LinesReader(path, index),
+                            [r for run in runs for r in run])
+        self.assertEqual(lines, plain_lines(self.data))
+
+    def test_ranges_out_of_order(self):
+        path = self.write_gzip()
+        index = build_index(path)
+        run, = index.ranges(0, index.complete_end, 16 * 1024)
+        reader = LinesReader(path, index)
+        backwards = [read_ranges(reader, [r]) for r in reversed(run)]
+        forwards = [read_ranges(LinesReader(path, index), [r]) for r in run]
+        self.assertEqual(backwards[::-1], forwards)
+
+
+class Bz2Test(CompressedInputTestCase):
+
+    def test_blocks_read_in_ranges(self):
+        path = os.path.join(self.work_dir, "loop.csv.bz2")
+        with open(path, "wb") as handler:
+            handler.write(bz2.compress(self.data, 1))
+        index = build_index(path)
+        self.assertEqual(index.uncompressed_size, len(self.data))
+        self.assertEqual(index.line_count, 20000)
+        runs = index.ranges(0, index.complete_end, 64 * 1024)
+        lines = read_ranges(LinesReader(path, index),
+                            [r for run in runs for r in run])
+        self.assertEqual(lines, plain_lines(self.data))
+
+
+class CompressedUploadTest(UploadTestCase):
+
+    def setUp(self):
+        UploadTestCase.setUp(self)
+        self.data = lines_of(3000)
+
+    def write_gzip(self, path, data):
+        with gzip.open(path, "ab") as handler:
+            handler.write(data)
+
+    def uploaded(self, conn, **kwargs):
+        self.upload(conn, key_column="a", work_unit_size=8 * 1024, **kwargs)
+        return domain_items(conn, "Test")
+
+    def test_same_items_as_uncompressed(self):
+        with open("data/plain.csv", "wb") as handler:
+            handler.write(self.data)
+        expected = self.uploaded(CountingSDBConnection())
+        os.remove("data/plain.csv")
+        lines = self.data.splitlines(True)
+        # Members and seek points enough to split the file across units
+        for i in range(0, 2000, 500):
+            self.write_gzip("data/a.csv.gz", b"".join(lines[i:i + 500]))
+        with open("data/b.csv.bz2", "wb") as handler:
+            handler.write(bz2.compress(b"".join(lines[2000:]), 1))
+        spacing = compressed_input.SEEK_POINT_SPACING
+        compressed_input.SEEK_POINT_SPACING = 1
+        try:
+            conn = CountingSDBConnection()
+            items = self.uploaded(conn)
+        finally:
+            compressed_input.SEEK_POINT_SPACING = spacing
+        self.assertEqual(conn.items_sent, 3000)
+        self.assertEqual(items, expected)
+
+    def test_appended_member_uploads_as_delta(self):
+        half = self.data.index(b"\n001500,") + 1
+        # The first half and the start of a line still being written
+        self.write_gzip("data/a.csv.gz", self.data[:half + 3])
+        conn = CountingSDBConnection()
+        items = self.uploaded(conn, delta=True, manifest_file="manifest.json")
+        self.assertEqual(len(items), 1500)
+        self.write_gzip("data/a.csv.gz", self.data[half + 3:])
+        items = self.uploaded(conn, delta=True, manifest_file="manifest.json")
+        self.assertEqual(conn.items_sent, 3000)
+        self.assertEqual(sorted(items), ["%06d" % i for i in range(3000)])
+        self.assertEqual(items["001501"]["b"], ["x" * 21])
+
+
+if __name__ == "__main__":
+    unittest.main()
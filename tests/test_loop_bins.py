@@ -0,0 +1,178 @@
+import unittest
+
+import numpy
+
+from loop_bins import (SpeedAccumulator, bin_count, binned_speeds,
+                       group_indexes, mean_speeds, pair_travel_times,
+                       travel_times)
+from loop_cache import readings_from_items
+from sdb_fake import FakeSDBConnection
+from sdb_schema import LOOP_SCHEMA, format_starttime
+from select_planner import LoopSelectPlan
+
+
+START = 1316044800
+
+
+class SpeedAccumulatorTest(unittest.TestCase):
+
+    def setUp(self):
+        rng = numpy.random.RandomState(0)
+        self.starttimes = START + rng.randint(0, 4 * 3600, 2000)
+        self.speeds = rng.uniform(5, 70, 2000)
+
+    def test_means_and_variances_of_readings(self):
+        hours = SpeedAccumulator(START, START + 4 * 3600, 3600)
+        hours.add(self.starttimes, self.speeds)
+        bins = (self.starttimes - START) // 3600
+        for b in range(4):
+            speeds = self.speeds[bins == b]
+            self.assertAlmostEqual(hours.means()[b], speeds.mean())
+            self.assertAlmostEqual(hours.variances()[b], speeds.var())
+
+    def test_rollups_with_squares_match_readings(self):
+        readings = SpeedAccumulator(START, START + 4 * 3600, 3600)
+        readings.add(self.starttimes, self.speeds)
+        # Rolled up by 5 minutes first
+        buckets = self.starttimes - (self.starttimes - START) % 300
+        keys = numpy.unique(buckets)
+        index = numpy.searchsorted(keys, buckets)
+        rollups = SpeedAccumulator(START, START + 4 * 3600, 3600)
+        rollups.add(keys, numpy.bincount(index, self.speeds),
+                    numpy.bincount(index).astype(numpy.int64),
+                    numpy.bincount(index, self.speeds ** 2))
+        numpy.testing.assert_allclose(rollups.means(), readings.means())
+        numpy.testing.assert_allclose(rollups.variances(),
+                                      readings.variances())
+
+    def test_rollups_without_squares_have_nan_variance(self):
+        hours = SpeedAccumulator(START, START + 2 * 3600, 3600)
+        hours.add(numpy.array([START, START + 3600]),
+                  numpy.array([100.0, 90.0]), numpy.array([2, 3]))
+        hours.add(numpy.array([START]), numpy.array([50.0]))
+        self.assertTrue(numpy.isnan(hours.variances()).all())
+        numpy.testing.assert_allclose(hours.means(), [50.0, 30.0])
+
+    def test_merged_partials_match_one_accumulator(self):
+        whole = SpeedAccumulator(START, START + 4 * 3600, 300)
+        whole.add(self.starttimes, self.speeds)
+        merged = SpeedAccumulator(START, START + 4 * 3600, 300)
+        for part in (slice(0, 700), slice(700, 2000)):
+            partial = SpeedAccumulator(START, START + 4 * 3600, 300)
+            partial.add(self.starttimes[part], self.speeds[part])
+            merged.merge(*partial.partial())
+        unsquared = SpeedAccumulator(START, START + 4 * 3600, 300)
+        unsquared.add(self.starttimes[:1], self.speeds[:1],
+                      numpy.array([1]))
+        merged.merge(*unsquared.partial())
+        whole.add(self.starttimes[:1], self.speeds[:1], numpy.array([1]))
+        numpy.testing.assert_array_equal(merged.counts, whole.counts)
+        numpy.testing.assert_allclose(merged.sums, whole.sums)
+        numpy.testing.assert_allclose(merged.variances(), whole.variances())
+        self.assertEqual(numpy.isnan(merged.variances()).sum(),
+                         numpy.isnan(whole.variances()).sum())
+
+    def test_readings_outside_the_span_are_left_out(self):
+        hours = SpeedAccumulator(START, START + 3600, 3600)
+        hours.add(numpy.array([START - 1, START, START + 3600]),
+                  numpy.array([10.0, 20.0, 30.0]))
+        self.assertEqual(list(hours.counts), [1])
+        self.assertEqual(list(hours.sums), [20.0])
+
+
+class BinnedSpeedsTest(unittest.TestCase):
+
+    def setUp(self):
+        rng = numpy.random.RandomState(1)
+        size = 5000
+        self.readings = {
+            "detectorid": rng.choice([1000, 1001, 1002, 1003, 7], size),
+            "starttime": START - 600 + rng.randint(0, 86400 + 1200, size),
+            "speed": rng.choice([0, 20, 35.5, 60, numpy.nan], size)}
+        # Two stations, detector 7 in none
+        self.detector_group = {1000: 0, 1001: 0, 1002: 1, 1003: 1}
+
+    def test_same_as_the_loops(self):
+        sums, counts = binned_speeds(self.readings, self.detector_group, 2,
+                                     START, START + 86400)
+        self.assertEqual(sums.shape, (2, 288))
+        expected_sums = numpy.zeros((2, 288))
+        expected_counts = numpy.zeros((2, 288), numpy.int64)
+        for detector_id, starttime, speed in zip(self.readings["detectorid"],
+                                                 self.readings["starttime"],
+                                                 self.readings["speed"]):
+            group = self.detector_group.get(detector_id)
+            if (group is None or numpy.isnan(speed) or speed == 0 or
+                    not START <= starttime < START + 86400):
+                continue
+            cell = group, (starttime - START) // 300
+            expected_sums[cell] += speed
+            expected_counts[cell] += 1
+        numpy.testing.assert_allclose(sums, expected_sums)
+        numpy.testing.assert_array_equal(counts, expected_counts)
+        # Every bin, the last of hour 23 too
+        self.assertTrue((counts[:, -1] > 0).all())
+
+    def test_rollup_rows(self):
+        rollups = {"detectorid": numpy.array([1000, 1002, 1002]),
+                   "starttime": numpy.array([START, START, START + 300]),
+                   "speed": numpy.array([120.0, 50.0, 0.0]),
+                   "count": numpy.array([3, 1, 0])}
+        sums, counts = binned_speeds(rollups, self.detector_group, 2, START,
+                                     START + 600)
+        numpy.testing.assert_array_equal(counts, [[3, 0], [1, 0]])
+        means = mean_speeds(sums, counts)
+        self.assertEqual(means[0, 0], 40.0)
+        self.assertTrue(numpy.isnan(means[1, 1]))
+        times = travel_times(means, [2.0, 1.0])
+        self.assertEqual(times[0, 0], 0.05)
+        self.assertTrue(numpy.isnan(times[0, 1]))
+
+    def test_group_indexes(self):
+        numpy.testing.assert_array_equal(
+            group_indexes(numpy.array([1003, 5, 1000, 9999]),
+                          self.detector_group), [1, -1, 0, -1])
+        numpy.testing.assert_array_equal(
+            group_indexes(numpy.array([1, 2]), {}), [-1, -1])
+
+    def test_readings_of_the_fake_domain(self):
+        conn = FakeSDBConnection()
+        domain = conn.create_domain("Loop")
+        items = {}
+        # The last minutes of the day, left out by range(0, 23)
+        for minute in range(24 * 60 - 10, 24 * 60):
+            for detector_id in (1000, 1002):
+                item = {"detectorid": str(detector_id), "status": "2",
+                        "starttime": format_starttime(START + minute * 60),
+                        "speed": str(minute % 7 * 10)}
+                LOOP_SCHEMA.encode_item(item)
+                items["%s-%s" % (detector_id, minute)] = item
+        domain.batch_put_attributes(dict(items.items()[:10]))
+        domain.batch_put_attributes(dict(items.items()[10:]))
+        plan = LoopSelectPlan("Loop", [1000, 1002], START, START + 86400)
+        readings = readings_from_items(plan.select(domain))
+        sums, counts = binned_speeds(readings, self.detector_group, 2,
+                                     START, START + 86400)
+        self.assertEqual(counts[:, :-2].sum(), 0)
+        expected = [sum(1 for m in range(24 * 60 - 10 + 5 * i,
+                                         24 * 60 - 5 + 5 * i) if m % 7)
+                    for i in range(2)]
+        numpy.testing.assert_array_equal(counts[:, -2:], [expected] * 2)
+
+
+class BinsTest(unittest.TestCase):
+
+    def test_bin_count_rounds_up(self):
+        self.assertEqual(bin_count(START, START + 86400), 288)
+        self.assertEqual(bin_count(START, START + 301), 2)
+
+    def test_pair_travel_times(self):
+        pairs = pair_travel_times([1.0, 2.0, numpy.nan, 4.0])
+        self.assertEqual(pairs[0, 1], 3.0)
+        self.assertEqual(pairs[3, 3], 4.0)
+        self.assertTrue(numpy.isnan(pairs[0, 2]))
+        self.assertTrue(numpy.isnan(pairs[1, 0]))
+
+
+if __name__ == "__main__":
+    unittest.main()
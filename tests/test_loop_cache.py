@@ -0,0 +1,138 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy
+
+import queries
+from loop_cache import LoopCache, export_loop_cache, readings_from_items
+from sdb_fake import FakeSDBConnection
+from sdb_schema import LOOP_SCHEMA, format_starttime, to_epoch
+from sdb_shards import ShardedDomain
+
+
+START = to_epoch("2011-09-15T00:00:00")
+
+
+def loop_items(detector_ids=range(1000, 1005), hours=48):
+    """Hourly readings, every 5th without a speed, every 7th not OK"""
+    items = {}
+    for detector_id in detector_ids:
+        for hour in range(hours):
+            n = detector_id * hours + hour
+            item = {"detectorid": str(detector_id),
+                    "starttime": "%s-07" % format_starttime(
+                        START + hour * 3600),
+                    "speed": "" if n % 5 == 0 else str(n % 60),
+                    "status": "1" if n % 7 == 0 else "2"}
+            LOOP_SCHEMA.encode_item(item)
+            items["%s-%s" % (detector_id, hour)] = item
+    # Dropped by the export
+    items["no-detector"] = {"starttime": format_starttime(START)}
+    items["bad-starttime"] = {"detectorid": "1000", "starttime": "yesterday"}
+    return items
+
+
+def put_items(domain, items):
+    """In batches of 25 items, the most a BatchPutAttributes takes"""
+    names = sorted(items)
+    for i in range(0, len(names), 25):
+        domain.batch_put_attributes(
+            dict((name, items[name]) for name in names[i:i + 25]))
+
+
+def sorted_readings(readings):
+    order = numpy.lexsort((readings["starttime"], readings["detectorid"]))
+    return dict((name, column[order]) for name, column in readings.items())
+
+
+class LoopCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp(prefix="test_loop_cache_")
+        self.conn = FakeSDBConnection(page_size=50)
+        self.domain = self.conn.create_domain(queries.LOOP_DOMAIN)
+        self.items = loop_items()
+        put_items(self.domain, self.items)
+        self.row_count = export_loop_cache(
+            self.domain, self.cache_dir,
+            self.conn.domain_metadata(self.domain))
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def test_export(self):
+        self.assertEqual(self.row_count, 240)
+        cache = LoopCache(self.cache_dir)
+        self.assertEqual(cache.detector_ids(), range(1000, 1005))
+        readings = cache.readings()
+        self.assertEqual(readings["detectorid"].dtype, numpy.int32)
+        self.assertEqual(readings["starttime"].dtype, numpy.int64)
+        self.assertEqual(readings["speed"].dtype, numpy.float32)
+        self.assertEqual(readings["status"].dtype, numpy.uint8)
+        # Sorted by detector then starttime
+        for name, column in sorted_readings(readings).items():
+            numpy.testing.assert_array_equal(column, readings[name])
+        self.assertEqual(numpy.isnan(readings["speed"]).sum(), 48)
+
+    def test_readings_of_a_window(self):
+        cache = LoopCache(self.cache_dir)
+        start, end = START + 5 * 3600, START + 30 * 3600
+        readings = cache.readings([1004, 1001, 999], start, end)
+        expected = readings_from_items(
+            item for item in self.items.values()
+            if item.get("detectorid") in ("1001", "1004") and
+            start <= to_epoch(item["starttime"]) < end)
+        self.assertEqual(len(readings["starttime"]), 50)
+        # In the order of the detectors asked for
+        self.assertEqual(readings["detectorid"][0], 1004)
+        readings = sorted_readings(readings)
+        for name, column in sorted_readings(expected).items():
+            numpy.testing.assert_array_equal(column, readings[name])
+
+    def test_stale(self):
+        cache = LoopCache(self.cache_dir)
+        self.assertFalse(cache.is_stale(self.conn.domain_metadata(
+            self.domain)))
+        self.domain.batch_put_attributes(
+            {"new": {"detectorid": "1000",
+                     "starttime": "2011-09-20T00:00:00"}})
+        self.assertTrue(cache.is_stale(self.conn.domain_metadata(
+            self.domain)))
+
+    def test_sharded_export(self):
+        cache_dir = os.path.join(self.cache_dir, "sharded")
+        domain = ShardedDomain(self.conn, queries.LOOP_DOMAIN)
+        query = "SELECT * FROM `%s` WHERE itemName() %s '1003'"
+        row_count = export_loop_cache(
+            domain, cache_dir, query=[query % (queries.LOOP_DOMAIN, "<"),
+                                      query % (queries.LOOP_DOMAIN, ">=")])
+        self.assertEqual(row_count, 240)
+        numpy.testing.assert_array_equal(
+            LoopCache(cache_dir).readings()["speed"],
+            LoopCache(self.cache_dir).readings()["speed"])
+
+    def test_loop_readings_same_as_the_domain(self):
+        loop_dom, loop_cache = queries.loop_dom, queries.loop_cache
+        window = (1000, 1002, 1003), START + 3600, START + 40 * 3600
+        try:
+            queries.loop_dom = self.domain
+            queries.loop_cache = None
+            from_domain = queries.loop_readings(
+                *window, positive_speed=True, ok_only=True)
+            queries.loop_cache = LoopCache(self.cache_dir)
+            from_cache = queries.loop_readings(
+                *window, positive_speed=True, ok_only=True)
+        finally:
+            queries.loop_dom, queries.loop_cache = loop_dom, loop_cache
+        self.assertGreater(len(from_cache["speed"]), 50)
+        from_domain = sorted_readings(from_domain)
+        for name, column in sorted_readings(from_cache).items():
+            numpy.testing.assert_array_equal(column, from_domain[name])
+        self.assertTrue((from_cache["speed"] > 0).all())
+        self.assertTrue((from_cache["status"] == 2).all())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,119 @@
+import datetime
+import unittest
+
+import numpy
+
+import queries
+from loop_calendar import (MONDAY, THURSDAY, TUESDAY, WEDNESDAY,
+                           CalendarFilter)
+from sdb_fake import FakeSDBConnection
+from sdb_schema import LOOP_SCHEMA, format_starttime, to_epoch
+from sdb_shards import ShardedDomain
+
+
+PEAKS = [(7, 9), (16, 18)]
+
+
+def mid_weekdays(start_date, end_date):
+    return CalendarFilter(start_date, end_date,
+                          [TUESDAY, WEDNESDAY, THURSDAY], PEAKS)
+
+
+class CalendarFilterTest(unittest.TestCase):
+
+    def test_days_across_months(self):
+        calendar = mid_weekdays(datetime.date(2011, 9, 26),
+                                datetime.date(2011, 10, 8))
+        self.assertEqual([day.isoformat() for day in calendar.days()],
+                         ["2011-09-27", "2011-09-28", "2011-09-29",
+                          "2011-10-04", "2011-10-05", "2011-10-06"])
+        leap = CalendarFilter(datetime.date(2012, 2, 27),
+                              datetime.date(2012, 3, 6), [WEDNESDAY])
+        self.assertEqual(leap.days(), [datetime.date(2012, 2, 29)])
+
+    def test_time_windows(self):
+        calendar = CalendarFilter(datetime.date(2011, 9, 27),
+                                  datetime.date(2011, 9, 29),
+                                  hour_windows=[(16, 18), (7, 9)])
+        self.assertEqual(
+            [(start.isoformat(), end.hour) for start, end in
+             calendar.time_windows()],
+            [("2011-09-27T07:00:00", 9), ("2011-09-27T16:00:00", 18),
+             ("2011-09-28T07:00:00", 9), ("2011-09-28T16:00:00", 18)])
+        whole_days = CalendarFilter(datetime.date(2011, 9, 27),
+                                    datetime.date(2011, 9, 28))
+        self.assertEqual(len(whole_days.time_windows()), 1)
+
+    def test_partition_same_as_the_dates(self):
+        calendar = CalendarFilter(datetime.date(2011, 9, 15),
+                                  datetime.date(2011, 11, 15),
+                                  [MONDAY, WEDNESDAY], PEAKS)
+        rng = numpy.random.RandomState(2)
+        starttimes = (to_epoch("2011-09-10T00:00:00") +
+                      rng.randint(0, 70 * 86400, 20000))
+        weekdays, windows = calendar.partition(starttimes)
+        for starttime, weekday, window in zip(starttimes, weekdays, windows):
+            moment = datetime.datetime.utcfromtimestamp(starttime)
+            expected = (-1, -1)
+            if (calendar.start_date <= moment.date() < calendar.end_date and
+                    moment.weekday() in calendar.weekdays):
+                for i, (first_hour, end_hour) in enumerate(PEAKS):
+                    if first_hour <= moment.hour < end_hour:
+                        expected = (calendar.weekdays.index(moment.weekday()),
+                                    i)
+            self.assertEqual((weekday, window), expected)
+        numpy.testing.assert_array_equal(calendar.mask(starttimes),
+                                         weekdays >= 0)
+
+
+class PeakReadingsTest(unittest.TestCase):
+    """The readings of the peak windows of every day in shared selects"""
+
+    def setUp(self):
+        conn = FakeSDBConnection()
+        self.conn = conn
+        domain = conn.create_domain(queries.LOOP_DOMAIN)
+        start = to_epoch("2011-09-26T00:00:00")
+        items = {}
+        # Two weeks of half hourly readings
+        for n in range(14 * 48):
+            item = {"detectorid": "1000", "status": "2", "speed": "50",
+                    "starttime": format_starttime(start + n * 1800)}
+            LOOP_SCHEMA.encode_item(item)
+            items[str(n)] = item
+        names = sorted(items)
+        for i in range(0, len(names), 25):
+            domain.batch_put_attributes(
+                dict((name, items[name]) for name in names[i:i + 25]))
+        self.saved = (queries.loop_dom, queries.rollup_dom,
+                      queries.loop_cache)
+        queries.loop_dom = ShardedDomain(conn, queries.LOOP_DOMAIN)
+        queries.rollup_dom = None
+        queries.loop_cache = None
+
+    def tearDown(self):
+        (queries.loop_dom, queries.rollup_dom,
+         queries.loop_cache) = self.saved
+
+    def test_one_pass(self):
+        calendar = mid_weekdays(datetime.date(2011, 9, 26),
+                                datetime.date(2011, 10, 10))
+        windows = calendar.time_windows()
+        selects = self.conn.requests["Select"]
+        starttimes = numpy.concatenate([
+            readings["starttime"] for readings in
+            queries.speed_reading_chunks(["1000"], 3600, ranges=windows)])
+        self.assertLess(self.conn.requests["Select"] - selects,
+                        len(windows))
+        # 4 readings a window, each in its weekday and window
+        self.assertEqual(len(starttimes), 4 * len(windows))
+        weekdays, peak_windows = calendar.partition(starttimes)
+        self.assertTrue((weekdays >= 0).all())
+        self.assertEqual(numpy.bincount(peak_windows).tolist(),
+                         [2 * len(windows)] * 2)
+        self.assertEqual(numpy.bincount(weekdays).tolist(),
+                         [4 * len(windows) // 3] * 3)
+
+
+if __name__ == "__main__":
+    unittest.main()
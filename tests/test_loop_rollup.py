@@ -0,0 +1,126 @@
+import unittest
+
+import numpy
+
+import queries
+from loop_bins import SpeedAccumulator
+from loop_cache import readings_from_items
+from loop_rollup import LoopRollup, rollup_domain_name, rollups_from_items
+from sdb_fake import FakeSDBConnection
+from sdb_schema import format_starttime, to_epoch
+from sdb_shards import ShardedDomain
+from tests.test_uploader import UploadTestCase, domain_items, write_lines
+
+
+START = to_epoch("2011-09-15T00:00:00")
+
+
+def reading(detector_id, seconds, speed, status="2"):
+    return {"detectorid": str(detector_id), "speed": str(speed),
+            "status": status,
+            "starttime": "%s-07" % format_starttime(START + seconds)}
+
+
+class LoopRollupTest(UploadTestCase):
+
+    def test_buckets(self):
+        rollup = LoopRollup()
+        for seconds, speed, status in [(0, 50, "2"), (100, 30, "1"),
+                                       (299, 40, "2"), (300, 60, "2"),
+                                       (400, 0, "2"), (500, "", "2")]:
+            rollup.add(reading(1000, seconds, speed, status))
+        self.assertFalse(rollup.add({"detectorid": "1000", "speed": "5",
+                                     "starttime": "yesterday"}))
+        items = dict(rollup.items())
+        self.assertEqual(sorted(items), [
+            "1000_300_2011-09-15T00:00:00", "1000_300_2011-09-15T00:05:00",
+            "1000_3600_2011-09-15T00:00:00"])
+        first = items["1000_300_2011-09-15T00:00:00"]
+        self.assertEqual((first["count"], first["sum"], first["min"],
+                          first["max"]), ("3", "120.0", "30.0", "50.0"))
+        self.assertEqual((first["ok_count"], first["ok_sum"]), ("2", "90.0"))
+        self.assertEqual(first["sum_squares"], repr(50.0 ** 2 + 30.0 ** 2 +
+                                                    40.0 ** 2))
+        hour = items["1000_3600_2011-09-15T00:00:00"]
+        self.assertEqual((hour["count"], hour["max"]), ("4", "60.0"))
+
+    def test_merged_partials(self):
+        rng = numpy.random.RandomState(3)
+        readings = [reading(rng.randint(1000, 1003), rng.randint(0, 7200),
+                            rng.randint(0, 70), rng.choice(["1", "2"]))
+                    for _ in range(500)]
+        whole = LoopRollup()
+        for item in readings:
+            whole.add(item)
+        merged = LoopRollup()
+        for i in range(0, 500, 100):
+            partial = merged.partial()
+            for item in readings[i:i + 100]:
+                partial.add(item)
+            merged.merge(partial.cells)
+        self.assertEqual(sorted(merged.cells), sorted(whole.cells))
+        for key, cell in whole.cells.items():
+            numpy.testing.assert_allclose(merged.cells[key], cell)
+
+    def test_rollups_same_means_as_readings(self):
+        rng = numpy.random.RandomState(4)
+        readings = [reading(1000, rng.randint(0, 7200), rng.randint(0, 70),
+                            rng.choice(["1", "2"])) for _ in range(500)]
+        rollup = LoopRollup()
+        for item in readings:
+            rollup.add(item)
+        for ok_only in (False, True):
+            rollups = rollups_from_items(
+                [attributes for _, attributes in rollup.items()
+                 if attributes["bucket"] == "3600"], ok_only)
+            from_rollups = SpeedAccumulator(START, START + 7200, 3600)
+            from_rollups.add(rollups["starttime"], rollups["speed"],
+                             rollups["count"], rollups["squares"])
+            raw = readings_from_items(
+                item for item in readings if float(item["speed"]) > 0 and
+                (not ok_only or item["status"] == "2"))
+            from_readings = SpeedAccumulator(START, START + 7200, 3600)
+            from_readings.add(raw["starttime"], raw["speed"])
+            numpy.testing.assert_array_equal(from_rollups.counts,
+                                             from_readings.counts)
+            numpy.testing.assert_allclose(from_rollups.means(),
+                                          from_readings.means())
+            numpy.testing.assert_allclose(from_rollups.variances(),
+                                          from_readings.variances())
+
+    def test_uploaded_and_read_by_the_queries(self):
+        rows = []
+        for detector_id in (1000, 1001):
+            for minute in range(0, 120, 2):
+                rows.append((detector_id, "%s-07" % format_starttime(
+                    START + minute * 60), 40 + minute % 30, "2"))
+        write_lines("data/loop.csv", rows)
+        conn = FakeSDBConnection()
+        rollup_name = rollup_domain_name(queries.LOOP_DOMAIN)
+        conn.create_domain(rollup_name)
+        self.upload(conn, queries.LOOP_DOMAIN,
+                    header="detectorid,starttime,speed,status",
+                    rollup=LoopRollup())
+        self.assertEqual(len(domain_items(conn, queries.LOOP_DOMAIN)), 120)
+        # 24 5-minute buckets and 2 hours of each detector
+        self.assertEqual(len(domain_items(conn, rollup_name)), 2 * 26)
+        saved = queries.loop_dom, queries.rollup_dom, queries.loop_cache
+        try:
+            queries.loop_dom = ShardedDomain(conn, queries.LOOP_DOMAIN)
+            queries.rollup_dom = ShardedDomain(conn, rollup_name)
+            queries.loop_cache = None
+            rollups = queries.speed_readings(["1000", "1001"], 3600, START,
+                                             START + 7200, ok_only=True)
+            queries.rollup_dom = None
+            readings = queries.speed_readings(["1000", "1001"], 3600, START,
+                                              START + 7200, ok_only=True)
+        finally:
+            queries.loop_dom, queries.rollup_dom, queries.loop_cache = saved
+        self.assertEqual(len(rollups["speed"]), 4)
+        self.assertEqual(rollups["count"].sum(), len(readings["speed"]))
+        self.assertAlmostEqual(rollups["speed"].sum(),
+                               readings["speed"].sum())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,95 @@
+import unittest
+
+import numpy
+
+import queries
+from loop_bins import SpeedAccumulator
+from map_reduce import map_reduce
+from sdb_fake import FakeSDBConnection
+from sdb_schema import to_epoch
+from sdb_shards import ShardedDomain, shard_domain_names, shard_index
+from tests.test_loop_cache import START, loop_items, put_items
+
+
+def square(n):
+    return n, n * n
+
+
+def fail_on_three(n):
+    if n == 3:
+        raise ValueError("three")
+    return n
+
+
+class MapReduceTest(unittest.TestCase):
+
+    def test_partials_reduced(self):
+        results = {}
+        reduced = map_reduce(square, range(20),
+                             lambda (n, partial): results.update({n: partial}),
+                             worker_count=3)
+        self.assertEqual(reduced, 20)
+        self.assertEqual(results, dict((n, n * n) for n in range(20)))
+        self.assertEqual(map_reduce(square, [], None), 0)
+
+    def test_mapper_errors_raised(self):
+        with self.assertRaises(ValueError):
+            map_reduce(fail_on_three, range(10), lambda partial: None,
+                       worker_count=2)
+
+
+class HourlyStationTest(unittest.TestCase):
+    """The hourly mapper of hourly_corridor_travel_times in worker processes
+    reading a sharded fake loop domain
+    """
+
+    def setUp(self):
+        self.conn = FakeSDBConnection(page_size=20)
+        names = shard_domain_names(queries.LOOP_DOMAIN, 2)
+        for name in names:
+            self.conn.create_domain(name)
+        self.items = loop_items()
+        for i, name in enumerate(names):
+            put_items(self.conn.get_domain(name, validate=False),
+                      dict((item_name, item) for item_name, item
+                           in self.items.items()
+                           if shard_index(item_name, 2) == i))
+        self.saved = (queries.loop_dom, queries.rollup_dom,
+                      queries.loop_cache, queries.READING_CHUNK_ROWS)
+        # Inherited by the forked workers
+        queries.loop_dom = ShardedDomain(self.conn, queries.LOOP_DOMAIN, 2)
+        queries.rollup_dom = None
+        queries.loop_cache = None
+        queries.READING_CHUNK_ROWS = 7
+
+    def tearDown(self):
+        (queries.loop_dom, queries.rollup_dom, queries.loop_cache,
+         queries.READING_CHUNK_ROWS) = self.saved
+
+    def test_stations_reduced_by_hour(self):
+        start, end = START, START + 48 * 3600
+        stations = [["1000", "1001"], ["1002"], ["1003", "1004"]]
+        station_hours = [SpeedAccumulator(start, end, 3600)
+                         for _ in stations]
+        map_reduce(queries._hourly_station_partial,
+                   [(i, detector_ids, start, end)
+                    for i, detector_ids in enumerate(stations)],
+                   lambda (i, partial): station_hours[i].merge(*partial),
+                   worker_count=2)
+        for detector_ids, hours in zip(stations, station_hours):
+            expected = SpeedAccumulator(start, end, 3600)
+            readings = [item for item in self.items.values()
+                        if item.get("detectorid") in detector_ids and
+                        item.get("status") == queries.LOOP_STATUS_OK and
+                        item["speed"] and float(item["speed"]) > 0]
+            expected.add([to_epoch(item["starttime"]) for item in readings],
+                         [float(item["speed"]) for item in readings])
+            numpy.testing.assert_array_equal(hours.counts, expected.counts)
+            numpy.testing.assert_allclose(hours.sums, expected.sums)
+            numpy.testing.assert_allclose(hours.variances(),
+                                          expected.variances())
+        self.assertGreater(sum(h.counts.sum() for h in station_hours), 150)
+
+
+if __name__ == "__main__":
+    unittest.main()
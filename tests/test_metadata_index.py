@@ -0,0 +1,95 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from metadata_index import MetadataIndex, load_metadata_index
+from sdb_fake import FakeSDBConnection
+
+
+# Stations 1 -> 2 -> 3 downstream, 4 on another highway, 2 detectors each
+STATIONS = {
+    "1": {"stationid": "1", "highwayname": "I-205", "length_mid": "0.5",
+          "downstream": "2", "locationtext": "Sunnyside"},
+    "2": {"stationid": "2", "highwayname": "I-205", "length_mid": "1.25",
+          "downstream": "3", "locationtext": "Johnson Creek"},
+    "3": {"stationid": "3", "highwayname": "I-205", "length_mid": "",
+          "locationtext": "Foster"},
+    "4": {"stationid": "4", "highwayname": "I-5", "length_mid": "2",
+          "downstream": "4", "locationtext": "Marquam"},
+}
+
+
+class MetadataIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp(prefix="test_metadata_index_")
+        self.index_file = os.path.join(self.work_dir, "metadata.json")
+        self.conn = FakeSDBConnection(page_size=3)
+        self.station_dom = self.conn.create_domain("Station")
+        self.detector_dom = self.conn.create_domain("Detector")
+        self.station_dom.batch_put_attributes(STATIONS)
+        # Numeric IDs, 10 sorts after 9
+        self.detector_dom.batch_put_attributes(dict(
+            ("d%s" % n, {"detectorid": str(n), "stationid": str(n // 2 + 1),
+                         "lanenumber": str(n % 2 + 1)})
+            for n in range(2, 10)))
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def load(self):
+        return load_metadata_index(
+            self.station_dom, self.detector_dom,
+            self.conn.domain_metadata(self.station_dom),
+            self.conn.domain_metadata(self.detector_dom), self.index_file)
+
+    def test_mappings(self):
+        index = MetadataIndex.from_domains(self.station_dom,
+                                           self.detector_dom)
+        self.assertEqual(index.station_detectors,
+                         {"2": ["2", "3"], "3": ["4", "5"], "4": ["6", "7"],
+                          "5": ["8", "9"]})
+        self.assertEqual(index.detector_station["9"], "5")
+        self.assertEqual(index.station_length,
+                         {"1": 0.5, "2": 1.25, "4": 2.0})
+        self.assertEqual(index.find_stations(highwayname="I-205"),
+                         ["1", "2", "3"])
+        self.assertEqual(index.find_detectors(stationid="3", lanenumber="2"),
+                         ["5"])
+        self.assertEqual(index.station_chain("1"), ["1", "2", "3"])
+        self.assertEqual(index.station_chain("1", "Johnson Creek"),
+                         ["1", "2"])
+        # Its own downstream station
+        self.assertEqual(index.station_chain("4"), ["4"])
+
+    def test_paginated_selects(self):
+        MetadataIndex.from_domains(self.station_dom, self.detector_dom)
+        # 4 stations and 8 detectors, by 3 per page
+        self.assertEqual(self.conn.requests["Select"], 2 + 3)
+
+    def test_saved_until_stale(self):
+        index = self.load()
+        selects = self.conn.requests["Select"]
+        saved = self.load()
+        self.assertEqual(self.conn.requests["Select"], selects)
+        self.assertEqual(saved.station_detectors, index.station_detectors)
+        self.assertEqual(saved.station_length, index.station_length)
+        self.detector_dom.batch_put_attributes(
+            {"d10": {"detectorid": "10", "stationid": "5"}})
+        reloaded = self.load()
+        self.assertGreater(self.conn.requests["Select"], selects)
+        self.assertEqual(reloaded.station_detectors["5"], ["8", "9", "10"])
+        # Saved again, current
+        self.assertFalse(MetadataIndex.from_file(self.index_file).is_stale(
+            self.conn.domain_metadata(self.station_dom),
+            self.conn.domain_metadata(self.detector_dom)))
+
+    def test_corrupt_file_reloaded(self):
+        with open(self.index_file, "w") as index_handler:
+            index_handler.write("{")
+        self.assertEqual(self.load().detector_station["2"], "2")
+
+
+if __name__ == "__main__":
+    unittest.main()
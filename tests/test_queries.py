@@ -0,0 +1,155 @@
+import datetime
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy
+
+import queries
+from sdb_benchmark import (FIRST_STATION_NAME, LAST_STATION_NAME,
+                           generate_detectors, generate_stations, put_items)
+from sdb_fake import FakeSDBConnection
+from sdb_schema import LOOP_SCHEMA, format_starttime, to_epoch
+from tests.test_uploader import quiet
+
+
+# The globals init_conn and open_loop_cache set
+QUERY_GLOBALS = ("conn", "detector_dom", "loop_dom", "station_dom",
+                 "rollup_dom", "detector_meta", "loop_meta", "station_meta",
+                 "metadata", "select_cache", "connection_factory",
+                 "loop_cache")
+
+
+class QueriesTestCase(unittest.TestCase):
+    """The queries of a fake connection with the stations and detectors of
+    the benchmark, run in a temporary directory
+    """
+    station_count = 5
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.work_dir = tempfile.mkdtemp(prefix="test_queries_")
+        os.chdir(self.work_dir)
+        self.saved = dict((name, getattr(queries, name))
+                          for name in QUERY_GLOBALS)
+        self.conn = FakeSDBConnection()
+        self.stations = generate_stations(self.station_count)
+        self.detectors = generate_detectors(self.stations)
+        put_items(self.conn, queries.STATION_DOMAIN, self.stations)
+        put_items(self.conn, queries.DETECTOR_DOMAIN, self.detectors)
+        self.readings = {}
+
+    def tearDown(self):
+        if queries.select_cache is not self.saved["select_cache"]:
+            queries.select_cache.close()
+        for name, value in self.saved.items():
+            setattr(queries, name, value)
+        os.chdir(self.cwd)
+        shutil.rmtree(self.work_dir)
+
+    def add_reading(self, detector_id, starttime, speed, status="2"):
+        item = {"detectorid": detector_id, "status": status,
+                "starttime": format_starttime(to_epoch(starttime)),
+                "speed": str(speed)}
+        LOOP_SCHEMA.encode_item(item)
+        self.readings["%s-%s" % (detector_id, len(self.readings))] = item
+
+    def init_conn(self):
+        put_items(self.conn, queries.LOOP_DOMAIN, self.readings)
+        with quiet():
+            queries.init_conn(lambda: self.conn)
+
+    def station_ids(self):
+        return sorted(self.stations, key=int)
+
+    def station_speed(self, i):
+        return 20.0 + 10 * i
+
+
+class StationToStationTest(QueriesTestCase):
+
+    def test_pair_matrices(self):
+        eight = datetime.datetime(2011, 9, 22, 8)
+        nine = datetime.datetime(2011, 9, 22, 9)
+        station_ids = self.station_ids()
+        for i, station_id in enumerate(station_ids):
+            for timestamp in (eight, nine):
+                # No reading of the second station at 9
+                if timestamp == nine and i == 1:
+                    continue
+                for minute in range(5):
+                    for lane in range(3):
+                        self.add_reading(
+                            str(int(station_id) + lane + 1),
+                            timestamp + datetime.timedelta(minutes=minute),
+                            self.station_speed(i))
+        self.init_conn()
+        with quiet():
+            pairs = queries.station_to_station_travel_times([eight, nine])
+        self.assertEqual(pairs.shape, (2, 5, 5))
+        segments = [float(self.stations[s]["length_mid"]) /
+                    self.station_speed(i) for i, s in enumerate(station_ids)]
+        for i in range(5):
+            for j in range(i, 5):
+                self.assertAlmostEqual(pairs[0, i, j],
+                                       sum(segments[i:j + 1]))
+                if i <= 1 <= j:
+                    self.assertTrue(numpy.isnan(pairs[1, i, j]))
+                else:
+                    self.assertAlmostEqual(pairs[1, i, j],
+                                           sum(segments[i:j + 1]))
+        self.assertTrue(numpy.isnan(pairs[0, 3, 2]))
+        with open("query_4_station_to_station.txt") as result_file:
+            # A line per pair and timestamp under the header
+            self.assertEqual(len(result_file.readlines()), 1 + 2 * 15)
+
+    def test_chain_of_the_metadata(self):
+        self.init_conn()
+        station_ids, detector_ids = queries.corridor_chain(
+            FIRST_STATION_NAME, LAST_STATION_NAME, "I-205", "N")
+        self.assertEqual(list(station_ids), self.station_ids())
+        self.assertEqual(detector_ids[station_ids[0]],
+                         ["1001", "1002", "1003"])
+
+
+class HourlyCorridorTest(QueriesTestCase):
+
+    def test_hours_of_the_stations(self):
+        eight = datetime.datetime(2011, 9, 22, 8)
+        nine = datetime.datetime(2011, 9, 22, 9)
+        station_ids = self.station_ids()
+        for i, station_id in enumerate(station_ids):
+            for timestamp in (eight, nine):
+                # No reading of the second station at 9
+                if timestamp == nine and i == 1:
+                    continue
+                for minute in range(0, 60, 20):
+                    starttime = timestamp + datetime.timedelta(minutes=minute)
+                    self.add_reading(str(int(station_id) + 1), starttime,
+                                     self.station_speed(i))
+                    # Left out, not OK or no speed
+                    self.add_reading(str(int(station_id) + 2), starttime,
+                                     5, status="1")
+                    self.add_reading(str(int(station_id) + 3), starttime, 0)
+        self.init_conn()
+        with quiet():
+            queries.hourly_corridor_travel_times(
+                FIRST_STATION_NAME, LAST_STATION_NAME, "I-205", "N",
+                datetime.date(2011, 9, 22), datetime.date(2011, 9, 23))
+        with open("query_2_corridor_hourly.txt") as result_file:
+            header = result_file.readline()
+            rows = [line.strip().split(",") for line in result_file]
+        self.assertEqual(header, "starthour,travel_time,stations_reporting\n")
+        self.assertEqual([(row[0], row[2]) for row in rows],
+                         [("2011-09-22T08:00:00", "5"),
+                          ("2011-09-22T09:00:00", "4")])
+        segments = [float(self.stations[s]["length_mid"]) /
+                    self.station_speed(i) for i, s in enumerate(station_ids)]
+        self.assertAlmostEqual(float(rows[0][1]), sum(segments))
+        # Complete only when every station reported
+        self.assertTrue(numpy.isnan(float(rows[1][1])))
+
+
+if __name__ == "__main__":
+    unittest.main()
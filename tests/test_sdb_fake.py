@@ -0,0 +1,176 @@
+import json
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import boto.exception
+
+import queries
+import sdb_benchmark
+from sdb_fake import FakeSDBConnection
+from tests.test_queries import QUERY_GLOBALS
+from tests.test_uploader import quiet
+
+
+def error_code(call, *args):
+    try:
+        call(*args)
+    except boto.exception.SDBResponseError as e:
+        return e.status, e.error_code
+    return None
+
+
+class FakeSelectTest(unittest.TestCase):
+
+    def setUp(self):
+        self.conn = FakeSDBConnection(page_size=4)
+        self.domain = self.conn.create_domain("Test")
+        self.domain.batch_put_attributes(dict(
+            ("item%02d" % n, {"n": "%02d" % n, "parity": str(n % 2),
+                              "tags": ["a", "b"] if n % 3 == 0 else "c"})
+             for n in range(12)))
+        self.domain.batch_put_attributes({"empty": {"other": "x"}})
+
+    def names(self, where, order=""):
+        return [item.name for item in self.domain.select(
+            "SELECT * FROM `Test` WHERE %s %s" % (where, order))]
+
+    def test_expressions(self):
+        self.assertEqual(self.names("n = '03'"), ["item03"])
+        self.assertEqual(len(self.names("n >= '10'")), 2)
+        self.assertEqual(len(self.names("n != '03'")), 11)
+        self.assertEqual(self.names("n IN ('01', \"02\")"),
+                         ["item01", "item02"])
+        self.assertEqual(self.names("n BETWEEN '04' AND '06'"),
+                         ["item04", "item05", "item06"])
+        self.assertEqual(self.names("n LIKE '1%'"), ["item10", "item11"])
+        self.assertEqual(self.names("n IS NULL"), ["empty"])
+        self.assertEqual(len(self.names("n IS NOT NULL")), 12)
+        self.assertEqual(self.names("itemName() < 'item02'"),
+                         ["empty", "item00", "item01"])
+        self.assertEqual(
+            self.names("(n = '01' OR n = '02') AND NOT parity = '0'"),
+            ["item01"])
+        # Any value of a multi valued attribute
+        self.assertEqual(len(self.names("tags = 'b'")), 4)
+
+    def test_order_limit_and_pages(self):
+        # LIMIT is the size of the pages
+        page = self.conn.select(self.domain, "SELECT * FROM `Test` WHERE "
+                                "n > '07' ORDER BY n DESC LIMIT 3")
+        self.assertEqual([item.name for item in page],
+                         ["item11", "item10", "item09"])
+        self.assertEqual(self.names("n > '07'", "ORDER BY n DESC LIMIT 3"),
+                         ["item11", "item10", "item09", "item08"])
+        page = self.conn.select(self.domain, "SELECT * FROM `Test`")
+        self.assertEqual(len(page), 4)
+        self.assertTrue(page.next_token)
+        page = self.conn.select(self.domain, "SELECT * FROM `Test`",
+                                next_token=page.next_token)
+        self.assertEqual(page[0].name, "item03")
+        self.assertEqual(len(list(self.domain.select("SELECT * FROM `Test`",
+                                                     max_items=6))), 6)
+        self.assertEqual(error_code(self.conn.select, self.domain,
+                                    "SELECT * FROM `Test`", "999:4"),
+                         (400, "InvalidNextToken"))
+
+    def test_output_attributes_and_count(self):
+        item, = self.domain.select("SELECT n, tags FROM `Test` "
+                                   "WHERE n = '03'")
+        self.assertEqual(dict(item), {"n": "03", "tags": ["a", "b"]})
+        count, = self.domain.select("SELECT COUNT(*) FROM `Test` "
+                                    "WHERE parity = '1'")
+        self.assertEqual(count["Count"], "6")
+
+    def test_metadata(self):
+        metadata = self.conn.domain_metadata(self.domain)
+        self.assertEqual(metadata.item_count, 13)
+        self.assertIsNotNone(metadata.timestamp)
+
+    def test_replace(self):
+        self.domain.batch_put_attributes({"item00": {"tags": "d"}},
+                                         replace=False)
+        item, = self.domain.select("SELECT tags FROM `Test` "
+                                   "WHERE itemName() = 'item00'")
+        self.assertEqual(item["tags"], ["a", "b", "d"])
+        self.domain.batch_put_attributes({"item00": {"tags": "e"}})
+        item, = self.domain.select("SELECT tags FROM `Test` "
+                                   "WHERE itemName() = 'item00'")
+        self.assertEqual(item["tags"], "e")
+
+
+class FakeRequestTest(unittest.TestCase):
+
+    def test_errors(self):
+        conn = FakeSDBConnection()
+        domain = conn.create_domain("Test")
+        self.assertEqual(error_code(conn.get_domain, "Missing"),
+                         (400, "NoSuchDomain"))
+        self.assertIsNone(conn.lookup("Missing"))
+        self.assertEqual(
+            error_code(domain.batch_put_attributes,
+                       dict((str(n), {"a": "1"}) for n in range(26))),
+            (400, "NumberSubmittedItemsExceeded"))
+        self.assertEqual(
+            error_code(domain.batch_put_attributes,
+                       {"1": {"a": [str(n) for n in range(257)]}}),
+            (400, "NumberSubmittedAttributesExceeded"))
+        self.assertEqual(
+            error_code(list, domain.select("SELECT * FROM `Test` WHERE")),
+            (400, "InvalidQueryExpression"))
+
+    def test_requests_counted(self):
+        conn = FakeSDBConnection()
+        conn.create_domain("Test")
+        # Validated by name with a select first, like boto
+        conn.batch_put_attributes("Test", {"1": {"a": "1"}})
+        self.assertEqual(conn.requests, {"CreateDomain": 1, "Select": 1,
+                                         "BatchPutAttributes": 1})
+        self.assertEqual(conn.request_count(), 3)
+
+    def test_latency_and_throttling(self):
+        conn = FakeSDBConnection(latency=0.01, throttle_rate=0.5, seed=1)
+        started = time.time()
+        codes = [error_code(conn.create_domain, "Test") for _ in range(20)]
+        self.assertGreaterEqual(time.time() - started, 0.2)
+        throttled = codes.count((503, "ServiceUnavailable"))
+        self.assertEqual(throttled, conn.throttled)
+        self.assertTrue(0 < throttled < 20)
+
+
+class BenchmarkTest(unittest.TestCase):
+
+    def test_run(self):
+        work_dir = tempfile.mkdtemp(prefix="test_sdb_benchmark_")
+        json_file = os.path.join(work_dir, "benchmark.jsonl")
+        # The benchmark runs init_conn
+        saved = dict((name, getattr(queries, name))
+                     for name in QUERY_GLOBALS + ("LOOP_SHARD_COUNT",))
+        try:
+            with quiet():
+                sdb_benchmark.main(["--days", "1", "--interval", "900",
+                                    "--stations", "3", "--workers", "2",
+                                    "--rollup", "--schema",
+                                    "--json", json_file])
+            with open(json_file) as json_handler:
+                run = json.loads(json_handler.read())
+        finally:
+            for name, value in saved.items():
+                setattr(queries, name, value)
+            shutil.rmtree(work_dir)
+        results = dict((result["name"], result) for result in run["results"])
+        self.assertEqual(
+            sorted(results),
+            sorted(("upload_to_simpleDB", "init_conn") +
+                   sdb_benchmark.QUERY_BENCHMARKS))
+        # 9 detectors every 15 minutes of a day
+        self.assertEqual(results["upload_to_simpleDB"]["items"], 9 * 96)
+        # The requests of the forked map/reduce workers are not counted
+        self.assertGreater(results["upload_to_simpleDB"]["requests"], 9 * 4)
+        self.assertGreater(results["init_conn"]["requests"], 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
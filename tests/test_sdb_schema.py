@@ -0,0 +1,138 @@
+import datetime
+import unittest
+
+from sdb_fake import FakeSDBConnection
+from sdb_schema import (LOOP_SCHEMA, DecimalType, IntegerType, Schema,
+                        TimestampType, format_starttime, normalize_separator,
+                        parse_starttime, space_separated, to_epoch)
+from select_planner import typed_predicate
+from tests.test_uploader import UploadTestCase, domain_items, write_lines
+
+
+class TypesTest(unittest.TestCase):
+
+    def assertSortsLikeValues(self, attribute_type, values):
+        encoded = [attribute_type.encode(value) for value in values]
+        self.assertEqual(sorted(encoded),
+                         [attribute_type.encode(v) for v in sorted(values)])
+        self.assertEqual(len(set(len(e) for e in encoded)), 1)
+
+    def test_integers(self):
+        integers = IntegerType(4, offset=1000)
+        self.assertSortsLikeValues(integers, [-1000, -9, -10, 0, 9, 55, 8999])
+        self.assertEqual(integers.encode(-9), "0991")
+        self.assertEqual(integers.decode("0991"), -9)
+        for value in (-1001, 9000):
+            self.assertRaises(ValueError, integers.encode, value)
+        # No offset, the encoded strings read back with int()
+        self.assertEqual(int(IntegerType(6).encode(42)), 42)
+
+    def test_decimals(self):
+        decimals = DecimalType(4, 2)
+        self.assertSortsLikeValues(decimals, [0, 9, 55.5, 9.99, 100, 0.01])
+        self.assertEqual(decimals.encode("9.5"), "0009.50")
+        self.assertEqual(decimals.decode("0009.50"), 9.5)
+        self.assertEqual(float(decimals.encode(55.556)), 55.56)
+        self.assertRaises(ValueError, decimals.encode, -1)
+        self.assertRaises(ValueError, decimals.encode, "fast")
+        signed = DecimalType(3, 1, offset=100)
+        self.assertSortsLikeValues(signed, [-100, -0.5, -20, 0, 3.3])
+        self.assertAlmostEqual(signed.decode(signed.encode(-20.26)), -20.3)
+
+    def test_timestamps(self):
+        timestamps = TimestampType()
+        self.assertEqual(timestamps.encode("2011-09-15 07:05:00-07"),
+                         "2011-09-15T07:05:00")
+        self.assertEqual(timestamps.encode(datetime.datetime(2011, 9, 15, 7)),
+                         "2011-09-15T07:00:00")
+        epoch = to_epoch("2011-09-15T07:05:00")
+        self.assertEqual(timestamps.encode(epoch), "2011-09-15T07:05:00")
+        self.assertEqual(timestamps.decode("2011-09-15T07:05:00"), epoch)
+        self.assertEqual(parse_starttime("2011-09-15 07:05:00-07"), epoch)
+        self.assertEqual(format_starttime(epoch), "2011-09-15T07:05:00")
+        self.assertIsNone(to_epoch(None))
+
+    def test_separator(self):
+        self.assertTrue(space_separated("2011-09-15 07:05:00-07"))
+        self.assertFalse(space_separated("2011-09-15T07:05:00"))
+        self.assertFalse(space_separated("a b"))
+        self.assertFalse(space_separated(None))
+        self.assertEqual(normalize_separator("2011-09-15 07:05:00-07"),
+                         "2011-09-15T07:05:00-07")
+        self.assertEqual(normalize_separator("55"), "55")
+        # A space separated starttime sorts below the day of its date
+        self.assertLess("2011-09-15 23:00:00", "2011-09-15T00:00:00")
+
+
+class SchemaTest(unittest.TestCase):
+
+    def test_items(self):
+        item = {"speed": "55.5", "volume": "12", "occupancy": "",
+                "starttime": "2011-09-15 07:05:00-07", "status": "2",
+                "detectorid": "1001"}
+        self.assertEqual(LOOP_SCHEMA.encode_item(item), 0)
+        self.assertEqual(item, {"speed": "0055.50", "volume": "000012",
+                                "occupancy": "",
+                                "starttime": "2011-09-15T07:05:00",
+                                "status": "2", "detectorid": "1001"})
+        decoded = LOOP_SCHEMA.decode_item(item)
+        self.assertEqual(decoded["speed"], 55.5)
+        self.assertEqual(decoded["volume"], 12)
+        self.assertIsNone(decoded["occupancy"])
+        self.assertEqual(decoded["starttime"],
+                         to_epoch("2011-09-15T07:05:00"))
+        self.assertEqual(decoded["detectorid"], "1001")
+        bad = {"speed": "-3", "volume": "x"}
+        self.assertEqual(LOOP_SCHEMA.encode_item(bad), 2)
+        self.assertEqual(bad, {"speed": "", "volume": ""})
+
+    def test_unencoded_values_decode(self):
+        # Uploaded without the schema
+        self.assertEqual(LOOP_SCHEMA.decode_value("speed", "55"), 55.0)
+        self.assertEqual(LOOP_SCHEMA.decode_value("volume", "7"), 7)
+        self.assertEqual(Schema({}).decode_value("speed", "55"), "55")
+
+    def test_predicates_on_the_server(self):
+        conn = FakeSDBConnection()
+        domain = conn.create_domain("Loop")
+        speeds = [0, 5, 9.5, 10, 55, 100]
+        items = {}
+        for i, speed in enumerate(speeds):
+            item = {"speed": str(speed), "starttime": format_starttime(
+                to_epoch("2011-09-15T00:00:00") + i * 3600)}
+            LOOP_SCHEMA.encode_item(item)
+            items[str(i)] = item
+        domain.batch_put_attributes(items)
+        selected = domain.select(
+            "SELECT speed FROM `Loop` WHERE %s AND starttime IS NOT NULL "
+            "ORDER BY speed DESC" %
+            typed_predicate("speed", ">", 9, LOOP_SCHEMA))
+        self.assertEqual([LOOP_SCHEMA.decode_value("speed", item["speed"])
+                          for item in selected], [100, 55, 10, 9.5])
+        selected = domain.select(
+            "SELECT * FROM `Loop` WHERE starttime BETWEEN %s AND %s "
+            "ORDER BY starttime" % (
+                '"2011-09-15T01:00:00"', '"2011-09-15T03:00:00"'))
+        self.assertEqual([item.name for item in selected], ["1", "2", "3"])
+
+
+class SchemaUploadTest(UploadTestCase):
+
+    def test_encoded_by_the_uploader(self):
+        write_lines("data/loop.csv", [
+            (1, "2011-09-15 07:05:00-07", 55.5),
+            (2, "2011-09-15 07:06:00-07", "-4"),
+            (3, "2011-09-15 07:07:00-07", "")])
+        conn = FakeSDBConnection()
+        self.upload(conn, "Loop", header="detectorid,starttime,speed",
+                    key_column="detectorid", schema=LOOP_SCHEMA)
+        items = domain_items(conn, "Loop")
+        self.assertEqual(items["1"]["speed"], ["0055.50"])
+        self.assertEqual(items["1"]["starttime"], ["2011-09-15T07:05:00"])
+        # Did not fit, uploaded empty
+        self.assertEqual(items["2"]["speed"], [""])
+        self.assertEqual(items["3"]["speed"], [""])
+
+
+if __name__ == "__main__":
+    unittest.main()
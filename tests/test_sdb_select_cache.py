@@ -0,0 +1,138 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from sdb_fake import FakeSDBConnection
+from sdb_select_cache import CachedDomain, SelectCache, normalize_query
+from sdb_shards import ShardedDomain
+
+
+class SelectCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp(prefix="test_select_cache_")
+        self.conn = FakeSDBConnection(page_size=10)
+        self.domain = self.conn.create_domain("Test")
+        self.domain.batch_put_attributes(
+            dict(("%02d" % n, {"n": str(n), "even": str(n % 2 == 0)})
+                 for n in range(25)))
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def cache(self, **kwargs):
+        cache = SelectCache(self.cache_dir, **kwargs)
+        cache.validate("Test", self.conn.domain_metadata(self.domain))
+        return cache
+
+    def selects(self, domain, query, **kwargs):
+        """The items of the query, and the selects it sent"""
+        selects = self.conn.requests.get("Select", 0)
+        items = sorted((item.name, dict(item))
+                       for item in domain.select(query, **kwargs))
+        return items, self.conn.requests.get("Select", 0) - selects
+
+
+class SelectCacheTest(SelectCacheTestCase):
+
+    def test_normalize_query(self):
+        self.assertEqual(
+            normalize_query("  SELECT *\n FROM `Test`   WHERE a = 'x  y' "),
+            "SELECT * FROM `Test` WHERE a = 'x  y'")
+
+    def test_hit_across_processes(self):
+        domain = CachedDomain(self.domain, self.cache())
+        items, selects = self.selects(domain, "SELECT * FROM `Test`")
+        self.assertEqual(len(items), 25)
+        self.assertEqual(selects, 3)
+        domain.cache.close()
+        # Another run, same data
+        domain = CachedDomain(self.domain, self.cache())
+        cached, selects = self.selects(domain, "SELECT *  FROM `Test`")
+        self.assertEqual(cached, items)
+        self.assertEqual(selects, 0)
+        self.assertEqual((domain.cache.hits, domain.cache.misses), (1, 0))
+
+    def test_key_of_the_flags(self):
+        domain = CachedDomain(self.domain, self.cache())
+        self.selects(domain, "SELECT * FROM `Test`")
+        items, selects = self.selects(domain, "SELECT * FROM `Test`",
+                                      consistent_read=True)
+        self.assertGreater(selects, 0)
+        items, selects = self.selects(domain, "SELECT * FROM `Test`",
+                                      max_items=5)
+        self.assertEqual(len(items), 5)
+        self.assertGreater(selects, 0)
+
+    def test_invalidated_by_the_metadata(self):
+        domain = CachedDomain(self.domain, self.cache())
+        self.selects(domain, "SELECT * FROM `Test`")
+        self.domain.batch_put_attributes({"99": {"n": "99"}})
+        # Stale until validated again
+        self.assertEqual(self.selects(domain, "SELECT * FROM `Test`")[1], 0)
+        cache = self.cache()
+        self.assertEqual(len(cache.entries), 0)
+        items, selects = self.selects(CachedDomain(self.domain, cache),
+                                      "SELECT * FROM `Test`")
+        self.assertEqual(len(items), 26)
+        self.assertGreater(selects, 0)
+
+    def test_not_validated_not_cached(self):
+        domain = CachedDomain(self.domain, SelectCache(self.cache_dir))
+        self.selects(domain, "SELECT * FROM `Test`")
+        self.assertGreater(self.selects(domain, "SELECT * FROM `Test`")[1],
+                           0)
+
+    def test_abandoned_select_not_cached(self):
+        domain = CachedDomain(self.domain, self.cache())
+        items = domain.select("SELECT * FROM `Test`")
+        next(items)
+        items.close()
+        self.assertEqual(domain.cache.entries, {})
+        self.assertEqual(sorted(os.listdir(self.cache_dir)), [])
+
+    def test_least_recently_used_evicted(self):
+        cache = self.cache()
+        domain = CachedDomain(self.domain, cache)
+        self.selects(domain, "SELECT * FROM `Test` WHERE even = 'True'")
+        entry_bytes = cache.entries.values()[0]["bytes"]
+        cache.max_bytes = 2 * entry_bytes
+        self.selects(domain, "SELECT * FROM `Test` WHERE even = 'False'")
+        # The first one used last
+        self.selects(domain, "SELECT * FROM `Test` WHERE even = 'True'")
+        self.selects(domain, "SELECT * FROM `Test` WHERE n = '1'")
+        self.assertEqual(self.selects(
+            domain, "SELECT * FROM `Test` WHERE even = 'True'")[1], 0)
+        self.assertGreater(self.selects(
+            domain, "SELECT * FROM `Test` WHERE even = 'False'")[1], 0)
+        self.assertLessEqual(sum(e["bytes"] for e in cache.entries.values()),
+                             cache.max_bytes)
+
+    def test_too_big_not_cached(self):
+        domain = CachedDomain(self.domain, self.cache(max_bytes=100))
+        items, _ = self.selects(domain, "SELECT * FROM `Test`")
+        self.assertEqual(len(items), 25)
+        self.assertEqual(domain.cache.entries, {})
+
+
+class CachedShardedDomainTest(SelectCacheTestCase):
+
+    def test_select_many(self):
+        sharded = ShardedDomain(self.conn, "Test")
+        domain = CachedDomain(sharded, self.cache())
+        queries = ["SELECT * FROM `Test` WHERE itemName() < '10'",
+                   "SELECT * FROM `Test` WHERE itemName() >= '10'"]
+        items = [item.name for item in domain.select_many(queries,
+                                                          ordered=True)]
+        self.assertEqual(items, ["%02d" % n for n in range(25)])
+        selects = self.conn.requests["Select"]
+        cached = [item.name for item in domain.select_many(queries,
+                                                           ordered=True)]
+        self.assertEqual(cached, items)
+        self.assertEqual(self.conn.requests["Select"], selects)
+        self.assertEqual(domain.get_metadata().item_count, 25)
+
+
+if __name__ == "__main__":
+    unittest.main()
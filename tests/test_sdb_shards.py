@@ -0,0 +1,178 @@
+import threading
+import time
+import unittest
+
+import boto.exception
+
+import sdb_shards
+from sdb_fake import FakeSDBConnection
+from sdb_shards import (ShardedDomain, fan_out_select, shard_domain_names,
+                        shard_index)
+from select_planner import item_name_partitions, partition_query
+from tests.test_uploader import UploadTestCase, domain_items, write_lines
+
+
+def sharded_conn(shard_count, item_count=300):
+    """A fake connection with the items 000.. spread across the shards"""
+    conn = FakeSDBConnection(page_size=25)
+    names = shard_domain_names("Test", shard_count)
+    for name in names:
+        conn.create_domain(name)
+    for n in range(item_count):
+        item_name = "%03d" % n
+        conn.batch_put_attributes(names[shard_index(item_name, shard_count)],
+                                  {item_name: {"n": item_name}})
+    return conn
+
+
+class ConcurrentSelectConnection(FakeSDBConnection):
+    """Records the most Select requests in flight at once"""
+
+    def __init__(self, **kwargs):
+        FakeSDBConnection.__init__(self, **kwargs)
+        self.in_flight = 0
+        self.most_in_flight = 0
+        self.in_flight_lock = threading.Lock()
+
+    def select(self, *args, **kwargs):
+        with self.in_flight_lock:
+            self.in_flight += 1
+            self.most_in_flight = max(self.most_in_flight, self.in_flight)
+        try:
+            time.sleep(0.002)
+            return FakeSDBConnection.select(self, *args, **kwargs)
+        finally:
+            with self.in_flight_lock:
+                self.in_flight -= 1
+
+
+class ShardIndexTest(unittest.TestCase):
+
+    def test_stable(self):
+        # Same shard in every process, no dependency on hash()
+        self.assertEqual([shard_index("1001%s" % i, 4) for i in range(8)],
+                         [shard_index(u"1001%s" % i, 4) for i in range(8)])
+        self.assertEqual(shard_index(1001, 4), shard_index("1001", 4))
+        self.assertEqual(shard_index("anything", 1), 0)
+        self.assertEqual(shard_domain_names("Test", 1), ["Test"])
+        self.assertEqual(shard_domain_names("Test", 3),
+                         ["Test_0", "Test_1", "Test_2"])
+
+    def test_spread(self):
+        counts = [0] * 4
+        for n in range(4000):
+            counts[shard_index(str(n), 4)] += 1
+        self.assertTrue(all(800 < count < 1200 for count in counts))
+
+
+class ShardedDomainTest(unittest.TestCase):
+
+    def test_select_merges_the_shards(self):
+        conn = sharded_conn(4)
+        domain = ShardedDomain(conn, "Test", 4)
+        items = list(domain.select("SELECT * FROM `Test`"))
+        self.assertEqual(sorted(item.name for item in items),
+                         ["%03d" % n for n in range(300)])
+        counts = list(domain.select("SELECT COUNT(*) FROM `Test`"))
+        self.assertEqual(len(counts), 4)
+        self.assertEqual(sum(int(c["Count"]) for c in counts), 300)
+        self.assertEqual(domain.get_metadata().item_count, 300)
+
+    def test_max_items(self):
+        domain = ShardedDomain(sharded_conn(4), "Test", 4)
+        self.assertEqual(
+            len(list(domain.select("SELECT * FROM `Test`", max_items=30))),
+            30)
+
+    def test_select_many_ordered(self):
+        domain = ShardedDomain(sharded_conn(3), "Test", 3)
+        queries = ["SELECT * FROM `Test` WHERE itemName() >= '%03d' "
+                   "AND itemName() < '%03d'" % (n, n + 50)
+                   for n in range(0, 300, 50)]
+        items = list(domain.select_many(queries, ordered=True,
+                                        max_workers=2))
+        # Every partition after the ones before it
+        partitions = [int(item.name) // 50 for item in items]
+        self.assertEqual(partitions, sorted(partitions))
+        self.assertEqual(len(items), 300)
+
+    def test_shard_errors_raised(self):
+        conn = sharded_conn(2)
+        domain = ShardedDomain(conn, "Test", 2)
+        del conn.domains["Test_1"]
+        with self.assertRaises(boto.exception.SDBResponseError):
+            list(fan_out_select([(d, domain.shard_query(
+                "SELECT * FROM `Test`", d)) for d in domain.domains]))
+
+
+class FanOutSelectTest(unittest.TestCase):
+
+    def partitions(self, conn, count=8):
+        boundaries = ["%03d" % (300 * i // count) for i in range(1, count)]
+        domain = conn.get_domain("Test")
+        return [(domain, query) for query in partition_query(
+            "SELECT * FROM `Test`", item_name_partitions(boundaries))]
+
+    def test_ordered_merge(self):
+        conn = sharded_conn(1)
+        items = list(fan_out_select(self.partitions(conn), ordered=True))
+        self.assertEqual([item.name for item in items],
+                         ["%03d" % n for n in range(300)])
+
+    def test_bounded_pool(self):
+        conn = ConcurrentSelectConnection(page_size=10)
+        conn.create_domain("Test").batch_put_attributes(
+            dict(("%03d" % n, {"n": "1"}) for n in range(0, 300, 12)))
+        items = list(fan_out_select(self.partitions(conn), max_workers=3))
+        self.assertEqual(len(items), 25)
+        self.assertEqual(conn.most_in_flight, 3)
+
+    def test_backpressure(self):
+        depth, poll = sdb_shards.FAN_OUT_QUEUE_DEPTH, sdb_shards._FAN_OUT_POLL
+        sdb_shards.FAN_OUT_QUEUE_DEPTH = 5
+        sdb_shards._FAN_OUT_POLL = 0.01
+        thread_count = threading.active_count()
+        try:
+            conn = sharded_conn(1)
+            conn.page_size = 5
+            partitions = self.partitions(conn, 2)
+            selects = conn.requests["Select"]
+            items = fan_out_select(partitions, ordered=True)
+            try:
+                next(items)
+                time.sleep(0.1)
+            finally:
+                items.close()
+            # A page or two ahead of the consumer in each stream, not the
+            # 60 pages of the partitions
+            self.assertLessEqual(conn.requests["Select"] - selects, 2 * 3)
+            # The fetchers stop once the consumer is gone
+            for _ in range(100):
+                if threading.active_count() == thread_count:
+                    break
+                time.sleep(0.01)
+            self.assertEqual(threading.active_count(), thread_count)
+        finally:
+            sdb_shards.FAN_OUT_QUEUE_DEPTH = depth
+            sdb_shards._FAN_OUT_POLL = poll
+
+
+class ShardedUploadTest(UploadTestCase):
+
+    def test_items_in_the_shard_of_their_key(self):
+        write_lines("data/0.csv", [(n % 7, n) for n in range(500)])
+        conn = FakeSDBConnection()
+        self.upload(conn, shard_count=3, header="detectorid,n",
+                    key_column="n", shard_key="detectorid")
+        names = shard_domain_names("Test", 3)
+        self.assertEqual(len(domain_items(conn, "Test", 3)), 500)
+        for i, name in enumerate(names):
+            for attrs in conn.domains[name].values():
+                self.assertEqual(shard_index(attrs["detectorid"][0], 3), i)
+        domain = ShardedDomain(conn, "Test", 3)
+        self.assertEqual(len(list(domain.select("SELECT * FROM `Test`"))),
+                         500)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,102 @@
+import json
+import os
+import unittest
+
+from sdb_fake import FakeSDBConnection
+from sdb_telemetry import (HISTOGRAM_BOUNDS, LatencyHistogram, Telemetry,
+                           TelemetryReporter, WorkerMetrics, format_progress)
+from tests.test_uploader import UploadTestCase, quiet, write_lines
+
+
+class LatencyHistogramTest(unittest.TestCase):
+
+    def test_buckets_and_percentiles(self):
+        histogram = LatencyHistogram()
+        for seconds in [0.0005] * 50 + [0.003] * 40 + [100.0] * 10:
+            histogram.record(seconds)
+        self.assertEqual(histogram.count, 100)
+        self.assertEqual(histogram.buckets[0], 50)
+        self.assertEqual(histogram.buckets[2], 40)
+        self.assertEqual(histogram.buckets[len(HISTOGRAM_BOUNDS)], 10)
+        self.assertEqual(histogram.percentile(50), HISTOGRAM_BOUNDS[0])
+        self.assertEqual(histogram.percentile(90), HISTOGRAM_BOUNDS[2])
+        # Slower than the last bound, the slowest one
+        self.assertEqual(histogram.percentile(99), 100.0)
+        self.assertIsNone(LatencyHistogram().percentile(50))
+
+    def test_merge_round_trip(self):
+        first, second = LatencyHistogram(), LatencyHistogram()
+        first.record(0.01)
+        second.record(0.5)
+        second.record(0.002)
+        first.merge(LatencyHistogram.from_dict(second.to_dict()))
+        self.assertEqual(first.count, 3)
+        self.assertEqual((first.min, first.max), (0.002, 0.5))
+        self.assertAlmostEqual(first.total, 0.512)
+
+
+class TelemetryTest(unittest.TestCase):
+
+    def test_workers_of_other_processes_merged(self):
+        telemetry = Telemetry()
+        telemetry.add_totals(100, 4000)
+        telemetry.worker("sender-0").count("items_sent", 30)
+        parser = WorkerMetrics()
+        parser.count("items_parsed", 60)
+        parser.observe("parse_seconds", 0.2)
+        # Twice from the same process, once per work unit
+        telemetry.merge_worker(1234, parser.to_dict())
+        telemetry.merge_worker(1234, parser.to_dict())
+        snapshot = telemetry.snapshot()
+        self.assertEqual(snapshot["total_lines"], 100)
+        self.assertEqual(snapshot["total_bytes"], 4000)
+        self.assertEqual(snapshot["done"], 30)
+        counters = snapshot["total"]["counters"]
+        self.assertEqual(counters, {"items_sent": 30, "items_parsed": 120})
+        self.assertEqual(
+            snapshot["workers"][1234]["histograms"]["parse_seconds"]["count"],
+            2)
+        self.assertIsNotNone(snapshot["eta_seconds"])
+        self.assertIn("30/100 items (30.0%)", format_progress(snapshot))
+        json.dumps(snapshot)
+
+
+class TelemetryFileTest(UploadTestCase):
+
+    def test_reporter_appends_snapshots(self):
+        telemetry = Telemetry()
+        reporter = TelemetryReporter(telemetry, "telemetry.jsonl",
+                                     interval=3600)
+        reporter.start()
+        with quiet():
+            reporter.report()
+            reporter.stop()
+        with open("telemetry.jsonl") as telemetry_handler:
+            self.assertEqual(len(telemetry_handler.readlines()), 2)
+
+    def test_upload_totals(self):
+        for i in range(3):
+            write_lines("data/%s.csv" % i,
+                        [("%s-%s" % (i, n), n) for n in range(250)])
+        conn = FakeSDBConnection()
+        self.upload(conn, telemetry_file="telemetry.jsonl")
+        with open("telemetry.jsonl") as telemetry_handler:
+            snapshot = json.loads(telemetry_handler.readlines()[-1])
+        counters = snapshot["total"]["counters"]
+        self.assertEqual(snapshot["total_lines"], 750)
+        self.assertEqual(snapshot["total_bytes"],
+                         sum(os.path.getsize("data/%s.csv" % i)
+                             for i in range(3)))
+        self.assertEqual(counters["items_parsed"], 750)
+        self.assertEqual(counters["items_sent"], 750)
+        self.assertEqual(counters["requests"],
+                         conn.requests["BatchPutAttributes"])
+        self.assertEqual(counters["batches_sent"],
+                         conn.requests["BatchPutAttributes"])
+        self.assertEqual(
+            snapshot["total"]["histograms"]["request_seconds"]["count"],
+            counters["requests"])
+
+
+if __name__ == "__main__":
+    unittest.main()
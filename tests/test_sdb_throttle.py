@@ -0,0 +1,103 @@
+import socket
+import unittest
+
+import boto.exception
+
+from sdb_fake import FakeSDBConnection
+from sdb_throttle import (AdaptiveThrottle, is_retryable_error,
+                          is_throttling_error, throttled_select)
+
+
+def response_error(status, code=None):
+    error = boto.exception.SDBResponseError(status, "Reason")
+    error.error_code = code
+    return error
+
+
+class Flaky(object):
+    """Fails with the given errors, then returns "done" """
+
+    def __init__(self, *errors):
+        self.errors = list(errors)
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        if self.errors:
+            raise self.errors.pop(0)
+        return "done"
+
+
+class ErrorTest(unittest.TestCase):
+
+    def test_classification(self):
+        self.assertTrue(is_throttling_error(response_error(503)))
+        self.assertTrue(is_throttling_error(
+            response_error(400, "RequestThrottled")))
+        self.assertFalse(is_throttling_error(response_error(500)))
+        self.assertTrue(is_retryable_error(response_error(500)))
+        self.assertTrue(is_retryable_error(socket.error()))
+        self.assertFalse(is_retryable_error(response_error(400)))
+        self.assertFalse(is_retryable_error(ValueError()))
+
+
+class AdaptiveThrottleTest(unittest.TestCase):
+
+    def throttle(self, **kwargs):
+        kwargs.setdefault("base_delay", 0.0001)
+        return AdaptiveThrottle(**kwargs)
+
+    def test_throttled_retried_and_limit_halved(self):
+        throttle = self.throttle(initial_limit=8)
+        flaky = Flaky(response_error(503), response_error(503))
+        self.assertEqual(throttle.call(flaky), "done")
+        self.assertEqual(flaky.calls, 3)
+        self.assertEqual((throttle.throttled, throttle.retries), (2, 2))
+        # Decreased once within target_latency
+        self.assertEqual(throttle.limit, 4)
+
+    def test_client_error_not_retried(self):
+        throttle = self.throttle()
+        flaky = Flaky(response_error(400))
+        with self.assertRaises(boto.exception.SDBResponseError):
+            throttle.call(flaky)
+        self.assertEqual(flaky.calls, 1)
+
+    def test_retries_exhausted(self):
+        throttle = self.throttle(max_retries=2)
+        flaky = Flaky(*[response_error(500)] * 5)
+        with self.assertRaises(boto.exception.SDBResponseError):
+            throttle.call(flaky)
+        self.assertEqual(flaky.calls, 3)
+
+    def test_limit_grows_after_healthy_window(self):
+        throttle = self.throttle(initial_limit=2, max_limit=3)
+        for _ in range(20):
+            throttle.call(Flaky())
+        self.assertEqual(throttle.limit, 3)
+
+    def test_backoff_capped(self):
+        throttle = AdaptiveThrottle(base_delay=1.0, max_delay=2.0)
+        for attempt in range(10):
+            self.assertLessEqual(throttle.backoff(attempt), 2.0)
+
+
+class ThrottledSelectTest(unittest.TestCase):
+
+    def test_pages_retried(self):
+        conn = FakeSDBConnection(page_size=10, seed=3)
+        domain = conn.create_domain("Test")
+        for i in range(0, 200, 25):
+            domain.batch_put_attributes(
+                dict(("%03d" % n, {"a": str(n)}) for n in range(i, i + 25)))
+        conn.throttle_rate = 0.3
+        throttle = AdaptiveThrottle(base_delay=0.0001, max_retries=20)
+        items = list(throttled_select(domain, "SELECT * FROM Test",
+                                      throttle=throttle))
+        self.assertEqual(sorted(item.name for item in items),
+                         ["%03d" % n for n in range(200)])
+        self.assertGreater(throttle.throttled, 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
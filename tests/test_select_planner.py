@@ -0,0 +1,209 @@
+import unittest
+
+import boto.exception
+
+import select_planner
+from sdb_fake import FakeSDBConnection
+from sdb_schema import LOOP_SCHEMA, format_starttime, to_epoch
+from sdb_shards import ShardedDomain, shard_domain_names, shard_index
+from select_planner import (MAX_COMPARISONS, LoopSelectPlan, add_predicate,
+                            comparison_count, hex_boundaries,
+                            item_name_partitions, partition_query,
+                            starttime_partitions, typed_predicate)
+
+
+START = to_epoch("2011-09-15T00:00:00")
+
+
+def loop_plan(detector_ids, **kwargs):
+    """The plan of queries.loop_readings with both filters"""
+    return LoopSelectPlan(
+        "Loop", detector_ids, START, START + 86400, filters={"status": "2"},
+        predicates=[typed_predicate("speed", ">", 0, LOOP_SCHEMA)], **kwargs)
+
+
+def put_minute_readings(conn, detector_count, minutes, shard_count=1):
+    """A reading of every detector every minute from START, spread across
+    the shards by item name
+    """
+    names = shard_domain_names("Loop", shard_count)
+    for name in names:
+        conn.create_domain(name)
+    shards = [{} for _ in names]
+    for detector in range(detector_count):
+        for minute in range(minutes):
+            item = {"detectorid": str(1000 + detector), "status": "2",
+                    "starttime": format_starttime(START + 60 * minute),
+                    "speed": str(30 + minute % 20)}
+            LOOP_SCHEMA.encode_item(item)
+            item_name = "%s-%04d" % (1000 + detector, minute)
+            shards[shard_index(item_name, shard_count)][item_name] = item
+    for name, items in zip(names, shards):
+        item_names = sorted(items)
+        for i in range(0, len(item_names), 25):
+            conn.batch_put_attributes(
+                name, dict((n, items[n]) for n in item_names[i:i + 25]))
+
+
+class ComparisonCountTest(unittest.TestCase):
+
+    def test_counts(self):
+        self.assertEqual(comparison_count('detectorid = "1"'), 1)
+        self.assertEqual(comparison_count('detectorid IN ("1", "2", "3")'), 3)
+        self.assertEqual(comparison_count(
+            'starttime >= "2011-09-15T00:00:00" AND '
+            'starttime < "2011-09-16T00:00:00"'), 2)
+        self.assertEqual(comparison_count("`status` != '2'"), 1)
+        self.assertEqual(comparison_count("itemName() IS NOT NULL"), 1)
+        self.assertEqual(comparison_count("name LIKE 'a%'"), 1)
+
+    def test_quoted_operators_do_not_count(self):
+        self.assertEqual(comparison_count('note = "a >= b, IN (c)"'), 1)
+        self.assertEqual(comparison_count('a IN ("x,y", "z")'), 2)
+
+
+class LoopSelectPlanTest(unittest.TestCase):
+
+    def test_in_lists_leave_room_for_the_other_comparisons(self):
+        detector_ids = [str(1000 + i) for i in range(45)]
+        plan = loop_plan(detector_ids)
+        queries = plan.queries()
+        for query in queries:
+            where = query.split(" WHERE ", 1)[1]
+            self.assertLessEqual(comparison_count(where), MAX_COMPARISONS)
+        self.assertEqual(len(queries), 3)
+        self.assertEqual(sum(len(batch) for batch in plan.detector_batches()),
+                         45)
+
+    def test_batch_is_capped_by_the_limit(self):
+        plan = loop_plan(range(45), detectors_per_select=MAX_COMPARISONS)
+        self.assertEqual(plan.detectors_per_select, MAX_COMPARISONS - 4)
+        plan = LoopSelectPlan("Loop", range(45))
+        self.assertEqual(plan.detectors_per_select,
+                         select_planner.DETECTORS_PER_SELECT)
+
+    def test_too_many_other_comparisons(self):
+        filters = dict(("a%s" % i, "1") for i in range(MAX_COMPARISONS))
+        with self.assertRaises(ValueError):
+            LoopSelectPlan("Loop", ["1"], filters=filters)
+
+    def test_plan_runs_on_fake(self):
+        conn = FakeSDBConnection()
+        domain = conn.create_domain("Loop")
+        items = {}
+        for detector in range(45):
+            for minute in range(3):
+                item = {"detectorid": str(1000 + detector),
+                        "starttime": format_starttime(START + 60 * minute),
+                        "speed": str(minute * 10), "status": "2"}
+                LOOP_SCHEMA.encode_item(item)
+                items["%s-%s" % (detector, minute)] = item
+        names = sorted(items)
+        for i in range(0, len(names), 25):
+            domain.batch_put_attributes(
+                dict((n, items[n]) for n in names[i:i + 25]))
+        plan = loop_plan([str(1000 + d) for d in range(45)])
+        selected = list(plan.select(domain))
+        # The readings of minute 0 have no positive speed
+        self.assertEqual(len(selected), 90)
+
+    def test_ranges_share_the_selects(self):
+        # The 7-9AM of 20 days
+        ranges = [(START + day * 86400 + 7 * 3600,
+                   START + day * 86400 + 9 * 3600) for day in range(20)]
+        detector_ids = [str(1000 + i) for i in range(10)]
+        plan = loop_plan(detector_ids, ranges=ranges)
+        queries = plan.queries()
+        for query in queries:
+            where = query.split(" WHERE ", 1)[1]
+            self.assertLessEqual(comparison_count(where), MAX_COMPARISONS)
+        self.assertLess(len(queries), len(ranges))
+        windows = plan.windows()
+        self.assertEqual(sorted(r for window in windows for r in window),
+                         ranges)
+
+    def test_ranges_select_their_readings_only(self):
+        conn = FakeSDBConnection()
+        domain = conn.create_domain("Loop")
+        items = {}
+        for hour in range(48):
+            item = {"detectorid": "1000", "speed": "50", "status": "2",
+                    "starttime": format_starttime(START + hour * 3600)}
+            LOOP_SCHEMA.encode_item(item)
+            items[str(hour)] = item
+        domain.batch_put_attributes(dict(items.items()[:25]))
+        domain.batch_put_attributes(dict(items.items()[25:]))
+        ranges = [(START + (day * 24 + 7) * 3600,
+                   START + (day * 24 + 9) * 3600) for day in range(2)]
+        plan = loop_plan(["1000"], ranges=ranges)
+        self.assertEqual(len(plan.queries()), 1)
+        hours = sorted((to_epoch(item["starttime"]) - START) // 3600
+                       for item in plan.select(domain))
+        self.assertEqual(hours, [7, 8, 31, 32])
+
+    def test_starttime_ranges_instead_of_like(self):
+        plan = loop_plan(["1000", "1001"], window_seconds=3600)
+        queries = plan.queries()
+        self.assertEqual(len(queries), 24)
+        for query in queries:
+            self.assertNotIn("LIKE", query)
+        self.assertIn('detectorid IN ("1000", "1001")', queries[0])
+        self.assertIn('starttime >= "2011-09-15T00:00:00" AND '
+                      'starttime < "2011-09-15T01:00:00"', queries[0])
+        self.assertIn('starttime >= "2011-09-15T23:00:00" AND '
+                      'starttime < "2011-09-16T00:00:00"', queries[-1])
+
+    def test_groups_of_each_window(self):
+        conn = FakeSDBConnection(page_size=40)
+        put_minute_readings(conn, 3, 120, shard_count=2)
+        domain = ShardedDomain(conn, "Loop", 2)
+        plan = LoopSelectPlan("Loop", ["1000", "1001", "1002"], START,
+                              START + 7200, window_seconds=3600)
+        selects = conn.requests["Select"]
+        slots = []
+        for slot, items in plan.iter_groups(
+                domain, lambda item: to_epoch(item["starttime"]) // 300):
+            self.assertEqual(len(items), 3 * 5)
+            slots.append(slot)
+        self.assertEqual(slots, [START // 300 + i for i in range(24)])
+        # 2 windows on 2 shards, about 90 readings each by 40 a page
+        self.assertEqual(conn.requests["Select"] - selects, 2 * 2 * 3)
+
+    def test_fake_rejects_too_many_comparisons(self):
+        conn = FakeSDBConnection()
+        domain = conn.create_domain("Loop")
+        values = ", ".join('"%s"' % i for i in range(MAX_COMPARISONS))
+        list(domain.select("SELECT * FROM Loop WHERE a IN (%s)" % values))
+        with self.assertRaises(boto.exception.SDBResponseError):
+            list(domain.select("SELECT * FROM Loop WHERE a IN (%s) AND b = '1'"
+                               % values))
+
+
+class PartitionQueryTest(unittest.TestCase):
+
+    def test_add_predicate(self):
+        self.assertEqual(add_predicate("SELECT * FROM `Loop`", "a = '1'"),
+                         "SELECT * FROM `Loop` WHERE a = '1'")
+        self.assertEqual(
+            add_predicate("SELECT * FROM `Loop` WHERE b = '2' "
+                          "ORDER BY b LIMIT 10", "a = '1'"),
+            "SELECT * FROM `Loop` WHERE b = '2' AND (a = '1') "
+            "ORDER BY b LIMIT 10")
+
+    def test_partitions_are_disjoint(self):
+        conn = FakeSDBConnection(page_size=50)
+        put_minute_readings(conn, 4, 60)
+        domain = ShardedDomain(conn, "Loop")
+        query = "SELECT * FROM `Loop`"
+        for predicates in (item_name_partitions(["1001", "1002-0030"]),
+                           starttime_partitions(START, START + 3600, 900)):
+            items = list(domain.select_many(
+                partition_query(query, predicates), ordered=True))
+            self.assertEqual(sorted(item.name for item in items),
+                             sorted(conn.domains["Loop"]))
+        self.assertEqual(len(hex_boundaries(4)), 3)
+        self.assertEqual(hex_boundaries(1000)[-1], "ff")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,678 @@
+import contextlib
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import unittest
+import uuid
+
+import boto.exception
+
+import aws_simpleDB_uploader
+import queries
+from sdb_fake import FakeSDBConnection
+from sdb_schema import to_epoch
+from sdb_shards import ShardedDomain, shard_domain_names
+from sdb_telemetry import Telemetry
+from select_planner import LoopSelectPlan
+
+
+class FailingSDBConnection(FakeSDBConnection):
+    """Fails a fraction of the BatchPutAttributes with a client error, which
+    the throttle does not retry
+    """
+
+    def __init__(self, failure_rate, **kwargs):
+        FakeSDBConnection.__init__(self, **kwargs)
+        self.failure_rate = failure_rate
+
+    def batch_put_attributes(self, domain_or_name, items, replace=True):
+        with self.lock:
+            failed = self.random.random() < self.failure_rate
+        if failed:
+            raise boto.exception.SDBResponseError(400, "Bad Request")
+        return FakeSDBConnection.batch_put_attributes(self, domain_or_name,
+                                                      items, replace)
+
+
+class ConcurrencySDBConnection(FakeSDBConnection):
+    """Records the most BatchPutAttributes in flight at once"""
+
+    def __init__(self, **kwargs):
+        FakeSDBConnection.__init__(self, **kwargs)
+        self.in_flight = 0
+        self.most_in_flight = 0
+        self.in_flight_lock = threading.Lock()
+
+    def batch_put_attributes(self, domain_or_name, items, replace=True):
+        with self.in_flight_lock:
+            self.in_flight += 1
+            self.most_in_flight = max(self.most_in_flight, self.in_flight)
+        try:
+            time.sleep(0.002)
+            return FakeSDBConnection.batch_put_attributes(
+                self, domain_or_name, items, replace)
+        finally:
+            with self.in_flight_lock:
+                self.in_flight -= 1
+
+
+class CountingSDBConnection(FakeSDBConnection):
+    """Counts the items of the BatchPutAttributes"""
+
+    def __init__(self, **kwargs):
+        FakeSDBConnection.__init__(self, **kwargs)
+        self.items_sent = 0
+
+    def batch_put_attributes(self, domain_or_name, items, replace=True):
+        with self.lock:
+            self.items_sent += len(items)
+        return FakeSDBConnection.batch_put_attributes(self, domain_or_name,
+                                                      items, replace)
+
+
+@contextlib.contextmanager
+def quiet():
+    """Silence the progress the uploader prints, of the parsers too"""
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, "w")
+    try:
+        yield
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+
+def write_lines(path, rows):
+    with open(path, "w") as file_handler:
+        for row in rows:
+            file_handler.write(",".join(str(v) for v in row) + "\n")
+
+
+def domain_items(conn, domain_name, shard_count=1):
+    items = {}
+    for name in shard_domain_names(domain_name, shard_count):
+        items.update(conn.domains[name])
+    return items
+
+
+class UploadTestCase(unittest.TestCase):
+    """Runs in a temporary directory, where the uploader keeps its caches"""
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.work_dir = tempfile.mkdtemp(prefix="test_uploader_")
+        os.chdir(self.work_dir)
+        os.mkdir("data")
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.work_dir)
+
+    def upload(self, conn, domain_name="Test", shard_count=1, header="a,b",
+               **kwargs):
+        # Created up front, a new domain waits for consistency
+        for name in shard_domain_names(domain_name, shard_count):
+            conn.create_domain(name)
+        kwargs.setdefault("worker_count", 2)
+        kwargs.setdefault("sender_count", 4)
+        kwargs.setdefault("connection_factory", lambda: conn)
+        with quiet():
+            aws_simpleDB_uploader.upload_to_simpleDB(
+                conn, domain_name, "data", header, reuse_domain=True,
+                shard_count=shard_count, **kwargs)
+
+
+class WorkUnitTest(UploadTestCase):
+
+    def work_units(self, sizes, unit_size):
+        files = []
+        for i, size in enumerate(sizes):
+            path = "data/%s.csv" % i
+            with open(path, "wb") as file_handler:
+                file_handler.write("x" * (size - 1) + "\n")
+            files.append(path)
+        file_stats = aws_simpleDB_uploader.get_files_line_count(
+            files, 1, cache_file=None)
+        with quiet():
+            return list(aws_simpleDB_uploader._work_units(
+                files, file_stats, unit_size, Telemetry()))
+
+    def test_units_balanced_across_files(self):
+        sizes = [50000, 300, 120, 7000, 90000, 10]
+        units = self.work_units(sizes, 4096)
+        unit_bytes = [sum(end - start for _, start, end in unit)
+                      for unit in units]
+        self.assertTrue(all(b >= 4096 for b in unit_bytes[:-1]))
+        self.assertTrue(all(b < 2 * 4096 for b in unit_bytes))
+        self.assertEqual(sum(unit_bytes), sum(sizes))
+        # Every byte of every file once, in order
+        for i, size in enumerate(sizes):
+            ranges = [(start, end) for unit in units
+                      for path, start, end in unit
+                      if path == "data/%s.csv" % i]
+            self.assertEqual(ranges[0][0], 0)
+            self.assertEqual(ranges[-1][1], size)
+            for (_, end), (start, _) in zip(ranges, ranges[1:]):
+                self.assertEqual(end, start)
+
+    def test_small_files_packed(self):
+        units = self.work_units([100] * 30, 1000)
+        self.assertEqual([len(unit) for unit in units], [10, 10, 10])
+
+
+class DecodeRangeTest(UploadTestCase):
+
+    data = "1,a\n\n22,bb\n 333,ccc \n4444,dddd\n55555,e"
+
+    def decoded(self, path, ranges, csv_quoting=False):
+        items = []
+        with open(path, "rb") as file_handler:
+            for start, end in ranges:
+                items.extend(aws_simpleDB_uploader.decode_range(
+                    file_handler, start, end, ("a", "b"), ",", csv_quoting))
+        return items
+
+    def test_same_lines_as_file_range_lines(self):
+        with open("data/a.csv", "wb") as file_handler:
+            file_handler.write(self.data)
+        whole = self.decoded("data/a.csv", [(0, len(self.data))])
+        self.assertEqual([item for item, _ in whole],
+                         [{"a": "1", "b": "a"}, {"a": "22", "b": "bb"},
+                          {"a": "333", "b": "ccc"},
+                          {"a": "4444", "b": "dddd"},
+                          {"a": "55555", "b": "e"}])
+        # line_end is past the new line of each line
+        self.assertEqual([line_end for _, line_end in whole],
+                         [4, 11, 21, 31, 38])
+        for cut in range(1, len(self.data)):
+            ranges = [(0, cut), (cut, len(self.data))]
+            self.assertEqual(self.decoded("data/a.csv", ranges), whole)
+            with open("data/a.csv", "rb") as file_handler:
+                lines = [line for start, end in ranges for line in
+                         aws_simpleDB_uploader.file_range_lines(
+                             file_handler, start, end) if line]
+            self.assertEqual(len(lines), len(whole))
+
+    def test_csv_quoting(self):
+        data = 'x,"a, b"\r\n"y ""z""",c\n'
+        with open("data/a.csv", "wb") as file_handler:
+            file_handler.write(data)
+        self.assertEqual(self.decoded("data/a.csv", [(0, len(data))], True),
+                         [({"a": "x", "b": "a, b"}, 10),
+                          ({"a": 'y "z"', "b": "c"}, len(data))])
+
+    def test_empty_file(self):
+        open("data/a.csv", "wb").close()
+        self.assertEqual(self.decoded("data/a.csv", [(0, 0)]), [])
+
+
+class BatchPackerTest(unittest.TestCase):
+
+    def packed(self, items, duplicate_keys="merge"):
+        packer = aws_simpleDB_uploader.BatchPacker(duplicate_keys)
+        batches = []
+        with quiet():
+            for item_name, attributes in items:
+                batches.extend(packer.add(item_name, attributes))
+        batches.extend(packer.flush())
+        return packer, [batch for batch, _ in batches]
+
+    def test_full_batches(self):
+        _, batches = self.packed(("i%s" % i, {"a": str(i)})
+                                 for i in range(60))
+        self.assertEqual([len(batch) for batch in batches], [25, 25, 10])
+
+    def test_attribute_pairs_split(self):
+        attributes = dict(("a%03d" % i, str(i)) for i in range(600))
+        _, batches = self.packed([("big", attributes)])
+        self.assertEqual([len(batch["big"]) for batch in batches],
+                         [256, 256, 88])
+        merged = {}
+        for batch in batches:
+            merged.update(batch["big"])
+        self.assertEqual(merged, attributes)
+
+    def test_request_bytes(self):
+        value = "v" * 1000
+        items = [("i%s" % i, dict(("a%s" % a, value) for a in range(200)))
+                 for i in range(20)]
+        _, batches = self.packed(items)
+        self.assertEqual(sum(len(batch) for batch in batches), 20)
+        for batch in batches:
+            self.assertLessEqual(
+                sum(aws_simpleDB_uploader.BatchPacker._request_bytes(n, a)
+                    for n, a in batch.items()),
+                aws_simpleDB_uploader.SIMPLE_DB_REQUEST_BYTES_LIMIT)
+        self.assertGreater(len(batches), 1)
+
+    def test_duplicate_keys(self):
+        items = [("a", {"x": "1", "y": "1"}), ("b", {"x": "2"}),
+                 ("a", {"y": "3"})]
+        _, batches = self.packed(items)
+        self.assertEqual(batches, [{"a": {"x": "1", "y": "3"},
+                                    "b": {"x": "2"}}])
+        _, batches = self.packed(items, "spill")
+        self.assertEqual(batches, [{"a": {"x": "1", "y": "1"},
+                                    "b": {"x": "2"}}, {"a": {"y": "3"}}])
+        with self.assertRaises(ValueError):
+            aws_simpleDB_uploader.BatchPacker("drop")
+
+    def test_oversized_rejected(self):
+        packer, batches = self.packed([("a", {"x": "v" * 1025}),
+                                       ("b", {"x": "1"})])
+        self.assertEqual(packer.rejected, 1)
+        self.assertEqual(batches, [{"b": {"x": "1"}}])
+
+    def test_checkpoint_with_its_item(self):
+        packer = aws_simpleDB_uploader.BatchPacker()
+        batches = []
+        for i in range(30):
+            batches.extend(packer.add("i%s" % i, {"a": "1"},
+                                      (("f", 0, 0), i + 1)))
+        batches.extend(packer.flush())
+        self.assertEqual([checkpoints for _, checkpoints in batches],
+                         [{("f", 0, 0): 25}, {("f", 0, 0): 30}])
+
+
+class SenderTest(UploadTestCase):
+
+    def test_full_batches_without_domain_lookups(self):
+        write_lines("data/a.csv", [(i, i) for i in range(1000)])
+        conn = FakeSDBConnection()
+        self.upload(conn)
+        self.assertEqual(len(conn.domains["Test"]), 1000)
+        self.assertEqual(conn.requests["BatchPutAttributes"], 40)
+        # The domain lookup and the item counts before and after, none to
+        # validate the domain of a batch
+        self.assertEqual(conn.requests["Select"], 3)
+
+    def test_in_flight_requests_bounded(self):
+        write_lines("data/a.csv", [(i, i) for i in range(2000)])
+        conn = ConcurrencySDBConnection()
+        self.upload(conn, sender_count=8, max_in_flight=2)
+        self.assertEqual(len(conn.domains["Test"]), 2000)
+        self.assertEqual(conn.most_in_flight, 2)
+
+    def test_connection_per_sender(self):
+        write_lines("data/a.csv", [(i, i) for i in range(100)])
+        conn = FakeSDBConnection()
+        connections = []
+
+        def connection_factory():
+            connections.append(conn)
+            return conn
+        self.upload(conn, sender_count=3,
+                    connection_factory=connection_factory)
+        self.assertEqual(len(connections), 3)
+
+
+class ResumeTest(UploadTestCase):
+
+    def write_files(self):
+        for f in range(3):
+            write_lines("data/part_%s.csv" % f,
+                        [(f * 1000 + i, i * 7) for i in range(1000)])
+
+    def failed_then_resumed(self, shard_count=1, key_column=None):
+        self.write_files()
+        conn = FailingSDBConnection(0.2, seed=1)
+        with self.assertRaises(RuntimeError):
+            self.upload(conn, shard_count=shard_count, key_column=key_column,
+                        work_unit_size=4096)
+        self.assertLess(len(domain_items(conn, "Test", shard_count)), 3000)
+        conn.failure_rate = 0.0
+        self.upload(conn, shard_count=shard_count, key_column=key_column,
+                    work_unit_size=4096, resume=True)
+        return domain_items(conn, "Test", shard_count)
+
+    def test_resume_without_key_column_does_not_duplicate(self):
+        items = self.failed_then_resumed()
+        self.assertEqual(len(items), 3000)
+        self.assertEqual(set(int(item["a"][0]) for item in items.values()),
+                         set(range(3000)))
+
+    def test_resume_sharded_without_key_column(self):
+        items = self.failed_then_resumed(shard_count=3)
+        self.assertEqual(len(items), 3000)
+
+    def test_resume_with_key_column(self):
+        items = self.failed_then_resumed(key_column="a")
+        self.assertEqual(set(items), set(str(i) for i in range(3000)))
+
+    def test_line_item_names_are_uuid5_of_path_and_offset(self):
+        item_name = aws_simpleDB_uploader.line_item_names("data/a.csv")
+        namespace = uuid.uuid5(uuid.NAMESPACE_URL,
+                               os.path.abspath("data/a.csv"))
+        for line_end in (0, 1, 17, 123456789, 2 ** 40):
+            self.assertEqual(item_name(line_end),
+                             str(uuid.uuid5(namespace, str(line_end))))
+
+    def test_line_item_names_are_stable(self):
+        self.write_files()
+        first = FakeSDBConnection()
+        self.upload(first)
+        second = FakeSDBConnection()
+        self.upload(second)
+        self.assertEqual(set(first.domains["Test"]),
+                         set(second.domains["Test"]))
+
+
+class LineCountTest(UploadTestCase):
+
+    def setUp(self):
+        UploadTestCase.setUp(self)
+        # Loaded again from this directory
+        aws_simpleDB_uploader._line_count_cache = None
+
+    def test_count_file_lines(self):
+        for name, data in (("a", "1\n2\n3\n"), ("b", "1\n2\n3"),
+                           ("c", ""), ("d", "\n\n1\n"), ("e", "x" * 10)):
+            path = "data/%s.csv" % name
+            with open(path, "wb") as file_handler:
+                file_handler.write(data)
+            with open(path, "rb") as file_handler:
+                expected = len(file_handler.readlines())
+            self.assertEqual(aws_simpleDB_uploader.count_file_lines(path),
+                             (path, expected, len(data)))
+
+    def test_counts_cached_by_size_and_mtime(self):
+        write_lines("data/a.csv", [(i, i) for i in range(5)])
+        write_lines("data/b.csv", [(i, i) for i in range(7)])
+        counted = []
+        count_file_lines = aws_simpleDB_uploader.count_file_lines
+
+        def recorded(file_path):
+            counted.append(file_path)
+            return count_file_lines(file_path)
+        aws_simpleDB_uploader.count_file_lines = recorded
+        try:
+            files = ["data/a.csv", "data/b.csv"]
+            stats = aws_simpleDB_uploader.get_files_line_count(files, 1)
+            self.assertEqual(stats["data/a.csv"][0], 5)
+            self.assertEqual(stats["data/b.csv"][0], 7)
+            self.assertTrue(os.path.isfile(
+                aws_simpleDB_uploader.LINE_COUNT_CACHE_FILE))
+            # Served from the cache file by a new process
+            aws_simpleDB_uploader._line_count_cache = None
+            write_lines("data/b.csv", [(i, i) for i in range(9)])
+            stats = aws_simpleDB_uploader.get_files_line_count(files, 1)
+        finally:
+            aws_simpleDB_uploader.count_file_lines = count_file_lines
+        self.assertEqual(sorted(counted),
+                         ["data/a.csv", "data/b.csv", "data/b.csv"])
+        self.assertEqual(stats["data/a.csv"][0], 5)
+        self.assertEqual(stats["data/b.csv"][0], 9)
+
+    def test_files_counted_together(self):
+        for f in range(3):
+            write_lines("data/part_%s.csv" % f,
+                        [(i, f) for i in range(10 + f)])
+        calls = []
+        get_files_line_count = aws_simpleDB_uploader.get_files_line_count
+
+        def recorded(files, *args, **kwargs):
+            calls.append(sorted(files))
+            return get_files_line_count(files, *args, **kwargs)
+        aws_simpleDB_uploader.get_files_line_count = recorded
+        try:
+            conn = FakeSDBConnection()
+            self.upload(conn)
+        finally:
+            aws_simpleDB_uploader.get_files_line_count = get_files_line_count
+        self.assertEqual(calls, [["data/part_0.csv", "data/part_1.csv",
+                                  "data/part_2.csv"]])
+        self.assertEqual(len(domain_items(conn, "Test")), 33)
+
+
+class FileDiscoveryTest(UploadTestCase):
+
+    def setUp(self):
+        UploadTestCase.setUp(self)
+        os.makedirs("data/sub/deeper")
+        for path, size in (("data/b.csv", 10), ("data/a.CSV", 100),
+                           ("data/notes.txt", 5), ("data/sub/c.csv.gz", 20),
+                           ("data/sub/deeper/d.csv", 1000)):
+            with open(path, "wb") as file_handler:
+                file_handler.write("x" * size)
+
+    def files(self, recursive=True, predicates=None):
+        return list(aws_simpleDB_uploader.iter_files(
+            "data", recursive=recursive, predicates=predicates))
+
+    def test_depth_first_in_name_order(self):
+        expected = ["data/a.CSV", "data/b.csv", "data/notes.txt",
+                    "data/sub/c.csv.gz", "data/sub/deeper/d.csv"]
+        self.assertEqual(self.files(), expected)
+        self.assertEqual(self.files(recursive=False), expected[:3])
+
+    def test_without_scandir(self):
+        scandir = aws_simpleDB_uploader.scandir
+        aws_simpleDB_uploader.scandir = None
+        try:
+            files = self.files()
+        finally:
+            aws_simpleDB_uploader.scandir = scandir
+        self.assertEqual(files, self.files())
+
+    def test_predicates(self):
+        ext_predicate = aws_simpleDB_uploader.ext_predicate
+        self.assertEqual(self.files(predicates=[ext_predicate("csv")]),
+                         ["data/a.CSV", "data/b.csv", "data/sub/c.csv.gz",
+                          "data/sub/deeper/d.csv"])
+        self.assertEqual(self.files(predicates=[ext_predicate(".gz")]),
+                         ["data/sub/c.csv.gz"])
+        self.assertEqual(
+            self.files(predicates=[
+                aws_simpleDB_uploader.size_predicate(10, 100)]),
+            ["data/a.CSV", "data/b.csv", "data/sub/c.csv.gz"])
+        self.assertEqual(
+            self.files(predicates=[
+                aws_simpleDB_uploader.glob_predicate("*.csv"),
+                aws_simpleDB_uploader.size_predicate(max_size=100)]),
+            ["data/b.csv"])
+        os.utime("data/b.csv", (0, 0))
+        self.assertNotIn("data/b.csv", self.files(predicates=[
+            aws_simpleDB_uploader.modified_since_predicate(1)]))
+
+    def test_directory_links_not_followed(self):
+        os.symlink(os.path.abspath("data/sub"), "data/sub/deeper/loop")
+        self.assertEqual(len(self.files()), 5)
+
+
+class UploadJournalTest(UploadTestCase):
+
+    def setUp(self):
+        UploadTestCase.setUp(self)
+        write_lines("data/a.csv", [(i, i) for i in range(100)])
+        self.ranges = [("data/a.csv", 0, 200), ("data/a.csv", 200, 400)]
+
+    def journal(self, resume=True, shard_count=1):
+        return aws_simpleDB_uploader.UploadJournal(
+            "journal.jsonl", resume=resume, shard_count=shard_count)
+
+    def test_commits_in_batch_order(self):
+        journal = self.journal(resume=False)
+        journal.pending_ranges(self.ranges)
+        key = ("data/a.csv", 0, 0)
+        # The second batch of the range is sent before the first one
+        journal.commit({key: (1, 120)})
+        journal.close()
+        self.assertEqual(self.journal().pending_ranges(self.ranges),
+                         [("data/a.csv", 0, 200, 0),
+                          ("data/a.csv", 200, 400, 200)])
+        journal = self.journal()
+        journal.pending_ranges(self.ranges)
+        journal.commit({key: (0, 60)})
+        journal.commit({key: (1, 120)})
+        journal.commit({("data/a.csv", 200, 0): (0, 400)})
+        journal.close()
+        self.assertEqual(self.journal().pending_ranges(self.ranges),
+                         [("data/a.csv", 0, 200, 120)])
+
+    def test_least_advanced_shard(self):
+        journal = self.journal(resume=False, shard_count=2)
+        journal.pending_ranges(self.ranges)
+        journal.commit({("data/a.csv", 0, 0): (0, 150),
+                        ("data/a.csv", 0, 1): (0, 90)})
+        journal.close()
+        pending = self.journal(shard_count=2).pending_ranges(self.ranges)
+        self.assertEqual(pending[0], ("data/a.csv", 0, 200, 90))
+
+    def test_changed_file_starts_over(self):
+        journal = self.journal(resume=False)
+        journal.pending_ranges(self.ranges)
+        journal.commit({("data/a.csv", 0, 0): (0, 200)})
+        journal.close()
+        write_lines("data/a.csv", [(i, i) for i in range(101)])
+        self.assertEqual(len(self.journal().pending_ranges(self.ranges)), 2)
+
+    def test_torn_last_line(self):
+        journal = self.journal(resume=False)
+        journal.pending_ranges(self.ranges)
+        journal.commit({("data/a.csv", 0, 0): (0, 200)})
+        journal.close()
+        with open("journal.jsonl", "a") as journal_handler:
+            journal_handler.write('{"file": "data/a.csv", "sta')
+        self.assertEqual(self.journal().pending_ranges(self.ranges),
+                         [("data/a.csv", 200, 400, 200)])
+
+
+class StarttimeTest(UploadTestCase):
+    """Starttimes written with a space, as the loop data exports are"""
+
+    def write_readings(self):
+        write_lines("data/loop.csv",
+                    [(1000 + i % 2, "2011-09-%s %02d:00:00-07" % (day, hour),
+                      50) for i, (day, hour) in
+                     enumerate((d, h) for d in (15, 16) for h in range(24))])
+
+    def test_separator_normalized_without_schema(self):
+        self.write_readings()
+        conn = FakeSDBConnection()
+        self.upload(conn, "Loop", header="detectorid,starttime,speed")
+        starttimes = [item["starttime"][0] for item in
+                      domain_items(conn, "Loop").values()]
+        self.assertEqual(len(starttimes), 48)
+        self.assertTrue(all(s[10] == "T" and s.endswith("-07")
+                            for s in starttimes))
+        # The window of the 16th has its 24 readings, none of the 15th
+        plan = LoopSelectPlan("Loop", ["1000", "1001"],
+                              to_epoch("2011-09-16T00:00:00"),
+                              to_epoch("2011-09-17T00:00:00"))
+        selected = list(plan.select(conn.get_domain("Loop")))
+        self.assertEqual(len(selected), 24)
+        self.assertTrue(all(item["starttime"].startswith("2011-09-16T")
+                            for item in selected))
+
+    def test_space_separated_domain_rejected(self):
+        conn = FakeSDBConnection()
+        domain = conn.create_domain("Loop")
+        domain.batch_put_attributes(
+            {"1": {"starttime": "2011-09-15T00:00:00"}})
+        queries.check_starttime_format(ShardedDomain(conn, "Loop"))
+        domain.batch_put_attributes(
+            {"1": {"starttime": "2011-09-15 00:00:00-07"}})
+        with self.assertRaises(RuntimeError):
+            queries.check_starttime_format(ShardedDomain(conn, "Loop"))
+
+
+class ManifestTest(UploadTestCase):
+
+    def setUp(self):
+        UploadTestCase.setUp(self)
+        write_lines("data/a.csv", [(i, i) for i in range(100)])
+
+    def append_lines(self, path, rows, tail=""):
+        with open(path, "a") as file_handler:
+            for row in rows:
+                file_handler.write(",".join(str(v) for v in row) + "\n")
+            file_handler.write(tail)
+
+    def planned(self, manifest, path="data/a.csv"):
+        plan = manifest.plan(path)
+        manifest.commit()
+        return plan
+
+    def manifest(self):
+        return aws_simpleDB_uploader.UploadManifest("manifest.json")
+
+    def test_plans(self):
+        size = os.path.getsize("data/a.csv")
+        self.assertEqual(self.planned(self.manifest()), (0, size, "new"))
+        self.assertEqual(self.planned(self.manifest()),
+                         (size, size, "unchanged"))
+        self.append_lines("data/a.csv", [(100, 100)])
+        grown = os.path.getsize("data/a.csv")
+        self.assertEqual(self.planned(self.manifest()),
+                         (size, grown, "appended"))
+        # Same size, other bytes
+        with open("data/a.csv", "r+") as file_handler:
+            file_handler.write("9")
+        os.utime("data/a.csv", (0, 0))
+        self.assertEqual(self.planned(self.manifest()),
+                         (0, grown, "rewritten"))
+        # Shorter than uploaded
+        write_lines("data/a.csv", [(i, i) for i in range(10)])
+        self.assertEqual(self.planned(self.manifest())[2], "rewritten")
+
+    def test_incomplete_last_line_left_for_the_next_run(self):
+        size = os.path.getsize("data/a.csv")
+        self.planned(self.manifest())
+        self.append_lines("data/a.csv", [(100, 100)], tail="101,1")
+        complete = size + len("100,100\n")
+        self.assertEqual(self.planned(self.manifest()),
+                         (size, complete, "appended"))
+        self.append_lines("data/a.csv", [], tail="01\n")
+        self.assertEqual(self.planned(self.manifest()),
+                         (complete, os.path.getsize("data/a.csv"),
+                          "appended"))
+
+    def test_not_committed_not_recorded(self):
+        self.manifest().plan("data/a.csv")
+        self.assertFalse(os.path.exists("manifest.json"))
+        self.assertEqual(self.planned(self.manifest())[2], "new")
+
+    def test_corrupt_manifest_uploads_in_full(self):
+        with open("manifest.json", "w") as manifest_handler:
+            manifest_handler.write('{"data/a.csv": {"si')
+        self.assertEqual(self.planned(self.manifest())[2], "new")
+
+    def delta_upload(self, conn):
+        items_sent = conn.items_sent
+        batches = conn.requests.get("BatchPutAttributes", 0)
+        self.upload(conn, key_column="a", delta=True,
+                    manifest_file="manifest.json")
+        return (conn.items_sent - items_sent,
+                conn.requests.get("BatchPutAttributes", 0) - batches)
+
+    def test_delta_uploads(self):
+        write_lines("data/b.csv", [(i, i) for i in range(1000, 1050)])
+        conn = CountingSDBConnection()
+        self.assertEqual(self.delta_upload(conn)[0], 150)
+        # Nothing changed, nothing sent
+        self.assertEqual(self.delta_upload(conn), (0, 0))
+        self.append_lines("data/a.csv", [(i, i) for i in range(100, 130)],
+                          tail="130,")
+        write_lines("data/c.csv", [(i, i) for i in range(2000, 2010)])
+        items_sent, batches = self.delta_upload(conn)
+        self.assertEqual(items_sent, 40)
+        self.assertLess(batches, 150 // 25)
+        items = domain_items(conn, "Test")
+        self.assertEqual(len(items), 190)
+        self.assertNotIn("130", items)
+        # The last line completed
+        self.append_lines("data/a.csv", [], tail="130\n")
+        self.assertEqual(self.delta_upload(conn)[0], 1)
+        self.assertEqual(domain_items(conn, "Test")["130"]["b"], ["130"])
+        # Rewritten, sent in full again
+        write_lines("data/b.csv", [(i, i + 1) for i in range(1000, 1050)])
+        os.utime("data/b.csv", (0, 0))
+        self.assertEqual(self.delta_upload(conn)[0], 50)
+        self.assertEqual(domain_items(conn, "Test")["1000"]["b"], ["1001"])
+
+
+if __name__ == "__main__":
+    unittest.main()